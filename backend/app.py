@@ -1,9 +1,17 @@
-import os, io, json, base64
+import os, io, json, base64, time, threading, uuid, random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait, FIRST_COMPLETED
 from pathlib import Path
-from flask import Flask, request, jsonify
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, url_for, g
 from flask_cors import CORS
-from PIL import Image
+from PIL import Image, ImageOps
+import numpy as np
+import httpx
+import openai
 from openai import OpenAI
+from prometheus_client import (Counter, Histogram, CollectorRegistry, REGISTRY,
+                               generate_latest, CONTENT_TYPE_LATEST, multiprocess)
 
 # === cargar .env del backend ===
 from dotenv import load_dotenv
@@ -13,6 +21,45 @@ load_dotenv(BASE_DIR / ".env")   # lee backend/.env
 app = Flask(__name__)
 CORS(app)
 
+# ===== Métricas (Prometheus) =====
+# Con varios workers de gunicorn exportar PROMETHEUS_MULTIPROC_DIR (startup.sh
+# lo hace): cada proceso escribe sus valores ahí y /metrics los agrega.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40, 80, 120)
+HTTP_SECONDS = Histogram("epp_http_request_seconds", "Duración de requests HTTP por ruta",
+                         ["route", "method", "status"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("epp_analyze_stage_seconds", "Duración de cada etapa del análisis",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+ERRORS = Counter("epp_analyze_errors_total", "Errores del análisis por tipo", ["type"])
+TOKENS = Counter("epp_upstream_tokens_total", "Tokens consumidos en el modelo", ["kind"])
+
+@contextmanager
+def stage(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - t0)
+
+@app.before_request
+def _metrics_start():
+    g._t0 = time.perf_counter()
+
+@app.after_request
+def _metrics_end(resp):
+    t0 = getattr(g, "_t0", None)
+    if t0 is not None and request.url_rule is not None:
+        HTTP_SECONDS.labels(request.url_rule.rule, request.method, str(resp.status_code)).observe(time.perf_counter() - t0)
+    return resp
+
+@app.get("/metrics")
+def metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
 api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise RuntimeError(
@@ -20,7 +67,481 @@ if not api_key:
         "Editá backend/.env y agregá: OPENAI_API_KEY=sk-xxxxxxxx"
     )
 
-client = OpenAI(api_key=api_key)
+# OPENAI_BASE_URL permite apuntar a un servidor compatible (p.ej. mock_openai.py para benchmarks)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# ===== Llamada resiliente al modelo =====
+# Pool HTTP con keep-alive, deadline por intento, reintentos con backoff
+# con jitter, request "hedged" opcional y circuit breaker. Los reintentos
+# del SDK se apagan (max_retries=0) para manejarlos acá.
+UPSTREAM_MAX_CONN        = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "32"))
+UPSTREAM_KEEPALIVE       = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "16"))
+UPSTREAM_KEEPALIVE_S     = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY_S", "60"))
+UPSTREAM_CONNECT_S       = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_S", "5"))
+UPSTREAM_ATTEMPT_S       = float(os.getenv("UPSTREAM_ATTEMPT_TIMEOUT_S", "30"))
+UPSTREAM_DEADLINE_S      = float(os.getenv("UPSTREAM_DEADLINE_S", "100"))
+UPSTREAM_RETRIES         = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE_S  = float(os.getenv("UPSTREAM_BACKOFF_BASE_S", "0.25"))
+UPSTREAM_BACKOFF_MAX_S   = float(os.getenv("UPSTREAM_BACKOFF_MAX_S", "4"))
+UPSTREAM_HEDGE           = os.getenv("UPSTREAM_HEDGE", "0") == "1"
+UPSTREAM_HEDGE_MIN_S     = float(os.getenv("UPSTREAM_HEDGE_MIN_S", "2"))
+UPSTREAM_HEDGE_DEFAULT_S = float(os.getenv("UPSTREAM_HEDGE_DEFAULT_S", "8"))
+BREAKER_FAILURES         = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_S       = float(os.getenv("BREAKER_COOLDOWN_S", "30"))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+class UpstreamUnavailable(Exception):
+    """El circuit breaker está abierto: no se intenta la llamada."""
+
+def is_retryable(ex):
+    if isinstance(ex, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(ex, openai.APIStatusError):
+        return ex.status_code in RETRYABLE_STATUS
+    return False
+
+class CircuitBreaker:
+    """closed -> open tras N fallas seguidas; tras el cooldown deja pasar
+    un intento de prueba (half_open) que lo cierra o lo vuelve a abrir."""
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown_s=BREAKER_COOLDOWN_S):
+        self.failures = failures
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe_out = False
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown_s:
+                self.state = "half_open"
+                self._probe_out = False
+            if self.state == "half_open" and not self._probe_out:
+                self._probe_out = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self.state = "closed"
+
+    def release(self):
+        """Devuelve el intento de prueba sin veredicto (el error no fue del upstream)."""
+        with self._lock:
+            self._probe_out = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self.state == "half_open" or (self.failures > 0 and self._consecutive >= self.failures):
+                if self.state != "open":
+                    self.opens += 1
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+class LatencyWindow:
+    """Últimas N latencias exitosas, para calcular el p95 del hedge."""
+
+    def __init__(self, size=200):
+        self._vals = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, secs):
+        with self._lock:
+            self._vals.append(secs)
+
+    def quantile(self, q):
+        with self._lock:
+            vals = sorted(self._vals)
+        if not vals:
+            return None
+        return vals[min(len(vals) - 1, int(q * len(vals)))]
+
+    def __len__(self):
+        return len(self._vals)
+
+class UpstreamPolicy:
+    """Breaker, reintentos con jitter, deadline y métricas de la llamada al
+    modelo, sin I/O: ResilientCaller (hilos) y AsyncResilientCaller (asgi.py)
+    sólo ponen el intento y la espera entre reintentos."""
+
+    def __init__(self, client, retries=UPSTREAM_RETRIES, attempt_s=UPSTREAM_ATTEMPT_S,
+                 deadline_s=UPSTREAM_DEADLINE_S, hedge=UPSTREAM_HEDGE):
+        self.client = client
+        self.retries = retries
+        self.attempt_s = attempt_s
+        self.deadline_s = deadline_s
+        self.hedge = hedge
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyWindow()
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                         "failures": 0, "rejected_open": 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def hedge_delay(self):
+        p95 = self.latency.quantile(0.95) if len(self.latency) >= 20 else None
+        return max(UPSTREAM_HEDGE_MIN_S, p95 if p95 is not None else UPSTREAM_HEDGE_DEFAULT_S)
+
+    @staticmethod
+    def backoff(ex, attempt):
+        # full jitter: sleep uniforme en [0, min(max, base*2^n)]
+        backoff = random.uniform(0, min(UPSTREAM_BACKOFF_MAX_S, UPSTREAM_BACKOFF_BASE_S * (2 ** attempt)))
+        retry_after = getattr(getattr(ex, "response", None), "headers", {}).get("retry-after")
+        if retry_after:
+            try:
+                backoff = max(backoff, min(float(retry_after), UPSTREAM_BACKOFF_MAX_S))
+            except ValueError:
+                pass
+        return backoff
+
+    def _start(self):
+        """Cuenta la llamada y devuelve su deadline."""
+        self._count("calls")
+        return time.monotonic() + self.deadline_s
+
+    def _admit(self, deadline):
+        """Pide paso al breaker y devuelve el timeout del próximo intento."""
+        if not self.breaker.allow():
+            self._count("rejected_open")
+            raise UpstreamUnavailable("upstream unavailable (circuit open)")
+        return min(self.attempt_s, max(0.1, deadline - time.monotonic()))
+
+    def _retry_delay(self, ex, attempt, deadline):
+        """Veredicto del breaker para un intento fallido. Devuelve cuánto
+        esperar antes de reintentar, o relanza ex si no se reintenta."""
+        if not is_retryable(ex):
+            if isinstance(ex, openai.APIStatusError):
+                self.breaker.record_success()   # 400/401...: el upstream responde
+            else:
+                self.breaker.release()
+            raise ex
+        self.breaker.record_failure()
+        self._count("failures")
+        backoff = self.backoff(ex, attempt)
+        if attempt >= self.retries or time.monotonic() + backoff >= deadline:
+            raise ex
+        self._count("retries")
+        return backoff
+
+    def stats(self):
+        with self._lock:
+            c = dict(self.counters)
+        p50, p95, p99 = (self.latency.quantile(q) for q in (0.5, 0.95, 0.99))
+        return {**c,
+                "breaker_state": self.breaker.state,
+                "breaker_opens": self.breaker.opens,
+                "hedge_enabled": self.hedge,
+                "hedge_delay_s": round(self.hedge_delay(), 3),
+                "latency_s": {"p50": p50, "p95": p95, "p99": p99, "samples": len(self.latency)}}
+
+class ResilientCaller(UpstreamPolicy):
+    def __init__(self, client, **kw):
+        super().__init__(client, **kw)
+        self._pool = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_CONN, thread_name_prefix="epp-upstream")
+
+    def _attempt(self, timeout_s, kwargs):
+        self._count("attempts")
+        t0 = time.monotonic()
+        resp = self.client.with_options(timeout=timeout_s).chat.completions.create(**kwargs)
+        self.latency.add(time.monotonic() - t0)
+        return resp
+
+    def _attempt_hedged(self, timeout_s, kwargs):
+        """Lanza un intento; si no terminó en hedge_delay() lanza otro igual y
+        se queda con el primero que responda bien."""
+        first = self._pool.submit(self._attempt, timeout_s, kwargs)
+        done, _ = futures_wait([first], timeout=self.hedge_delay())
+        if done:
+            return first.result()
+        self._count("hedges")
+        second = self._pool.submit(self._attempt, timeout_s, kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    if f is second:
+                        self._count("hedge_wins")
+                    return f.result()
+                error = f.exception()
+        raise error
+
+    def create(self, **kwargs):
+        deadline = self._start()
+        attempt = 0
+        while True:
+            timeout_s = self._admit(deadline)
+            try:
+                if self.hedge:
+                    resp = self._attempt_hedged(timeout_s, kwargs)
+                else:
+                    resp = self._attempt(timeout_s, kwargs)
+            except Exception as ex:
+                delay = self._retry_delay(ex, attempt, deadline)
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return resp
+            attempt += 1
+            time.sleep(delay)
+
+# asgi.py importa este módulo por el pipeline y arma sus propios clientes
+# async: con SERVE_MODE=asgi no se crean el pool httpx, el cliente OpenAI sync,
+# sus hilos ni el motor de trabajos.
+SYNC_MODE = os.getenv("SERVE_MODE", "sync") != "asgi"
+
+if SYNC_MODE:
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONN,
+                            max_keepalive_connections=UPSTREAM_KEEPALIVE,
+                            keepalive_expiry=UPSTREAM_KEEPALIVE_S),
+        timeout=httpx.Timeout(UPSTREAM_ATTEMPT_S, connect=UPSTREAM_CONNECT_S),
+    )
+    client = OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, max_retries=0,
+                    timeout=httpx.Timeout(UPSTREAM_ATTEMPT_S, connect=UPSTREAM_CONNECT_S),
+                    http_client=http_client)
+    upstream = ResilientCaller(client)
+else:
+    upstream = None
+
+# ===== Caché de resultados por hash perceptual =====
+# Dos fotos casi iguales (doble toque, trabajador quieto frente al kiosko) dan
+# el mismo dHash salvo unos pocos bits: reutilizamos el resultado del modelo.
+# El parecido solo cuenta dentro del mismo 'uid'; sin uid, solo hash idéntico.
+CACHE_MAX_ITEMS = int(os.getenv("ANALYZE_CACHE_MAX_ITEMS", "256"))
+CACHE_TTL_S     = float(os.getenv("ANALYZE_CACHE_TTL_S", "30"))
+CACHE_MAX_DIST  = int(os.getenv("ANALYZE_CACHE_MAX_DIST", "6"))   # distancia de Hamming (bits de 64)
+
+def dhash(img: Image.Image, size: int = 8) -> int:
+    """Difference hash de 64 bits: compara píxeles vecinos en una miniatura en grises."""
+    g = img.convert("L").resize((size + 1, size), Image.BILINEAR)
+    px = list(g.getdata())
+    h = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            h = (h << 1) | (1 if px[base + col] > px[base + col + 1] else 0)
+    return h
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+class ResultCache:
+    """LRU + TTL indexado por (required, min_conf, sujeto); dentro de cada clave
+    busca el hash más cercano con distancia <= max_dist. Sin sujeto (uid) solo
+    comparte resultado un duplicado exacto: dos personas distintas con el mismo
+    encuadre pueden quedar a pocos bits y el veredicto es de seguridad."""
+
+    def __init__(self, max_items=CACHE_MAX_ITEMS, ttl_s=CACHE_TTL_S, max_dist=CACHE_MAX_DIST):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.max_dist = max_dist
+        self._items = OrderedDict()   # (params, phash) -> (expires_at, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def params_key(required, min_conf, subject=None):
+        return (tuple(sorted(str(x) for x in required)), round(float(min_conf), 3), subject or None)
+
+    def get(self, phash, required, min_conf, subject=None):
+        if self.max_items <= 0:
+            return None
+        pk = self.params_key(required, min_conf, subject)
+        max_dist = self.max_dist if pk[2] else 0
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_dist = None, None
+            for key, (exp, _res) in list(self._items.items()):
+                if exp <= now:
+                    del self._items[key]
+                    continue
+                if key[0] != pk:
+                    continue
+                d = hamming(key[1], phash)
+                if d <= max_dist and (best_dist is None or d < best_dist):
+                    best_key, best_dist = key, d
+                    if d == 0:
+                        break
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(best_key)
+            self.hits += 1
+            return self._items[best_key][1]
+
+    def put(self, phash, required, min_conf, result, subject=None):
+        if self.max_items <= 0:
+            return
+        key = (self.params_key(required, min_conf, subject), phash)
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl_s, result)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "size": len(self._items),
+                "max_items": self.max_items,
+                "ttl_s": self.ttl_s,
+                "max_dist": self.max_dist,
+            }
+
+result_cache = ResultCache()
+
+# ===== Preprocesado de imagen (una sola decodificación) =====
+# Se decodifica una única vez (con draft de JPEG para decodificar ya reducido),
+# se corrige la orientación EXIF, se achica al lado máximo y se re-encoda.
+MAX_EDGE     = int(os.getenv("ANALYZE_MAX_EDGE", "1024"))
+JPEG_QUALITY = int(os.getenv("ANALYZE_JPEG_QUALITY", "85"))
+
+def preprocess_image(raw: bytes, max_edge: int = MAX_EDGE, quality: int = JPEG_QUALITY):
+    """Devuelve (imagen RGB ya achicada, bytes JPEG a enviar, info).
+    Lanza excepción si los bytes no son una imagen válida."""
+    img = Image.open(io.BytesIO(raw))
+    src_format = img.format
+    src_size = img.size
+    if src_format == "JPEG" and max_edge > 0:
+        # draft elige el mayor factor de escala 1/2, 1/4, 1/8 que no baje de lo pedido
+        img.draft("RGB", (max_edge, max_edge))
+    img.load()
+    changed = img.size != src_size
+    if img.getexif().get(0x0112, 1) != 1:   # tag Orientation
+        img = ImageOps.exif_transpose(img)
+        changed = True
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+        changed = True
+    if max_edge > 0 and max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        changed = True
+
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    sent = out.getvalue()
+    # Si ya era un JPEG chico y derecho, re-encodar no aporta: mandamos el original
+    if not changed and src_format == "JPEG" and len(raw) <= len(sent):
+        sent = raw
+
+    info = {
+        "orig_bytes": len(raw),
+        "sent_bytes": len(sent),
+        "saved_bytes": len(raw) - len(sent),
+        "orig_size": list(src_size),
+        "sent_size": list(img.size),
+    }
+    return img, sent, info
+
+# ===== Pre-chequeo de calidad (local, antes del modelo) =====
+# Sobre un cuadro reducido en grises medimos tamaño, contraste, brillo y nitidez
+# (varianza del Laplaciano). Si la foto falla claramente respondemos "retake"
+# con el mismo schema de report_epp, sin pagar la llamada al modelo.
+# Los umbrales son conservadores: ante la duda decide el modelo.
+QUALITY_GATE         = os.getenv("QUALITY_GATE", "1") == "1"
+QUALITY_EDGE         = int(os.getenv("QUALITY_EDGE", "256"))              # lado mayor del cuadro medido
+QUALITY_MIN_SIDE     = int(os.getenv("QUALITY_MIN_SIDE_PX", "160"))       # lado menor de la foto original
+QUALITY_MIN_CONTRAST = float(os.getenv("QUALITY_MIN_CONTRAST", "8"))      # desvío de luminancia (0-255)
+QUALITY_MIN_BRIGHT   = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "25"))   # luminancia media (0-255)
+QUALITY_MIN_SHARP    = float(os.getenv("QUALITY_MIN_SHARPNESS", "15"))    # varianza del Laplaciano
+
+QUALITY_CHECKS = Counter("epp_quality_gate_total", "Resultado del pre-chequeo de calidad", ["result"])
+EPP_KEYS = ["casco", "chaleco", "gafas", "guantes", "botas"]
+RETAKE_MSG = {
+    "too_far": "foto demasiado chica: acercate a la cámara",
+    "occluded": "no se ve la escena (cámara tapada o encuadre vacío)",
+    "low_light": "foto muy oscura: buscá más luz",
+    "blurry": "foto movida o desenfocada: quedate quieto",
+}
+
+def quality_metrics(img: Image.Image, edge: int = QUALITY_EDGE):
+    """Brillo medio, contraste (desvío) y varianza del Laplaciano en grises,
+    sobre la imagen reducida a ~edge px de lado mayor."""
+    factor = max(1, max(img.size) // edge) if edge > 0 else 1
+    small = (img.reduce(factor) if factor > 1 else img).convert("L")
+    a = np.asarray(small, dtype=np.float32)
+    if a.shape[0] < 3 or a.shape[1] < 3:
+        return {"brightness": float(a.mean()), "contrast": 0.0, "sharpness": 0.0}
+    lap = (a[:-2, 1:-1] + a[2:, 1:-1] + a[1:-1, :-2] + a[1:-1, 2:]) - 4.0 * a[1:-1, 1:-1]
+    return {"brightness": round(float(a.mean()), 1), "contrast": round(float(a.std()), 1),
+            "sharpness": round(float(lap.var()), 1)}
+
+class QualityGate:
+    def __init__(self, enabled=QUALITY_GATE, min_side=QUALITY_MIN_SIDE, min_contrast=QUALITY_MIN_CONTRAST,
+                 min_brightness=QUALITY_MIN_BRIGHT, min_sharpness=QUALITY_MIN_SHARP):
+        self.enabled = enabled
+        self.min_side = min_side
+        self.min_contrast = min_contrast
+        self.min_brightness = min_brightness
+        self.min_sharpness = min_sharpness
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def check(self, img, orig_size):
+        """Devuelve (motivo o None, métricas). El motivo usa los valores de photo_quality."""
+        m = quality_metrics(img)
+        if min(orig_size) < self.min_side:
+            reason = "too_far"
+        elif m["contrast"] < self.min_contrast:
+            reason = "occluded"
+        elif m["brightness"] < self.min_brightness:
+            reason = "low_light"
+        elif m["sharpness"] < self.min_sharpness:
+            reason = "blurry"
+        else:
+            reason = None
+        label = reason or "ok"
+        QUALITY_CHECKS.labels(label).inc()
+        with self._lock:
+            self._counts[label] = self._counts.get(label, 0) + 1
+        return reason, m
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        total = sum(counts.values())
+        rejected = total - counts.get("ok", 0)
+        return {
+            "enabled": self.enabled, "checked": total, "rejected": rejected,
+            "reject_rate": (rejected / total) if total else 0.0, "by_result": counts,
+            "thresholds": {"min_side_px": self.min_side, "min_contrast": self.min_contrast,
+                           "min_brightness": self.min_brightness, "min_sharpness": self.min_sharpness},
+        }
+
+quality_gate = QualityGate()
+
+def retake_result(reason, required):
+    """Resultado con el schema de report_epp para una foto que hay que repetir."""
+    r = {k: {"present": False, "confidence": 0.0} for k in EPP_KEYS}
+    r.update({
+        "comentarios": RETAKE_MSG.get(reason, "repetir la foto"),
+        "photo_quality": reason,
+        "required_echo": list(required),
+        "meets_requirements": False,
+        "missing_required": list(required),
+    })
+    return r
+
 def to_data_url(image_bytes: bytes, mime="image/jpeg") -> str:
     return f"data:{mime};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
 
@@ -38,7 +559,7 @@ REPORT_EPP_TOOL = {
                 "guantes": {"type":"object","properties":{"present":{"type":"boolean"},"confidence":{"type":"number","minimum":0,"maximum":1}},"required":["present","confidence"]},
                 "botas":   {"type":"object","properties":{"present":{"type":"boolean"},"confidence":{"type":"number","minimum":0,"maximum":1}},"required":["present","confidence"]},
                 "comentarios":   {"type":"string"},
-                "photo_quality": {"type":"string","enum":["ok","low_light","blurry","occluded","too_far"]},
+                "photo_quality": {"type":"string","enum":["ok", *RETAKE_MSG]},
                 "required_echo": {"type":"array","items":{"type":"string"}},
                 "meets_requirements": {"type":"boolean"},
                 "missing_required":  {"type":"array","items":{"type":"string"}}
@@ -57,31 +578,28 @@ SYSTEM_PROMPT = (
     "- Devuelve 'meets_requirements' y 'missing_required' acorde a ese criterio.\n"
 )
 
-@app.post("/analyze")
-def analyze():
-    file = request.files.get("image")
-    if not file:
-        return jsonify({"ok": False, "error": "image file missing"}), 400
-
-    # Requisitos desde el front
+def parse_requirements(form):
+    """Lee 'required' (JSON list) y 'min_conf' del form, con los mismos defaults de siempre."""
     try:
-        required = json.loads(request.form.get("required", "[]"))
+        required = json.loads(form.get("required", "[]"))
         if not isinstance(required, list): required = []
     except Exception:
         required = []
     try:
-        min_conf = float(request.form.get("min_conf", "0.6"))
+        min_conf = float(form.get("min_conf", "0.6"))
     except Exception:
         min_conf = 0.6
+    return required, min_conf
 
-    raw = file.read()
-    try:
-        Image.open(io.BytesIO(raw)).verify()
-    except Exception:
-        return jsonify({"ok": False, "error": "invalid image"}), 400
+def parse_precheck(form):
+    """Lee 'precheck' del form: '0' apaga el pre-chequeo de calidad."""
+    return form.get("precheck", "1") != "0"
 
-    data_url = to_data_url(raw)
+def parse_subject(form):
+    """Lee 'uid' del form: a quién se fotografió, para la clave del caché."""
+    return (form.get("uid") or "").strip() or None
 
+def build_messages(data_url, required, min_conf):
     # Mensaje de usuario con contexto de requisitos
     user_text = (
         "Analiza la imagen y devuelve SOLO la función report_epp.\n"
@@ -90,51 +608,356 @@ def analyze():
         "Si un requerido no está visible o su 'confidence' es menor a MIN_CONF, debe figurar en 'missing_required'.\n"
         "Incluye 'required_echo' con el eco exacto de la lista de requeridos."
     )
+    return [
+        {"role":"system","content": SYSTEM_PROMPT},
+        {"role":"user","content":[
+            {"type":"text","text": user_text},
+            {"type":"image_url","image_url":{"url": data_url}}
+        ]}
+    ]
+
+def parse_report_epp(chat):
+    """Valida la respuesta del modelo. Devuelve (result, None) o (None, error)."""
+    choice = chat.choices[0]
+    tool_calls = getattr(choice.message, "tool_calls", None)
+    if not tool_calls:
+        return None, "model did not call the tool"
 
+    call = tool_calls[0]
+    if call.function.name != "report_epp":
+        return None, f"unexpected tool {call.function.name}"
+
+    try:
+        result = json.loads(call.function.arguments or "{}")
+    except Exception as e:
+        return None, f"invalid tool args: {e}"
+
+    # Validaciones mínimas
+    for k in ["casco","chaleco","gafas","guantes","botas"]:
+        if k not in result:
+            return None, f"missing key '{k}'"
+        conf = result[k].get("confidence", None)
+        pres = result[k].get("present", None)
+        if not isinstance(pres, bool) or not isinstance(conf, (int,float)):
+            return None, f"bad type in '{k}'"
+
+    if "meets_requirements" not in result or "missing_required" not in result:
+        return None, "missing compliance fields"
+
+    return result, None
+
+def prepare_analysis(raw, required, min_conf, precheck=True, subject=None):
+    """Parte local (CPU) del análisis: decodificar, hash, pre-chequeo, caché y base64.
+    Devuelve ((payload, status), None) si ya hay respuesta, o (None, ctx) con lo
+    necesario para llamar al modelo. La comparten el modo Flask y el ASGI.
+    precheck=False saltea el pre-chequeo de calidad (p.ej. tras varios retakes);
+    subject (uid) habilita el caché por parecido dentro de la misma persona."""
     try:
-        chat = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role":"system","content": SYSTEM_PROMPT},
-                {"role":"user","content":[
-                    {"type":"text","text": user_text},
-                    {"type":"image_url","image_url":{"url": data_url}}
-                ]}
-            ],
-            tools=[REPORT_EPP_TOOL],
-            tool_choice={"type":"function","function":{"name":"report_epp"}}
-        )
-
-        choice = chat.choices[0]
-        tool_calls = getattr(choice.message, "tool_calls", None)
-        if not tool_calls:
-            return jsonify({"ok": False, "error": "model did not call the tool"}), 500
-
-        call = tool_calls[0]
-        if call.function.name != "report_epp":
-            return jsonify({"ok": False, "error": f"unexpected tool {call.function.name}"}), 500
+        with stage("preprocess"):
+            img, jpeg, prep = preprocess_image(raw)
+        with stage("phash"):
+            phash = dhash(img)
+    except Exception:
+        ERRORS.labels("invalid_image").inc()
+        return ({"ok": False, "error": "invalid image"}, 400), None
+    del raw
+
+    if precheck and quality_gate.enabled:
+        with stage("quality"):
+            reason, quality = quality_gate.check(img, prep["orig_size"])
+        if reason:
+            return ({"ok": True, "result": retake_result(reason, required), "retake": True,
+                     "quality": quality, "preprocess": prep}, 200), None
+    del img
+
+    with stage("cache_lookup"):
+        cached = result_cache.get(phash, required, min_conf, subject)
+    if cached is not None:
+        return ({"ok": True, "result": cached, "cached": True, "preprocess": prep}, 200), None
+
+    with stage("base64"):
+        data_url = to_data_url(jpeg)
+    request_kwargs = dict(
+        model="gpt-4o-mini",
+        messages=build_messages(data_url, required, min_conf),
+        tools=[REPORT_EPP_TOOL],
+        tool_choice={"type":"function","function":{"name":"report_epp"}}
+    )
+    return None, {"phash": phash, "prep": prep, "required": required, "min_conf": min_conf,
+                  "subject": subject, "request": request_kwargs}
+
+def finish_analysis(chat, ctx):
+    """Tokens, validación y caché de la respuesta del modelo → (payload, status)."""
+    usage = getattr(chat, "usage", None)
+    if usage is not None:
+        TOKENS.labels("prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+        TOKENS.labels("completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+    with stage("validate"):
+        result, err = parse_report_epp(chat)
+    if err:
+        ERRORS.labels("validation").inc()
+        return {"ok": False, "error": err}, 500
+    result_cache.put(ctx["phash"], ctx["required"], ctx["min_conf"], result, ctx["subject"])
+    return {"ok": True, "result": result, "preprocess": ctx["prep"]}, 200
+
+def upstream_failure(e):
+    if isinstance(e, UpstreamUnavailable):
+        ERRORS.labels("upstream_unavailable").inc()
+        return {"ok": False, "error": str(e)}, 503
+    ERRORS.labels(f"upstream_{type(e).__name__}").inc()
+    return {"ok": False, "error": str(e)}, 500
+
+def unhandled_failure(e):
+    ERRORS.labels(f"unhandled_{type(e).__name__}").inc()
+    return {"ok": False, "error": str(e)}, 500
+
+def run_analysis(raw, required, min_conf, precheck=True, subject=None):
+    """Pipeline completo de una imagen. Devuelve (payload JSON, status HTTP)."""
+    early, ctx = prepare_analysis(raw, required, min_conf, precheck, subject)
+    if early:
+        return early
+    try:
+        with stage("upstream"):
+            chat = upstream.create(**ctx["request"])
+        return finish_analysis(chat, ctx)
+    except Exception as e:
+        return upstream_failure(e)
+
+# ===== Motor de trabajos (análisis en segundo plano) =====
+# Un pool acotado procesa los análisis; /analyze espera a su trabajo y
+# /analyze/jobs devuelve el id enseguida. El estado vive en memoria del
+# proceso: correr gunicorn con 1 worker gthread (ver startup.sh).
+JOB_WORKERS    = int(os.getenv("ANALYZE_JOB_WORKERS", "4"))
+JOB_QUEUE_MAX  = int(os.getenv("ANALYZE_JOB_QUEUE_MAX", "64"))
+JOB_TTL_S      = float(os.getenv("ANALYZE_JOB_TTL_S", "300"))
+SYNC_TIMEOUT_S = float(os.getenv("ANALYZE_SYNC_TIMEOUT_S", "110"))
+LONGPOLL_MAX_S = 60.0
+SSE_HEARTBEAT_S = 15.0
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"          # queued -> running -> done
+        self.payload = None
+        self.http_status = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def finish(self, payload, http_status):
+        self.payload = payload
+        self.http_status = http_status
+        self.finished_at = time.time()
+        self.status = "done"
+        self.done.set()
+
+    def to_dict(self):
+        d = {"job_id": self.id, "status": self.status, "created_at": self.created_at}
+        if self.done.is_set():
+            d.update(finished_at=self.finished_at, http_status=self.http_status, response=self.payload)
+        return d
 
+class JobEngine:
+    def __init__(self, workers=JOB_WORKERS, queue_max=JOB_QUEUE_MAX, ttl_s=JOB_TTL_S):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.ttl_s = ttl_s
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="epp-job")
+        self._slots = threading.BoundedSemaphore(workers + queue_max)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, raw, required, min_conf, precheck=True, subject=None):
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+        job = Job()
+        with self._lock:
+            self._gc_locked()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, raw, required, min_conf, precheck, subject)
+        return job
+
+    def _run(self, job, raw, required, min_conf, precheck=True, subject=None):
+        STAGE_SECONDS.labels("queue_wait").observe(time.time() - job.created_at)
+        job.status = "running"
         try:
-            result = json.loads(call.function.arguments or "{}")
+            payload, code = run_analysis(raw, required, min_conf, precheck, subject)
         except Exception as e:
-            return jsonify({"ok": False, "error": f"invalid tool args: {e}"}), 500
+            payload, code = unhandled_failure(e)
+        finally:
+            self._slots.release()
+        job.finish(payload, code)
 
-        # Validaciones mínimas
-        for k in ["casco","chaleco","gafas","guantes","botas"]:
-            if k not in result:
-                return jsonify({"ok": False, "error": f"missing key '{k}'"}), 500
-            conf = result[k].get("confidence", None)
-            pres = result[k].get("present", None)
-            if not isinstance(pres, bool) or not isinstance(conf, (int,float)):
-                return jsonify({"ok": False, "error": f"bad type in '{k}'"}), 500
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
 
-        if "meets_requirements" not in result or "missing_required" not in result:
-            return jsonify({"ok": False, "error": "missing compliance fields"}), 500
+    def _gc_locked(self):
+        limit = time.time() - self.ttl_s
+        for jid in [jid for jid, j in self._jobs.items() if j.finished_at and j.finished_at < limit]:
+            del self._jobs[jid]
 
-        return jsonify({"ok": True, "result": result})
+    def stats(self):
+        with self._lock:
+            by_status = {}
+            for j in self._jobs.values():
+                by_status[j.status] = by_status.get(j.status, 0) + 1
+        return {"workers": self.workers, "queue_max": self.queue_max, "jobs": by_status}
 
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+jobs = JobEngine() if SYNC_MODE else None
+
+def parse_wait(args):
+    """Segundos de long-poll pedidos con ?wait=N, acotados a LONGPOLL_MAX_S."""
+    try:
+        return min(max(float(args.get("wait", "0")), 0.0), LONGPOLL_MAX_S)
+    except ValueError:
+        return 0.0
+
+def _submit_from_request():
+    """Crea un trabajo desde el request actual. Devuelve (job, None) o (None, respuesta de error)."""
+    file = request.files.get("image")
+    if not file:
+        return None, (jsonify({"ok": False, "error": "image file missing"}), 400)
+    required, min_conf = parse_requirements(request.form)
+    with stage("read"):
+        raw = file.read()
+    try:
+        return jobs.submit(raw, required, min_conf, parse_precheck(request.form),
+                           parse_subject(request.form)), None
+    except JobQueueFull:
+        ERRORS.labels("queue_full").inc()
+        return None, (jsonify({"ok": False, "error": "server busy, retry later"}), 503)
+
+@app.post("/analyze")
+def analyze():
+    job, err = _submit_from_request()
+    if err:
+        return err
+    if not job.done.wait(SYNC_TIMEOUT_S):
+        return jsonify({"ok": False, "error": "analysis timed out", "job_id": job.id}), 504
+    return jsonify(job.payload), job.http_status
+
+@app.post("/analyze/jobs")
+def analyze_job_create():
+    job, err = _submit_from_request()
+    if err:
+        return err
+    return jsonify({
+        "ok": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": url_for("analyze_job_get", job_id=job.id),
+        "events_url": url_for("analyze_job_events", job_id=job.id),
+    }), 202
+
+@app.get("/analyze/jobs/<job_id>")
+def analyze_job_get(job_id):
+    """Estado del trabajo. Con ?wait=N hace long-poll hasta N segundos."""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "job not found"}), 404
+    wait = parse_wait(request.args)
+    if wait:
+        job.done.wait(wait)
+    return jsonify({"ok": True, **job.to_dict()})
+
+@app.get("/analyze/jobs/<job_id>/events")
+def analyze_job_events(job_id):
+    """Server-Sent Events: un evento 'status' al conectar y 'result' al terminar."""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "job not found"}), 404
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def stream():
+        yield sse("status", {"job_id": job.id, "status": job.status})
+        while not job.done.wait(SSE_HEARTBEAT_S):
+            yield ": keepalive\n\n"
+        yield sse("result", job.to_dict())
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ===== Lote: varias imágenes en un solo request =====
+BATCH_CONCURRENCY = int(os.getenv("ANALYZE_BATCH_CONCURRENCY", "4"))
+BATCH_MAX_ITEMS   = int(os.getenv("ANALYZE_BATCH_MAX_ITEMS", "100"))
+
+def parse_batch(form, n_files):
+    """Valida el form de /analyze_batch para n_files imágenes. Devuelve
+    ((specs, precheck, concurrency), None) o (None, (payload, status));
+    specs trae (required, min_conf) por imagen, en orden."""
+    if not n_files:
+        return None, ({"ok": False, "error": "images missing"}, 400)
+    if n_files > BATCH_MAX_ITEMS:
+        return None, ({"ok": False, "error": f"too many images (max {BATCH_MAX_ITEMS})"}, 400)
+    try:
+        items = json.loads(form.get("items", "[]"))
+        if not isinstance(items, list): items = []
+    except Exception:
+        return None, ({"ok": False, "error": "invalid items json"}, 400)
+    default_required, default_min_conf = parse_requirements(form)
+    try:
+        concurrency = int(form.get("concurrency", BATCH_CONCURRENCY))
+    except ValueError:
+        concurrency = BATCH_CONCURRENCY
+    concurrency = max(1, min(concurrency, BATCH_CONCURRENCY, n_files))
+
+    specs = []
+    for i in range(n_files):
+        spec = items[i] if i < len(items) and isinstance(items[i], dict) else {}
+        if "required" in spec or "min_conf" in spec:
+            specs.append(parse_requirements({
+                "required": json.dumps(spec.get("required", default_required)),
+                "min_conf": spec.get("min_conf", default_min_conf),
+            }))
+        else:
+            specs.append((default_required, default_min_conf))
+    return (specs, parse_precheck(form), concurrency), None
+
+def batch_summary(filenames, outcomes, concurrency):
+    """Respuesta de /analyze_batch: un resultado (payload, status) por ítem, en orden."""
+    results = [{"filename": name, "status": code, "index": i, **payload}
+               for i, (name, (payload, code)) in enumerate(zip(filenames, outcomes))]
+    failed = sum(1 for r in results if not r.get("ok"))
+    return {"ok": True, "count": len(results), "failed": failed,
+            "concurrency": concurrency, "results": results}
+
+@app.post("/analyze_batch")
+def analyze_batch():
+    """Form multipart con N archivos 'images' y, opcional, 'items': lista JSON
+    (mismo orden) de {"required": [...], "min_conf": x}. Los 'required' y
+    'min_conf' del form son el default de cada ítem.
+    Devuelve un resultado por ítem, en orden; los errores no cortan el lote."""
+    files = request.files.getlist("images")
+    plan, err = parse_batch(request.form, len(files))
+    if err:
+        return jsonify(err[0]), err[1]
+    specs, precheck, concurrency = plan
+    raws = []
+    for f in files:
+        with stage("read"):
+            raws.append(f.read())
+
+    def one(i):
+        required, min_conf = specs[i]
+        try:
+            return run_analysis(raws[i], required, min_conf, precheck)
+        except Exception as e:
+            return unhandled_failure(e)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="epp-batch") as pool:
+        outcomes = list(pool.map(one, range(len(files))))
+    return jsonify(batch_summary([f.filename for f in files], outcomes, concurrency))
+
+@app.get("/analyze/cache")
+def analyze_cache_stats():
+    return jsonify({"ok": True, "cache": result_cache.stats(), "jobs": jobs.stats(),
+                    "upstream": upstream.stats(), "quality": quality_gate.stats()})
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
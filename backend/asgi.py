@@ -0,0 +1,400 @@
+"""
+Modo ASGI del backend: las mismas rutas y respuestas que app.py, atendidas
+por un event loop (Starlette sobre uvicorn). La llamada al modelo usa
+AsyncOpenAI (no ocupa un hilo mientras espera) y la decodificación/re-encodado
+de imágenes va a un pool de hilos para no bloquear el loop. Un proceso
+sostiene cientos de llamadas en vuelo; ASYNC_MAX_INFLIGHT acota cuántos
+análisis se admiten a la vez.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+    SERVE_MODE=asgi ./startup.sh
+
+El modo Flask (gunicorn app:app) sigue disponible y comparte con este el
+pipeline, el parseo de los forms y la política de reintentos de app.py.
+"""
+import asyncio, json, os, re, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import httpx
+from openai import AsyncOpenAI
+from prometheus_client import CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# app.py no arma sus clientes sync ni el motor de trabajos en este modo
+os.environ["SERVE_MODE"] = "asgi"
+import app as core
+from app import ERRORS, HTTP_SECONDS, STAGE_SECONDS, stage
+
+ASYNC_MAX_INFLIGHT      = int(os.getenv("ASYNC_MAX_INFLIGHT", "512"))     # análisis admitidos a la vez
+ASYNC_UPSTREAM_MAX_CONN = int(os.getenv("ASYNC_UPSTREAM_MAX_CONNECTIONS", "256"))
+ASYNC_IMAGE_WORKERS     = int(os.getenv("ASYNC_IMAGE_WORKERS", str(os.cpu_count() or 4)))
+MAX_UPLOAD_BYTES        = int(float(os.getenv("ANALYZE_MAX_UPLOAD_MB", "16")) * 1024 * 1024)
+
+image_pool = ThreadPoolExecutor(max_workers=ASYNC_IMAGE_WORKERS, thread_name_prefix="epp-img")
+
+# ===== Llamada resiliente al modelo (async) =====
+async_http = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=ASYNC_UPSTREAM_MAX_CONN,
+                        max_keepalive_connections=ASYNC_UPSTREAM_MAX_CONN,
+                        keepalive_expiry=core.UPSTREAM_KEEPALIVE_S),
+    timeout=httpx.Timeout(core.UPSTREAM_ATTEMPT_S, connect=core.UPSTREAM_CONNECT_S),
+)
+aclient = AsyncOpenAI(api_key=core.api_key, base_url=core.OPENAI_BASE_URL, max_retries=0,
+                      timeout=httpx.Timeout(core.UPSTREAM_ATTEMPT_S, connect=core.UPSTREAM_CONNECT_S),
+                      http_client=async_http)
+
+class AsyncResilientCaller(core.UpstreamPolicy):
+    """ResilientCaller con AsyncOpenAI: misma política (core.UpstreamPolicy).
+    Los intentos esperan turno en un semáforo en vez de en el pool de httpx,
+    así la espera no cuenta como timeout."""
+
+    def __init__(self, client, max_conn=ASYNC_UPSTREAM_MAX_CONN, **kw):
+        super().__init__(client, **kw)
+        self._conn = asyncio.Semaphore(max_conn)
+
+    async def _attempt(self, timeout_s, kwargs):
+        async with self._conn:
+            self._count("attempts")
+            t0 = time.monotonic()
+            resp = await self.client.with_options(timeout=timeout_s).chat.completions.create(**kwargs)
+            self.latency.add(time.monotonic() - t0)
+            return resp
+
+    async def _attempt_hedged(self, timeout_s, kwargs):
+        first = asyncio.ensure_future(self._attempt(timeout_s, kwargs))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay())
+        if done:
+            return first.result()
+        self._count("hedges")
+        second = asyncio.ensure_future(self._attempt(timeout_s, kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for f in done:
+                    if f.exception() is None:
+                        if f is second:
+                            self._count("hedge_wins")
+                        return f.result()
+                    error = f.exception()
+            raise error
+        finally:
+            for f in pending:   # el intento perdedor no sigue ocupando conexión
+                f.cancel()
+
+    async def create(self, **kwargs):
+        deadline = self._start()
+        attempt = 0
+        while True:
+            timeout_s = self._admit(deadline)
+            try:
+                if self.hedge:
+                    resp = await self._attempt_hedged(timeout_s, kwargs)
+                else:
+                    resp = await self._attempt(timeout_s, kwargs)
+            except Exception as ex:
+                delay = self._retry_delay(ex, attempt, deadline)
+            except BaseException:   # cancelado: el intento de prueba queda sin veredicto
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return resp
+            attempt += 1
+            await asyncio.sleep(delay)
+
+upstream = AsyncResilientCaller(aclient)
+
+async def run_analysis(raw, required, min_conf, precheck=True, subject=None):
+    """Como app.run_analysis: la parte de CPU en image_pool, el modelo en el loop."""
+    loop = asyncio.get_running_loop()
+    early, ctx = await loop.run_in_executor(image_pool, core.prepare_analysis,
+                                           raw, required, min_conf, precheck, subject)
+    del raw
+    if early:
+        return early
+    try:
+        with stage("upstream"):
+            chat = await upstream.create(**ctx["request"])
+        return core.finish_analysis(chat, ctx)
+    except Exception as e:
+        return core.upstream_failure(e)
+
+# ===== Admisión y trabajos =====
+class Admission:
+    """Cupo de análisis en curso (requests, trabajos e ítems de lote). Todo
+    corre en el hilo del loop, así que no hace falta lock."""
+
+    def __init__(self, limit=ASYNC_MAX_INFLIGHT):
+        self.limit = limit
+        self.inflight = 0
+        self.rejected = 0
+
+    def try_acquire(self, n=1):
+        if self.inflight + n > self.limit:
+            self.rejected += 1
+            return False
+        self.inflight += n
+        return True
+
+    def release(self, n=1):
+        self.inflight -= n
+
+admission = Admission()
+
+class AsyncJob(core.Job):
+    def __init__(self):
+        super().__init__()
+        self.finished = asyncio.Event()   # para esperar sin ocupar un hilo
+
+    def finish(self, payload, http_status):
+        super().finish(payload, http_status)
+        self.finished.set()
+
+class AsyncJobEngine:
+    """Como JobEngine, pero cada trabajo es una tarea del loop."""
+
+    def __init__(self, admission, ttl_s=core.JOB_TTL_S):
+        self.admission = admission
+        self.ttl_s = ttl_s
+        self._jobs = {}
+        self._tasks = set()
+
+    def submit(self, raw, required, min_conf, precheck=True, subject=None):
+        if not self.admission.try_acquire():
+            raise core.JobQueueFull()
+        job = AsyncJob()
+        self._gc()
+        self._jobs[job.id] = job
+        task = asyncio.create_task(self._run(job, raw, required, min_conf, precheck, subject))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job, raw, required, min_conf, precheck, subject):
+        STAGE_SECONDS.labels("queue_wait").observe(time.time() - job.created_at)
+        job.status = "running"
+        try:
+            payload, code = await run_analysis(raw, required, min_conf, precheck, subject)
+        except Exception as e:
+            payload, code = core.unhandled_failure(e)
+        finally:
+            self.admission.release()
+        job.finish(payload, code)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _gc(self):
+        limit = time.time() - self.ttl_s
+        for jid in [jid for jid, j in self._jobs.items() if j.finished_at and j.finished_at < limit]:
+            del self._jobs[jid]
+
+    def stats(self):
+        by_status = {}
+        for j in self._jobs.values():
+            by_status[j.status] = by_status.get(j.status, 0) + 1
+        return {"workers": ASYNC_IMAGE_WORKERS, "queue_max": self.admission.limit,
+                "inflight": self.admission.inflight, "rejected": self.admission.rejected, "jobs": by_status}
+
+jobs = AsyncJobEngine(admission)
+
+# ===== HTTP (Starlette) =====
+class JSON(JSONResponse):
+    def render(self, content):
+        # mismo formato que jsonify de Flask fuera de debug
+        return (json.dumps(content, ensure_ascii=True, sort_keys=True, separators=(",", ":")) + "\n").encode()
+
+class RequestTooLarge(Exception):
+    pass
+
+class UploadLimit:
+    """Corta con 413 los cuerpos de más de MAX_UPLOAD_BYTES, traigan o no Content-Length."""
+
+    def __init__(self, app, limit=MAX_UPLOAD_BYTES):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        size = 0
+
+        async def limited_receive():
+            nonlocal size
+            msg = await receive()
+            size += len(msg.get("body", b""))
+            if size > self.limit:
+                raise RequestTooLarge()
+            return msg
+
+        await self.app(scope, limited_receive, send)
+
+def busy():
+    ERRORS.labels("queue_full").inc()
+    return JSON({"ok": False, "error": "server busy, retry later"}, 503)
+
+async def _submit_from_request(request):
+    async with request.form() as form:
+        file = form.get("image")
+        if not isinstance(file, UploadFile):
+            return None, JSON({"ok": False, "error": "image file missing"}, 400)
+        required, min_conf = core.parse_requirements(form)
+        precheck = core.parse_precheck(form)
+        subject = core.parse_subject(form)
+        with stage("read"):
+            raw = await file.read()
+    try:
+        return jobs.submit(raw, required, min_conf, precheck, subject), None
+    except core.JobQueueFull:
+        return None, busy()
+
+async def analyze(request):
+    job, err = await _submit_from_request(request)
+    if err:
+        return err
+    try:
+        await asyncio.wait_for(job.finished.wait(), core.SYNC_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        return JSON({"ok": False, "error": "analysis timed out", "job_id": job.id}, 504)
+    return JSON(job.payload, job.http_status)
+
+async def analyze_job_create(request):
+    job, err = await _submit_from_request(request)
+    if err:
+        return err
+    root = request.scope.get("root_path", "")
+    return JSON({
+        "ok": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": root + request.app.url_path_for("analyze_job_get", job_id=job.id),
+        "events_url": root + request.app.url_path_for("analyze_job_events", job_id=job.id),
+    }, 202)
+
+async def analyze_job_get(request):
+    """Estado del trabajo. Con ?wait=N hace long-poll hasta N segundos."""
+    job = jobs.get(request.path_params["job_id"])
+    if not job:
+        return JSON({"ok": False, "error": "job not found"}, 404)
+    wait = core.parse_wait(request.query_params)
+    if wait:
+        try:
+            await asyncio.wait_for(job.finished.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+    return JSON({"ok": True, **job.to_dict()})
+
+async def analyze_job_events(request):
+    """Server-Sent Events: un evento 'status' al conectar y 'result' al terminar."""
+    job = jobs.get(request.path_params["job_id"])
+    if not job:
+        return JSON({"ok": False, "error": "job not found"}, 404)
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def stream():
+        yield sse("status", {"job_id": job.id, "status": job.status})
+        while True:
+            try:
+                await asyncio.wait_for(job.finished.wait(), core.SSE_HEARTBEAT_S)
+                break
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+        yield sse("result", job.to_dict())
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def analyze_batch(request):
+    """Mismo contrato que /analyze_batch de app.py; los ítems ocupan cupo de admisión."""
+    async with request.form() as form:
+        files = [f for f in form.getlist("images") if isinstance(f, UploadFile)]
+        plan, err = core.parse_batch(form, len(files))
+        if err:
+            return JSON(*err)
+        specs, precheck, concurrency = plan
+        raws = []
+        for f in files:
+            with stage("read"):
+                raws.append(await f.read())
+    if not admission.try_acquire(len(files)):
+        return busy()
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(raw, spec):
+        required, min_conf = spec
+        async with sem:
+            try:
+                return await run_analysis(raw, required, min_conf, precheck)
+            except Exception as e:
+                return core.unhandled_failure(e)
+
+    try:
+        outcomes = await asyncio.gather(*(one(raw, spec) for raw, spec in zip(raws, specs)))
+    finally:
+        admission.release(len(files))
+    return JSON(core.batch_summary([f.filename for f in files], outcomes, concurrency))
+
+async def analyze_cache_stats(request):
+    return JSON({"ok": True, "cache": core.result_cache.stats(), "jobs": jobs.stats(),
+                 "upstream": upstream.stats(), "quality": core.quality_gate.stats()})
+
+async def metrics(request):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+def route(path, endpoint, method):
+    """Route que observa HTTP_SECONDS con la misma etiqueta de ruta que Flask."""
+    rule = re.sub(r"\{(\w+)\}", r"<\1>", path)
+
+    async def timed(request):
+        t0 = time.perf_counter()
+        resp = await endpoint(request)
+        HTTP_SECONDS.labels(rule, request.method, str(resp.status_code)).observe(time.perf_counter() - t0)
+        return resp
+
+    return Route(path, timed, methods=[method], name=endpoint.__name__)
+
+async def too_large(request, exc):
+    return JSON({"ok": False, "error": "request too large"}, 413)
+
+async def server_error(request, exc):
+    return JSON(*core.unhandled_failure(exc))
+
+@asynccontextmanager
+async def lifespan(_app):
+    yield
+    await async_http.aclose()
+    image_pool.shutdown(wait=False)
+
+# flask_cors en app.py deja pasar cualquier origen; acá lo mismo
+app = Starlette(
+    routes=[
+        route("/analyze", analyze, "POST"),
+        route("/analyze/jobs", analyze_job_create, "POST"),
+        route("/analyze/cache", analyze_cache_stats, "GET"),
+        route("/analyze/jobs/{job_id}", analyze_job_get, "GET"),
+        route("/analyze/jobs/{job_id}/events", analyze_job_events, "GET"),
+        route("/analyze_batch", analyze_batch, "POST"),
+        route("/metrics", metrics, "GET"),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+        Middleware(UploadLimit),
+    ],
+    exception_handlers={RequestTooLarge: too_large, Exception: server_error},
+    lifespan=lifespan,
+)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark de /analyze a tasa fija (lazo abierto): para cada tasa manda
+requests cada 1/rate segundos durante --duration, sin esperar respuestas,
+y reporta p50/p95/p99, throughput, errores, aciertos de cache y RSS de los workers.
+
+Pensado para correr contra el backend apuntado a mock_openai.py, con la cache
+de resultados apagada (las pocas fotos de muestra se repiten y, con la cache
+prendida, casi todo se resolvería sin llegar al modelo):
+
+    python mock_openai.py --latency-ms 800 --latency-sigma 0.4 &
+    ANALYZE_CACHE_MAX_ITEMS=0 OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=mock ./startup.sh &
+    python bench.py --url http://127.0.0.1:8000/analyze --rates 1,5,10 --duration 20 --out bench.json
+"""
+import argparse, json, os, random, threading, time
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_IMAGES = Path(__file__).resolve().parent.parent / "frontend" / "data" / "images"
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = (len(sorted_vals) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+def load_images(folder):
+    imgs = [p.read_bytes() for p in sorted(Path(folder).glob("*.jpg"))]
+    if not imgs:
+        raise SystemExit(f"No hay .jpg en {folder}")
+    return imgs
+
+def worker_pids(match):
+    """PIDs cuyo cmdline contiene 'match' (p.ej. 'app:app' para gunicorn)."""
+    pids = []
+    for d in Path("/proc").iterdir():
+        if not d.name.isdigit() or int(d.name) == os.getpid():
+            continue
+        try:
+            argv = (d / "cmdline").read_bytes().decode(errors="ignore").split("\0")
+        except OSError:
+            continue
+        exe = os.path.basename(argv[0])
+        if ("python" in exe or "gunicorn" in exe) and match in " ".join(argv):
+            pids.append(int(d.name))
+    return pids
+
+def rss_kb(pid):
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+class RssSampler(threading.Thread):
+    def __init__(self, match, every_s=0.5):
+        super().__init__(daemon=True)
+        self.match, self.every_s = match, every_s
+        self.peak = {}
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.is_set():
+            for pid in worker_pids(self.match):
+                kb = rss_kb(pid)
+                if kb is not None and kb > self.peak.get(pid, 0):
+                    self.peak[pid] = kb
+            self._halt.wait(self.every_s)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+def run_rate(client, url, images, rate, duration, required, min_conf, match, timeout):
+    n = max(1, int(rate * duration))
+    lat, codes, lock = [], {}, threading.Lock()
+    hits = 0
+
+    def one(i):
+        nonlocal hits
+        img = random.choice(images)
+        t0 = time.perf_counter()
+        try:
+            r = client.post(url, files={"image": (f"bench_{i}.jpg", img, "image/jpeg")},
+                            data={"required": json.dumps(required), "min_conf": str(min_conf)},
+                            timeout=timeout)
+            code = r.status_code
+            cached = code == 200 and bool(r.json().get("cached"))
+        except Exception as ex:
+            code = type(ex).__name__
+        dt = time.perf_counter() - t0
+        with lock:
+            codes[str(code)] = codes.get(str(code), 0) + 1
+            if code == 200:
+                lat.append(dt)
+                hits += cached
+
+    sampler = RssSampler(match) if match else None
+    if sampler: sampler.start()
+    threads = []
+    t_start = time.perf_counter()
+    for i in range(n):
+        # lazo abierto: respetamos el reloj aunque el servidor se atrase
+        delay = t_start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        t = threading.Thread(target=one, args=(i,), daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+    if sampler: sampler.stop()
+
+    lat.sort()
+    return {
+        "rate_rps": rate,
+        "sent": n,
+        "ok": len(lat),
+        "status_codes": codes,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(lat) / wall, 3) if wall else 0,
+        "cache_hits": hits,
+        "cache_hit_ratio": round(hits / len(lat), 3) if lat else None,
+        "latency_ms": {
+            "p50": round(percentile(lat, 50) * 1000, 1) if lat else None,
+            "p95": round(percentile(lat, 95) * 1000, 1) if lat else None,
+            "p99": round(percentile(lat, 99) * 1000, 1) if lat else None,
+            "max": round(lat[-1] * 1000, 1) if lat else None,
+        },
+        "rss_peak_kb_per_worker": ({str(k): v for k, v in sampler.peak.items()} if sampler else {}),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de throughput/latencia para /analyze")
+    ap.add_argument("--url", default="http://127.0.0.1:8000/analyze")
+    ap.add_argument("--images", default=str(DEFAULT_IMAGES))
+    ap.add_argument("--rates", default="1,2,5", help="tasas en req/s separadas por coma")
+    ap.add_argument("--duration", type=float, default=15.0, help="segundos por tasa")
+    ap.add_argument("--required", default='["casco","gafas"]')
+    ap.add_argument("--min-conf", type=float, default=0.6)
+    ap.add_argument("--proc-match", default="app:app", help="texto del cmdline de los workers para medir RSS ('' desactiva)")
+    ap.add_argument("--timeout", type=float, default=130.0)
+    ap.add_argument("--out", help="archivo JSON de salida (además de stdout)")
+    a = ap.parse_args()
+
+    images = load_images(a.images)
+    required = json.loads(a.required)
+    runs = []
+    with requests.Session() as client:
+        client.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=200))
+        client.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=200))
+        for rate in [float(x) for x in a.rates.split(",") if x.strip()]:
+            res = run_rate(client, a.url, images, rate, a.duration, required, a.min_conf,
+                           a.proc_match, a.timeout)
+            runs.append(res)
+            print(json.dumps(res), flush=True)
+            if res["cache_hits"]:
+                print(f"aviso: {res['cache_hits']} respuestas salieron de la cache; para medir el "
+                      "camino al modelo levantar el backend con ANALYZE_CACHE_MAX_ITEMS=0", flush=True)
+
+    report = {"url": a.url, "duration_s": a.duration, "images": len(images),
+              "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": runs}
+    if a.out:
+        Path(a.out).write_text(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Servidor local que imita POST /v1/chat/completions de OpenAI y siempre
+responde una llamada válida a report_epp. Sirve para cargar /analyze sin
+gastar tokens ni depender de la red.
+
+    python mock_openai.py --port 9000 --latency-ms 800 --latency-sigma 0.4 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=mock ./startup.sh
+"""
+import argparse, ast, json, random, re, time, uuid
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+CFG = {
+    "latency_ms": 800.0,      # mediana
+    "latency_sigma": 0.0,     # sigma lognormal (0 = latencia fija)
+    "error_rate": 0.0,        # probabilidad de responder error
+    "error_codes": [500, 503, 429],
+    "present_prob": 0.8,      # probabilidad de que cada EPP figure presente
+}
+
+EPP_KEYS = ["casco", "chaleco", "gafas", "guantes", "botas"]
+_REQ_RE  = re.compile(r"Required items:\s*(\[.*?\])")
+_CONF_RE = re.compile(r"MIN_CONF:\s*([0-9.]+)")
+
+def _sample_latency_s():
+    med = CFG["latency_ms"] / 1000.0
+    if CFG["latency_sigma"] <= 0:
+        return med
+    return random.lognormvariate(0, CFG["latency_sigma"]) * med
+
+def _user_text(messages):
+    for m in messages or []:
+        if m.get("role") != "user":
+            continue
+        content = m.get("content")
+        if isinstance(content, str):
+            return content
+        for part in content or []:
+            if part.get("type") == "text":
+                return part.get("text", "")
+    return ""
+
+def _fake_report(required, min_conf):
+    r = {}
+    for k in EPP_KEYS:
+        present = random.random() < CFG["present_prob"]
+        conf = round(random.uniform(0.7, 0.99) if present else random.uniform(0.05, 0.5), 2)
+        r[k] = {"present": present, "confidence": conf}
+    missing = [k for k in required
+               if not (k in r and r[k]["present"] and r[k]["confidence"] >= min_conf)]
+    r.update({
+        "comentarios": "respuesta simulada",
+        "photo_quality": "ok",
+        "required_echo": list(required),
+        "meets_requirements": not missing,
+        "missing_required": missing,
+    })
+    return r
+
+@app.post("/v1/chat/completions")
+def chat_completions():
+    body = request.get_json(silent=True) or {}
+    time.sleep(_sample_latency_s())
+
+    if random.random() < CFG["error_rate"]:
+        code = random.choice(CFG["error_codes"])
+        return jsonify({"error": {"message": f"mock error {code}", "type": "server_error", "code": None}}), code
+
+    text = _user_text(body.get("messages"))
+    try:
+        required = ast.literal_eval(_REQ_RE.search(text).group(1))
+    except Exception:
+        required = []
+    try:
+        min_conf = float(_CONF_RE.search(text).group(1))
+    except Exception:
+        min_conf = 0.6
+
+    args = json.dumps(_fake_report(required, min_conf), ensure_ascii=False)
+    return jsonify({
+        "id": f"chatcmpl-mock-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": "report_epp", "arguments": args},
+                }],
+            },
+            "finish_reason": "tool_calls",
+        }],
+        "usage": {"prompt_tokens": 850, "completion_tokens": 120, "total_tokens": 970},
+    })
+
+def main():
+    ap = argparse.ArgumentParser(description="Mock de chat.completions que devuelve report_epp")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9000)
+    ap.add_argument("--latency-ms", type=float, default=CFG["latency_ms"], help="latencia mediana")
+    ap.add_argument("--latency-sigma", type=float, default=CFG["latency_sigma"], help="sigma lognormal; 0 = fija")
+    ap.add_argument("--error-rate", type=float, default=CFG["error_rate"])
+    ap.add_argument("--error-codes", default=",".join(map(str, CFG["error_codes"])))
+    ap.add_argument("--present-prob", type=float, default=CFG["present_prob"])
+    a = ap.parse_args()
+    CFG.update(latency_ms=a.latency_ms, latency_sigma=a.latency_sigma, error_rate=a.error_rate,
+               error_codes=[int(x) for x in a.error_codes.split(",") if x.strip()],
+               present_prob=a.present_prob)
+    app.run(host=a.host, port=a.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,14 @@
 #!/usr/bin/env bash
-gunicorn --bind=0.0.0.0:${PORT:-8000} --workers=2 --timeout=120 app:app
+# 1 proceso: el motor de trabajos (/analyze/jobs) guarda el estado en memoria.
+# SERVE_MODE=sync (default): gunicorn gthread; las conexiones SSE/long-poll no
+#   deben ocupar un worker sync entero.
+# SERVE_MODE=asgi: uvicorn con asgi.py; las llamadas al modelo son async y un
+#   solo proceso sostiene cientos en vuelo (ASYNC_MAX_INFLIGHT).
+# Métricas multiproceso: los workers comparten PROMETHEUS_MULTIPROC_DIR (se limpia al arrancar).
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/epp-backend-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+if [ "${SERVE_MODE:-sync}" = "asgi" ]; then
+  uvicorn asgi:app --host 0.0.0.0 --port ${PORT:-8000} --workers ${WEB_WORKERS:-1} --timeout-keep-alive 75 --no-access-log
+else
+  gunicorn --bind=0.0.0.0:${PORT:-8000} --workers=${WEB_WORKERS:-1} --worker-class=gthread --threads=${WEB_THREADS:-32} --timeout=120 app:app
+fi
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Benchmark del hub contra una instancia corriendo (idealmente sobre datos de
+gen_data.py). Mide, en este orden:
+
+  - latencia de GET / (dashboard, con y sin filtro) y GET /empleados (lista, búsqueda, filtro)
+  - QPS de POST /should_rewrite con N clientes concurrentes (lazo cerrado)
+  - throughput y latencia de POST /ingreso con N clientes concurrentes
+
+y escribe un JSON con el commit actual para comparar corridas entre commits.
+
+    python gen_data.py --data-dir /tmp/hubbench --reset --employees 5000 --days 365
+    HUB_DATA_DIR=/tmp/hubbench HC_SYNC_INTERVAL_S=0 gunicorn -w 4 -b 127.0.0.1:8090 pc_hub:app &
+    python bench_hub.py --url http://127.0.0.1:8090 --concurrency 1,8,32 --procs 4 --out bench_hub.json
+
+--data-dir permite agregar al reporte el volumen de la base. Las fichadas
+que crea /ingreso quedan en esa base (conviene regenerarla entre corridas).
+"""
+import argparse, io, json, multiprocessing, random, sqlite3, subprocess, sys, threading, time
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = (len(sorted_vals) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+def summarize(lat):
+    lat = sorted(lat)
+    ms = lambda p: round(percentile(lat, p) * 1000, 2) if lat else None
+    return {"p50": ms(50), "p95": ms(95), "p99": ms(99), "max": round(lat[-1] * 1000, 2) if lat else None}
+
+def git_commit():
+    try:
+        here = Path(__file__).resolve().parent
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True,
+                             text=True, timeout=5).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                               capture_output=True, text=True, timeout=5).stdout.strip()
+        return sha + ("-dirty" if dirty else "") if sha else None
+    except Exception:
+        return None
+
+def db_stats(data_dir):
+    path = Path(data_dir) / "hub.db"
+    if not path.exists():
+        return None
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        out = {t: con.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+               for t in ("employees", "records", "images", "hc_accounts", "sleep_days")}
+        out["db_mb"] = round(path.stat().st_size / 1e6, 1)
+        return out
+    finally:
+        con.close()
+
+def new_session(pool):
+    s = requests.Session()
+    s.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool))
+    s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool))
+    return s
+
+def fetch_roster(client, base):
+    r = client.get(f"{base}/api/employees/delta", params={"since": 0}, timeout=60)
+    r.raise_for_status()
+    return r.json()["employees"]
+
+def latency_run(client, url, params, samples, warmup, timeout):
+    for _ in range(warmup):
+        client.get(url, params=params, timeout=timeout)
+    lat, codes, nbytes = [], {}, 0
+    for _ in range(samples):
+        t0 = time.perf_counter()
+        try:
+            r = client.get(url, params=params, timeout=timeout)
+            code, nbytes = r.status_code, len(r.content)
+        except Exception as ex:
+            code = type(ex).__name__
+        dt = time.perf_counter() - t0
+        codes[str(code)] = codes.get(str(code), 0) + 1
+        if code == 200:
+            lat.append(dt)
+    return {"url": url, "params": params, "samples": samples, "status_codes": codes,
+            "bytes": nbytes, "latency_ms": summarize(lat)}
+
+_TASK = None   # make_request(client, rnd) de la fase actual; los hijos lo heredan al hacer fork
+
+def _loop_slice(args):
+    """Lazo cerrado de un proceso: N hilos mandan requests uno tras otro durante 'duration' s."""
+    concurrency, duration, seed = args
+    client = new_session(concurrency + 4)
+    lat, codes, lock = [], {}, threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def worker(i):
+        rnd = random.Random(seed + i)
+        my_lat, my_codes = [], {}
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                code = _TASK(client, rnd)
+            except Exception as ex:
+                code = type(ex).__name__
+            dt = time.perf_counter() - t0
+            my_codes[str(code)] = my_codes.get(str(code), 0) + 1
+            if code == 200:
+                my_lat.append(dt)
+        with lock:
+            lat.extend(my_lat)
+            for k, v in my_codes.items():
+                codes[k] = codes.get(k, 0) + v
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    client.close()
+    return lat, codes, time.perf_counter() - t_start
+
+def closed_loop(make_request, concurrency, duration, procs=1):
+    """Reparte 'concurrency' clientes en 'procs' procesos (un solo proceso de
+    Python satura su GIL bastante antes que el hub en requests cortos)."""
+    global _TASK
+    _TASK = make_request
+    procs = max(1, min(procs, concurrency))
+    slices = [(concurrency // procs + (i < concurrency % procs), duration, i * 10000) for i in range(procs)]
+    if procs == 1:
+        results = [_loop_slice(slices[0])]
+    else:
+        with multiprocessing.get_context("fork").Pool(procs) as pool:
+            results = pool.map(_loop_slice, slices)
+    lat, codes = [], {}
+    for l, c, _ in results:
+        lat += l
+        for k, v in c.items():
+            codes[k] = codes.get(k, 0) + v
+    wall = max(w for _, _, w in results)
+    return {"concurrency": concurrency, "procs": procs, "ok": len(lat), "status_codes": codes,
+            "wall_s": round(wall, 3), "throughput_rps": round(len(lat) / wall, 1) if wall else 0,
+            "latency_ms": summarize(lat)}
+
+def synth_jpeg(rnd, size=(640, 480)):
+    """JPEG de cámara simulado: ruido suave para que decodificar, achicar y
+    recomprimir la miniatura cueste como con una foto real."""
+    img = PILImage.effect_noise(size, 40).convert("RGB")
+    img = PILImage.blend(img, PILImage.new("RGB", size, tuple(rnd.randrange(256) for _ in range(3))), 0.5)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def load_images(folder, n=20):
+    imgs = [p.read_bytes() for p in sorted(Path(folder).rglob("*.jpg"))[:n]] if folder else []
+    if imgs:
+        return imgs
+    rnd = random.Random(0)
+    if PILImage is not None:
+        return [synth_jpeg(rnd) for _ in range(n)]
+    # sin Pillow: el hub no puede hacer la miniatura y cada /ingreso cuenta un error thumb_*
+    print("AVISO: sin Pillow ni --images, /ingreso recibe bytes al azar; no mide la miniatura",
+          file=sys.stderr, flush=True)
+    return [b"\xff\xd8\xff\xe0" + rnd.randbytes(30000) + b"\xff\xd9" for _ in range(n)]
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de /ingreso, dashboard, /empleados y /should_rewrite")
+    ap.add_argument("--url", default="http://127.0.0.1:8090", help="URL base del hub")
+    ap.add_argument("--concurrency", default="1,8,32", help="clientes concurrentes separados por coma")
+    ap.add_argument("--duration", type=float, default=10.0, help="segundos por nivel de concurrencia")
+    ap.add_argument("--procs", type=int, default=1, help="procesos cliente entre los que se reparten los clientes")
+    ap.add_argument("--samples", type=int, default=30, help="requests por página en las mediciones de latencia")
+    ap.add_argument("--warmup", type=int, default=3)
+    ap.add_argument("--images", default=None, help="carpeta con .jpg para /ingreso (default: JPEGs sintéticos)")
+    ap.add_argument("--unique-images", action="store_true",
+                    help="foto distinta en cada /ingreso (sin deduplicar en el almacén)")
+    ap.add_argument("--skip", default="", help="fases a omitir: pages,should_rewrite,ingreso")
+    ap.add_argument("--data-dir", default=None, help="HUB_DATA_DIR del hub medido, para el volumen de datos")
+    ap.add_argument("--label", default="", help="texto libre guardado en el reporte")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--out", help="archivo JSON de salida (además de stdout)")
+    a = ap.parse_args()
+
+    base = a.url.rstrip("/")
+    levels = [int(x) for x in a.concurrency.split(",") if x.strip()]
+    skip = {x.strip() for x in a.skip.split(",") if x.strip()}
+    client = new_session(4)
+    roster = fetch_roster(client, base)
+    uids = list(roster) or ["BENCH0001"]
+    report = {"url": base, "commit": git_commit(), "label": a.label,
+              "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "duration_s": a.duration, "procs": a.procs,
+              "data": db_stats(a.data_dir) if a.data_dir else None, "roster": len(roster)}
+
+    if "pages" not in skip:
+        uid = random.Random(1).choice(uids)
+        name = (roster.get(uid, {}).get("n") or "a").split()[0][:3]
+        pages = [("dashboard", "/", {}), ("dashboard_uid", "/", {"uid": uid}),
+                 ("dashboard_pasa0", "/", {"pasa": "0"}), ("empleados", "/empleados", {}),
+                 ("empleados_q", "/empleados", {"q": name}), ("empleados_rewrite", "/empleados", {"rewrite": "1"})]
+        report["pages"] = {}
+        for name, path, params in pages:
+            res = latency_run(client, base + path, params, a.samples, a.warmup, a.timeout)
+            report["pages"][name] = res
+            print(json.dumps({name: res}), flush=True)
+
+    if "should_rewrite" not in skip:
+        def should_rewrite(client, rnd):
+            return client.post(f"{base}/should_rewrite", data={"uid": rnd.choice(uids)}, timeout=a.timeout).status_code
+        report["should_rewrite"] = []
+        for c in levels:
+            res = closed_loop(should_rewrite, c, a.duration, a.procs)
+            report["should_rewrite"].append(res)
+            print(json.dumps({"should_rewrite": res}), flush=True)
+
+    if "ingreso" not in skip:
+        images = load_images(a.images)
+        api_result = json.dumps({"ok": True, "result": {
+            "casco": {"present": True, "confidence": 0.91}, "gafas": {"present": True, "confidence": 0.84},
+            "guantes": {"present": False, "confidence": 0.2}, "photo_quality": "ok"}})
+
+        def ingreso(client, rnd):
+            img = rnd.choice(images)
+            if a.unique_images:
+                img = img[:-2] + rnd.randbytes(16) + img[-2:]
+            uid = rnd.choice(uids)
+            e = roster.get(uid) or {}
+            r = client.post(f"{base}/ingreso", timeout=a.timeout,
+                            files={"image": ("bench.jpg", img, "image/jpeg")},
+                            data={"uid": uid, "nombre_tag": e.get("n", ""),
+                                  "epp_tag": json.dumps(e.get("e", [])), "api_result": api_result})
+            return r.status_code
+        report["ingreso"] = []
+        for c in levels:
+            res = closed_loop(ingreso, c, a.duration, a.procs)
+            report["ingreso"].append(res)
+            print(json.dumps({"ingreso": res}), flush=True)
+
+    client.close()
+    if a.out:
+        Path(a.out).write_text(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
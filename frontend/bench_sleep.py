@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la agregación de sueño que corre en cada sincronización: bucle
+original (_accumulate_stage_minutes_per_day) contra la versión NumPy
+(accumulate_stages_per_day). Antes de medir verifica que den exactamente lo
+mismo, incluyendo noches que cruzan el cambio de hora (DST) y timestamps raros.
+
+    python bench_sleep.py --employees 200 --days 90 --out bench_sleep.json
+"""
+import argparse, atexit, json, os, random, shutil, sys, tempfile, time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+# pc_hub migra la base de HUB_DATA_DIR al importarse: una descartable, no frontend/data
+os.environ["HUB_DATA_DIR"] = tempfile.mkdtemp(prefix="bench_sleep_")
+atexit.register(shutil.rmtree, os.environ["HUB_DATA_DIR"], ignore_errors=True)
+os.environ["HC_SYNC_INTERVAL_S"] = "0"
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import pc_hub as hub
+
+UTC_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+def synth_sessions(n_employees, days, seed=1, start=datetime(2025, 1, 1, tzinfo=timezone.utc)):
+    rnd = random.Random(seed)
+    sessions = []
+    for emp in range(n_employees):
+        for d in range(days):
+            s = start + timedelta(days=d, hours=1, minutes=rnd.randint(0, 180), seconds=rnd.randint(0, 59))
+            end = s + timedelta(minutes=rnd.randint(240, 600))
+            stages, cur = [], s
+            while cur < end:
+                seg = min(end, cur + timedelta(minutes=rnd.randint(3, 50), seconds=rnd.randint(0, 59)))
+                stages.append({"startTime": cur.strftime(UTC_FMT), "endTime": seg.strftime(UTC_FMT),
+                               "stage": rnd.choice([1, 4, 4, 5, 6])})
+                cur = seg
+            sessions.append({"_id": f"{emp}-{d}", "start": s.strftime(UTC_FMT), "end": end.strftime(UTC_FMT),
+                             "data": {"stages": stages}})
+    return sessions
+
+def edge_stages(tz):
+    """Casos borde: DST, fracciones, '+00:00', sin zona, basura, intervalos vacíos o largos."""
+    rnd = random.Random(7)
+    out = []
+    # transiciones de DST (BA tuvo DST en 2007-2009; NY todos los años)
+    for center in (datetime(2008, 10, 19, 3, tzinfo=timezone.utc), datetime(2009, 3, 15, 2, tzinfo=timezone.utc),
+                   datetime(2024, 3, 10, 7, tzinfo=timezone.utc), datetime(2024, 11, 3, 6, tzinfo=timezone.utc)):
+        for _ in range(300):
+            s = center + timedelta(seconds=rnd.randint(-40000, 40000))
+            e = s + timedelta(seconds=rnd.randint(-600, 90000))
+            fmt = rnd.choice([UTC_FMT, "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S+00:00"])
+            out.append((s.strftime(fmt), e.strftime(fmt), rnd.choice([0, 1, 4, 5, 6, 9, "x"])))
+    out += [("2025-01-01T00:00:00Z", "2025-01-05T00:00:00Z", 4),       # varios días
+            ("2025-01-01T03:00:00Z", "2025-01-01T03:00:00Z", 4),       # vacío
+            ("no-es-fecha", "2025-01-01T03:00:00Z", 4),
+            ("2025-01-01T03:00:00", "2025-01-01T09:00:00", 5),         # sin zona
+            ("2025-01-01T03:00:00-03:00", "2025-01-01T09:30:00-03:00", 6),
+            (None, "2025-01-01T03:00:00Z", 4), ("2025-01-01T03:00:00Z", "2025-01-01T04:00:00Z", None),
+            ("9999-12-31T22:00:00Z", "9999-12-31T23:00:00Z", 4),     # lejos de cualquier ventana
+            ("1900-01-01T00:00:00Z", "2025-01-01T04:00:00Z", 5)]
+    return out
+
+def loop_accumulate(stages, tz, ws, we):
+    by_day = {}
+    for s, e, stg in stages:
+        if not (s and e) or stg is None:
+            continue
+        hub._accumulate_stage_minutes_per_day(by_day, s, e, stg, tz, ws, we)
+    return by_day
+
+def check_equal(tz_name):
+    tz = ZoneInfo(tz_name)
+    stages = edge_stages(tz)
+    for ws, we in [(datetime(2008, 10, 1), datetime(2009, 4, 1)), (datetime(2024, 3, 9), datetime(2024, 11, 5)),
+                   (datetime(2008, 10, 18, 12), datetime(2008, 10, 19, 12)), (datetime(2000, 1, 1), datetime(2030, 1, 1))]:
+        ws, we = ws.replace(tzinfo=tz), we.replace(tzinfo=tz)
+        a = loop_accumulate(stages, tz, ws, we)
+        b = hub.accumulate_stages_per_day({}, stages, tz, ws, we)
+        assert a == b and list(a) == list(b), f"accumulate difiere ({tz_name}, {ws}..{we})"
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        res = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, res
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de agregación de sueño (bucle vs NumPy)")
+    ap.add_argument("--employees", type=int, default=100)
+    ap.add_argument("--days", type=int, default=90)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", help="archivo JSON de salida (además de stdout)")
+    a = ap.parse_args()
+    if hub.np is None:
+        raise SystemExit("numpy no está instalado")
+
+    for tz_name in ("America/Argentina/Buenos_Aires", "America/New_York"):
+        check_equal(tz_name)
+
+    sessions = synth_sessions(a.employees, a.days)
+    stages = [(st["startTime"], st["endTime"], st["stage"]) for s in sessions for st in s["data"]["stages"]]
+    ws = datetime(2025, 1, 1, tzinfo=hub.BA_TZ)
+    we = ws + timedelta(days=a.days + 1)
+
+    t_loop, r_loop = timed(lambda: loop_accumulate(stages, hub.BA_TZ, ws, we), a.repeat)
+    t_np, r_np = timed(lambda: hub.accumulate_stages_per_day({}, stages, hub.BA_TZ, ws, we), a.repeat)
+    assert r_loop == r_np
+
+    report = {
+        "sessions": len(sessions), "stages": len(stages), "identical": True,
+        "accumulate_per_day": {"loop_s": round(t_loop, 4), "numpy_s": round(t_np, 4),
+                               "speedup": round(t_loop / t_np, 1)},
+    }
+    print(json.dumps(report, indent=2))
+    if a.out:
+        with open(a.out, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+if __name__ == "__main__":
+    main()
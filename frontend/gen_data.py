@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Generador de datos sintéticos para el hub: empleados, fichadas con su
+cumplimiento (mismo cálculo que /ingreso), fotos falsas en el almacén por
+contenido y, opcionalmente, cuentas HC apuntadas a hc_stub.py con su sueño.
+Escribe en un directorio aparte (HUB_DATA_DIR), no en frontend/data.
+
+    python gen_data.py --data-dir /tmp/hubbench --reset --employees 5000 --days 365 --per-day 2
+    python hc_stub.py --port 9100 --latency-ms 20 &
+    python gen_data.py --data-dir /tmp/hubbench --reset --employees 500 --hc-accounts 50 --hc-base http://127.0.0.1:9100
+
+Después se levanta el hub contra ese directorio y se mide con bench_hub.py:
+
+    HUB_DATA_DIR=/tmp/hubbench HC_SYNC_INTERVAL_S=0 python pc_hub.py
+"""
+import argparse, io, json, os, random, shutil, sys, time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+NOMBRES   = ["Ana", "Beto", "Carla", "Diego", "Elena", "Facundo", "Gisela", "Hernán", "Inés", "Juan",
+             "Karina", "Lucas", "María", "Nicolás", "Olga", "Pablo", "Rocío", "Sergio", "Tamara", "Walter"]
+APELLIDOS = ["Acosta", "Benítez", "Castro", "Domínguez", "Fernández", "Gómez", "Herrera", "López",
+             "Martínez", "Núñez", "Pérez", "Quiroga", "Romero", "Sosa", "Torres", "Vega"]
+API_KEYS  = ["casco", "gafas", "guantes", "chaleco", "botas"]   # nombres del backend
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Llena hub.db con datos sintéticos")
+    ap.add_argument("--data-dir", required=True, help="directorio de datos del hub (HUB_DATA_DIR)")
+    ap.add_argument("--reset", action="store_true", help="borra hub.db, fotos y miniaturas del directorio antes")
+    ap.add_argument("--employees", type=int, default=200)
+    ap.add_argument("--days", type=int, default=365, help="días hacia atrás con fichadas")
+    ap.add_argument("--per-day", type=float, default=2.0, help="fichadas promedio por empleado y día")
+    ap.add_argument("--images", type=int, default=200, help="fotos distintas (se reparten entre las fichadas)")
+    ap.add_argument("--thumbs", action="store_true", help="generar también las miniaturas")
+    ap.add_argument("--pass-rate", type=float, default=0.8, help="probabilidad de que cada EPP se detecte")
+    ap.add_argument("--force-rewrite", type=float, default=0.05, help="fracción de empleados con rewrite pendiente")
+    ap.add_argument("--hc-accounts", type=int, default=0, help="empleados con cuenta HC (usuario = uid)")
+    ap.add_argument("--hc-base", default=None, help="URL de hc_stub.py; si está, sincroniza el sueño al final")
+    ap.add_argument("--batch", type=int, default=20000, help="filas por transacción")
+    ap.add_argument("--seed", type=int, default=1)
+    return ap.parse_args()
+
+a = parse_args()
+DATA = Path(a.data_dir).resolve()
+if DATA == (Path(__file__).resolve().parent / "data"):
+    sys.exit("usar un --data-dir distinto de frontend/data")
+if a.reset:
+    for name in ("hub.db", "hub.db-wal", "hub.db-shm"):
+        (DATA / name).unlink(missing_ok=True)
+    for sub in ("images", "thumbs"):
+        shutil.rmtree(DATA / sub, ignore_errors=True)
+
+# pc_hub toma la configuración del entorno al importarse
+os.environ["HUB_DATA_DIR"] = str(DATA)
+os.environ["HC_SYNC_INTERVAL_S"] = "0"
+os.environ.setdefault("HUB_IMAGE_FSYNC", "0")
+if a.hc_base:
+    os.environ["HC_BASE"] = a.hc_base
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import pc_hub as hub
+
+rnd = random.Random(a.seed)
+
+def fake_jpeg(i):
+    """JPEG chico y distinto por índice; sin Pillow, bytes al azar con cabecera JPEG."""
+    if hub.PILImage is None:
+        return b"\xff\xd8\xff\xe0" + rnd.randbytes(20000) + b"\xff\xd9"
+    img = hub.PILImage.new("RGB", (640, 480), tuple(rnd.randrange(256) for _ in range(3)))
+    px = img.load()
+    for _ in range(400):   # algo de textura para que el tamaño sea realista
+        x, y = rnd.randrange(640), rnd.randrange(480)
+        px[x, y] = (i % 256, rnd.randrange(256), rnd.randrange(256))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def gen_images():
+    out = []
+    for i in range(a.images):
+        rel, sha, size, _new = hub.image_store.put(io.BytesIO(fake_jpeg(i)))
+        if a.thumbs:
+            hub.make_thumbnail(rel)
+        out.append((rel, sha, size))
+    return out
+
+def gen_employees(now):
+    rows, uids = [], set()
+    while len(uids) < a.employees:
+        uids.add(f"{rnd.getrandbits(32):08X}")
+    for v, uid in enumerate(sorted(uids), 1):
+        casco, lentes, guantes = (int(rnd.random() < p) for p in (0.9, 0.6, 0.5))
+        upd = (now - timedelta(days=rnd.randint(0, a.days), seconds=rnd.randint(0, 86399))).isoformat(timespec="seconds")
+        rows.append((uid, f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)}", casco, lentes, guantes,
+                     int(casco and lentes and guantes), int(rnd.random() < 0.02),
+                     int(rnd.random() < a.force_rewrite), upd, v))
+    with hub.db() as con:
+        con.executemany("""INSERT INTO employees(uid,nombre,casco,lentes,guantes,epp_completo,bloqueado,
+                                                 force_rewrite,updated_at,version)
+                           VALUES(?,?,?,?,?,?,?,?,?,?)
+                           ON CONFLICT(uid) DO NOTHING""", rows)
+    return [{"uid": r[0], "nombre": r[1], "casco": r[2], "lentes": r[3], "guantes": r[4]} for r in rows]
+
+def api_result():
+    res = {}
+    for k in API_KEYS:
+        present = rnd.random() < a.pass_rate
+        res[k] = {"present": present, "confidence": round(rnd.uniform(0.7, 0.99) if present else rnd.uniform(0.05, 0.5), 2)}
+    res["photo_quality"] = "ok" if rnd.random() < 0.9 else rnd.choice(hub.PHOTO_QUALITIES[1:])
+    return json.dumps({"ok": True, "result": res}, ensure_ascii=False)
+
+def gen_records(emps, images, start):
+    """Fichadas en orden de ts (los ids crecen con la fecha, como en producción)."""
+    total, refs = 0, [0] * len(images)
+    batch = []
+    sql = """INSERT INTO records(ts,uid,nombre_tag,epp_tag_json,api_result_json,image_file,
+                                 required_mask,detected_mask,pasa,photo_quality)
+             VALUES(?,?,?,?,?,?,?,?,?,?)"""
+
+    def flush():
+        with hub.db() as con:
+            con.executemany(sql, batch)
+        batch.clear()
+
+    for d in range(a.days):
+        day = start + timedelta(days=d)
+        n = int(len(emps) * a.per_day + rnd.random())
+        secs = sorted(rnd.randint(6 * 3600, 20 * 3600) for _ in range(n))
+        for s in secs:
+            e = rnd.choice(emps)
+            img = rnd.randrange(len(images))
+            refs[img] += 1
+            res = api_result()
+            comp = hub.compute_compliance(e, res)
+            tag = [k for k in ("casco", "lentes", "guantes") if e[k]]
+            batch.append(((day + timedelta(seconds=s)).strftime("%Y-%m-%d %H:%M:%S"), e["uid"], e["nombre"],
+                          json.dumps(tag, ensure_ascii=False), res, images[img][0],
+                          comp["required_mask"], comp["detected_mask"], comp["pasa"], comp["photo_quality"]))
+            if len(batch) >= a.batch:
+                total += len(batch)
+                flush()
+        print(f"\r{day:%Y-%m-%d}  {total + len(batch)} fichadas", end="", file=sys.stderr, flush=True)
+    total += len(batch)
+    if batch:
+        flush()
+    print(file=sys.stderr)
+    now = datetime.now().isoformat(timespec="seconds")
+    with hub.db() as con:
+        con.executemany("""INSERT INTO images(path,sha256,size,refcount,created_at) VALUES(?,?,?,?,?)
+                           ON CONFLICT(path) DO UPDATE SET refcount=refcount+excluded.refcount""",
+                        [(rel, sha, size, n, now) for (rel, sha, size), n in zip(images, refs) if n])
+    return total
+
+def gen_hc_accounts(emps):
+    uids = [e["uid"] for e in emps[:a.hc_accounts]]
+    for uid in uids:
+        hub.hc_accounts.save(uid, uid.lower(), "stub")
+    return uids
+
+def main():
+    now = datetime.now().replace(microsecond=0)
+    start = datetime(now.year, now.month, now.day) - timedelta(days=a.days)
+    t0 = time.perf_counter()
+    images = gen_images()
+    t_img = time.perf_counter()
+    emps = gen_employees(now)
+    t_emp = time.perf_counter()
+    n_rec = gen_records(emps, images, start)
+    t_rec = time.perf_counter()
+    with hub.db() as con:
+        hub.rebuild_compliance_rollup(con)
+    t_roll = time.perf_counter()
+    hc_uids = gen_hc_accounts(emps) if a.hc_accounts else []
+    synced = {}
+    if hc_uids and a.hc_base:
+        synced = hub.sync_sleep(full=True, uids=set(hc_uids))
+    t_end = time.perf_counter()
+    with hub.db() as con:
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        con.execute("ANALYZE")
+
+    report = {
+        "data_dir": str(DATA), "seed": a.seed,
+        "employees": len(emps), "records": n_rec, "images": len(images), "days": a.days,
+        "hc_accounts": len(hc_uids), "hc_synced_ok": sum(1 for v in synced.values() if v is not None),
+        "db_mb": round(hub.DB_PATH.stat().st_size / 1e6, 1),
+        "seconds": {"images": round(t_img - t0, 2), "employees": round(t_emp - t_img, 2),
+                    "records": round(t_rec - t_emp, 2), "rollup": round(t_roll - t_rec, 2),
+                    "hc": round(t_end - t_roll, 2)},
+    }
+    (DATA / "gen_data.json").write_text(json.dumps(report, indent=2))
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+# Config de gunicorn para el hub (gunicorn la lee sola si se arranca desde frontend/):
+#
+#     gunicorn -w 4 -b 0.0.0.0:8090 pc_hub:app
+#
+# Cada worker arranca su hilo de sincronización de sueño; el lease en
+# sync_state hace que sincronice uno solo a la vez. Importar pc_hub (comandos
+# de mantenimiento, gen_data.py, bench) no arranca nada.
+
+def post_worker_init(worker):
+    import pc_hub
+    pc_hub.start_sleep_syncer()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Servidor local que imita HC Gateway (login + fetch/sleepSession) con sueño
+sintético y determinístico por usuario: una sesión por noche, con etapas.
+Sirve para probar la sincronización por cuenta sin red ni credenciales.
+
+    python hc_stub.py --port 9100 --latency-ms 150 --fail-users ana,beto
+    HC_BASE=http://127.0.0.1:9100 python pc_hub.py
+
+Cualquier usuario/contraseña loguea (salvo --password, que la fija para todos).
+Los usuarios de --fail-users responden 500 al pedir sesiones.
+"""
+import argparse, hashlib, random, threading, time, uuid
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+CFG = {
+    "latency_ms": 100.0,      # por request
+    "error_rate": 0.0,        # probabilidad de 503 en fetch
+    "fail_users": set(),      # usuarios que siempre fallan en fetch
+    "password": None,         # None = acepta cualquiera
+    "token_ttl_s": 3600,
+    "history_days": 60,       # noches generadas hacia atrás
+}
+
+_UTC_FMT = "%Y-%m-%dT%H:%M:%SZ"
+_tokens = {}   # token -> (usuario, expira)
+_lock = threading.Lock()
+STATS = {"logins": 0, "fetches": 0}
+
+def _parse(iso_s):
+    return datetime.strptime(iso_s, _UTC_FMT).replace(tzinfo=timezone.utc)
+
+def _night(user, day):
+    """Sesión de la noche que empieza en 'day' (fecha local UTC-3), igual en cada llamada."""
+    rnd = random.Random(hashlib.sha256(f"{user}|{day.isoformat()}".encode()).digest())
+    # acostarse entre 22:00 y 01:00 locales (= 01:00–04:00 UTC del día siguiente)
+    start = datetime(day.year, day.month, day.day, 1, tzinfo=timezone.utc) + timedelta(days=1, minutes=rnd.randint(0, 180))
+    end = start + timedelta(minutes=rnd.randint(300, 540))
+    stages, cur = [], start
+    while cur < end:
+        seg = min(end, cur + timedelta(minutes=rnd.randint(10, 60)))
+        stages.append({"startTime": cur.strftime(_UTC_FMT), "endTime": seg.strftime(_UTC_FMT),
+                       "stage": rnd.choice([1, 4, 4, 5, 6])})
+        cur = seg
+    return {"_id": f"{user}-{day.isoformat()}", "start": start.strftime(_UTC_FMT),
+            "end": end.strftime(_UTC_FMT), "data": {"stages": stages}}
+
+def _sessions(user, q):
+    today = datetime.now(timezone.utc).date()
+    out = []
+    for i in range(CFG["history_days"], 0, -1):
+        s = _night(user, today - timedelta(days=i))
+        if _parse(s["end"]) > datetime.now(timezone.utc):
+            continue
+        if "$gte" in (q.get("start") or {}) and s["start"] < q["start"]["$gte"]:
+            continue
+        if "$lte" in (q.get("end") or {}) and s["end"] > q["end"]["$lte"]:
+            continue
+        out.append(s)
+    return out
+
+@app.post("/api/v2/login")
+def login():
+    body = request.get_json(silent=True) or {}
+    time.sleep(CFG["latency_ms"] / 1000.0)
+    user, pw = body.get("username"), body.get("password")
+    if not user or (CFG["password"] is not None and pw != CFG["password"]):
+        return jsonify({"error": "invalid credentials"}), 403
+    token = uuid.uuid4().hex
+    expiry = datetime.now(timezone.utc) + timedelta(seconds=CFG["token_ttl_s"])
+    with _lock:
+        _tokens[token] = (user, expiry)
+        STATS["logins"] += 1
+    return jsonify({"token": token, "expiry": expiry.isoformat()})
+
+@app.post("/api/v2/fetch/sleepSession")
+def fetch_sleep():
+    time.sleep(CFG["latency_ms"] / 1000.0)
+    token = (request.headers.get("Authorization") or "").removeprefix("Bearer ").strip()
+    with _lock:
+        user, expiry = _tokens.get(token, (None, None))
+        STATS["fetches"] += 1
+    if not user or expiry < datetime.now(timezone.utc):
+        return jsonify({"error": "invalid token"}), 401
+    if user in CFG["fail_users"]:
+        return jsonify({"error": f"stub failure for {user}"}), 500
+    if random.random() < CFG["error_rate"]:
+        return jsonify({"error": "stub overloaded"}), 503
+    q = (request.get_json(silent=True) or {}).get("queries") or {}
+    return jsonify(_sessions(user, q))
+
+@app.get("/stats")
+def stats():
+    return jsonify({**STATS, "tokens": len(_tokens)})
+
+def main():
+    ap = argparse.ArgumentParser(description="Stub de HC Gateway con sueño sintético por usuario")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--latency-ms", type=float, default=CFG["latency_ms"])
+    ap.add_argument("--error-rate", type=float, default=CFG["error_rate"])
+    ap.add_argument("--fail-users", default="", help="usuarios separados por coma que siempre fallan")
+    ap.add_argument("--password", default=None, help="contraseña exigida a todos (default: cualquiera)")
+    ap.add_argument("--token-ttl-s", type=int, default=CFG["token_ttl_s"])
+    ap.add_argument("--history-days", type=int, default=CFG["history_days"])
+    a = ap.parse_args()
+    CFG.update(latency_ms=a.latency_ms, error_rate=a.error_rate, password=a.password,
+               fail_users={u for u in a.fail_users.split(",") if u.strip()},
+               token_ttl_s=a.token_ttl_s, history_days=a.history_days)
+    app.run(host=a.host, port=a.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-import os, json, sqlite3, datetime
+import os, io, csv, json, sqlite3, datetime, time, threading, queue, hashlib, tempfile, atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, send_from_directory, flash
+from flask import Flask, request, jsonify, render_template_string, redirect, url_for, send_from_directory, flash, g, Response, has_request_context, stream_with_context
+from markupsafe import escape
+from werkzeug.security import safe_join
 
 # ===== Cargar .env si existe =====
 try:
@@ -12,49 +16,410 @@ except Exception:
 
 # ===== Paths / App =====
 BASE_DIR = Path(__file__).resolve().parent
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.getenv("HUB_DATA_DIR", BASE_DIR / "data"))   # gen_data.py / bench_hub.py usan otro
 IMG_DIR  = DATA_DIR / "images"
+THUMB_DIR = DATA_DIR / "thumbs"
 DB_PATH  = DATA_DIR / "hub.db"
 os.makedirs(IMG_DIR, exist_ok=True)
+os.makedirs(THUMB_DIR, exist_ok=True)
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-insecure-change-me")  # poné una real en prod
 
+# ===== Métricas (Prometheus, opcional) =====
+# Si prometheus_client no está instalado las métricas son no-op y /metrics da 501.
+# Con varios workers de gunicorn exportar PROMETHEUS_MULTIPROC_DIR.
+try:
+    from prometheus_client import (Counter, Histogram, CollectorRegistry, REGISTRY,
+                                   generate_latest, CONTENT_TYPE_LATEST, multiprocess)
+    LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+    HTTP_SECONDS = Histogram("hub_http_request_seconds", "Duración de requests HTTP por ruta",
+                             ["route", "method", "status"], buckets=LATENCY_BUCKETS)
+    STAGE_SECONDS = Histogram("hub_stage_seconds", "Duración de etapas internas por ruta",
+                              ["route", "stage"], buckets=LATENCY_BUCKETS)
+    ERRORS = Counter("hub_errors_total", "Errores por tipo", ["type"])
+except ImportError:
+    HTTP_SECONDS = STAGE_SECONDS = ERRORS = None
+
+def count_error(kind):
+    if ERRORS is not None:
+        ERRORS.labels(kind).inc()
+
+@contextmanager
+def stage(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if STAGE_SECONDS is not None:
+            route = request.url_rule.rule if has_request_context() and request.url_rule else "-"
+            STAGE_SECONDS.labels(route, name).observe(time.perf_counter() - t0)
+
+@app.before_request
+def _metrics_start():
+    g._t0 = time.perf_counter()
+
+@app.after_request
+def _metrics_end(resp):
+    t0 = getattr(g, "_t0", None)
+    if HTTP_SECONDS is not None and t0 is not None and request.url_rule is not None:
+        HTTP_SECONDS.labels(request.url_rule.rule, request.method, str(resp.status_code)).observe(time.perf_counter() - t0)
+    return resp
+
+@app.get("/metrics")
+def metrics():
+    if HTTP_SECONDS is None:
+        return "prometheus_client no instalado", 501
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
 # ===== DB helpers =====
-def db():
-    conn = sqlite3.connect(DB_PATH)
+# Pool de conexiones por proceso (se rehace tras un fork de gunicorn) con WAL,
+# para que los INSERT de /ingreso no bloqueen las lecturas del dashboard.
+DB_POOL_SIZE    = int(os.getenv("HUB_DB_POOL_SIZE", "8"))
+DB_POOL_WAIT_S  = float(os.getenv("HUB_DB_POOL_WAIT_S", "10"))
+DB_BUSY_MS      = int(os.getenv("HUB_DB_BUSY_MS", "5000"))
+DB_SYNCHRONOUS  = os.getenv("HUB_DB_SYNCHRONOUS", "NORMAL")   # NORMAL es seguro con WAL
+DB_MMAP_MB      = int(os.getenv("HUB_DB_MMAP_MB", "256"))
+DB_CACHE_MB     = int(os.getenv("HUB_DB_CACHE_MB", "32"))
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_MS / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_MS}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_MB * 1024}")   # negativo = KiB
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
-def init_db():
-    with db() as con:
-        con.execute("""CREATE TABLE IF NOT EXISTS employees(
-            uid TEXT PRIMARY KEY,
-            nombre TEXT,
-            casco INTEGER DEFAULT 0,
-            lentes INTEGER DEFAULT 0,
-            guantes INTEGER DEFAULT 0,
-            epp_completo INTEGER DEFAULT 0,
-            bloqueado INTEGER DEFAULT 0,
-            force_rewrite INTEGER DEFAULT 0,
-            updated_at TEXT
+class ConnectionPool:
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():   # no compartir conexiones heredadas del padre
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return _connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=DB_POOL_WAIT_S)
+        except queue.Empty:
+            raise RuntimeError("pool de SQLite agotado")
+
+    def _release(self, conn):
+        if self._pid == os.getpid():
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            with conn:   # commit o rollback como el "with sqlite3.connect()" de antes
+                yield conn
+        finally:
+            self._release(conn)
+
+_pool = ConnectionPool()
+
+def db():
+    """Uso: `with db() as con:` — toma una conexión del pool y la devuelve al salir."""
+    return _pool.connection()
+
+# ===== Migraciones =====
+# Versionadas con PRAGMA user_version. Cada una corre una sola vez, en su
+# propia transacción; agregar nuevas al final de MIGRATIONS.
+def _columns(con, table):
+    return {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+
+def _m001_base(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS employees(
+        uid TEXT PRIMARY KEY,
+        nombre TEXT,
+        casco INTEGER DEFAULT 0,
+        lentes INTEGER DEFAULT 0,
+        guantes INTEGER DEFAULT 0,
+        epp_completo INTEGER DEFAULT 0,
+        bloqueado INTEGER DEFAULT 0,
+        force_rewrite INTEGER DEFAULT 0,
+        updated_at TEXT
+    )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS records(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts TEXT,
+        uid TEXT,
+        nombre_tag TEXT,
+        epp_tag_json TEXT,
+        api_result_json TEXT,
+        image_file TEXT
+    )""")
+
+def _m002_force_rewrite(con):
+    # bases viejas creadas antes de force_rewrite
+    if "force_rewrite" not in _columns(con, "employees"):
+        con.execute("ALTER TABLE employees ADD COLUMN force_rewrite INTEGER DEFAULT 0")
+
+def _m003_indexes(con):
+    con.execute("CREATE INDEX IF NOT EXISTS idx_records_uid_id ON records(uid, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_records_ts ON records(ts)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_employees_updated_at ON employees(updated_at)")
+
+def _m004_sleep_store(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS sleep_sessions(
+        id TEXT PRIMARY KEY,
+        start TEXT NOT NULL,
+        end TEXT NOT NULL,
+        data_json TEXT,
+        fetched_at TEXT
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sleep_sessions_start ON sleep_sessions(start)")
+    con.execute("""CREATE TABLE IF NOT EXISTS sleep_days(
+        day TEXT PRIMARY KEY,
+        total_min INTEGER NOT NULL DEFAULT 0,
+        per_stage_json TEXT,
+        updated_at TEXT
+    )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS sync_state(
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""")
+
+def _m005_records_compliance(con):
+    cols = _columns(con, "records")
+    for name, typ in [("required_mask", "INTEGER"), ("detected_mask", "INTEGER"),
+                      ("pasa", "INTEGER"), ("photo_quality", "TEXT")]:
+        if name not in cols:
+            con.execute(f"ALTER TABLE records ADD COLUMN {name} {typ}")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_records_pasa_id ON records(pasa, id)")
+    # las fichadas que ya había se completan acá (son pocas); si no, quedaban
+    # fuera del rollup y de la analítica hasta correr backfill-compliance
+    n, last_id = 1, 0
+    while n:
+        n, last_id = backfill_compliance_batch(con, last_id)
+
+def _m006_records_uid_pasa(con):
+    con.execute("CREATE INDEX IF NOT EXISTS idx_records_uid_pasa_id ON records(uid, pasa, id)")
+
+def _m007_images(con):
+    con.execute("""CREATE TABLE IF NOT EXISTS images(
+        path TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        size INTEGER,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_records_image_file ON records(image_file)")
+
+# Bits para guardar listas de EPP como enteros en records (filtrables en SQL)
+EPP_BITS = {"casco": 1, "lentes": 2, "guantes": 4, "chaleco": 8, "botas": 16}
+
+# columnas por ítem de compliance_daily: <item>_req / <item>_det / <item>_ok
+ROLLUP_ITEM_COLS = [f"{item}_{k}" for item in EPP_BITS for k in ("req", "det", "ok")]
+
+def rebuild_compliance_rollup(con, day_from=None, day_to=None):
+    """Recalcula compliance_daily desde records (todo o un rango de días).
+    Las fichadas sin pasa calculado se saltean: primero backfill-compliance."""
+    where, params = ["pasa IS NOT NULL"], []
+    dwhere, dparams = [], []
+    if day_from:
+        where.append("ts >= ?"); params.append(day_from + " 00:00:00")
+        dwhere.append("day >= ?"); dparams.append(day_from)
+    if day_to:
+        where.append("ts <= ?"); params.append(day_to + " 23:59:59")
+        dwhere.append("day <= ?"); dparams.append(day_to)
+    con.execute("DELETE FROM compliance_daily" + (" WHERE " + " AND ".join(dwhere) if dwhere else ""), dparams)
+    sums = []
+    for item, bit in EPP_BITS.items():
+        sums += [f"SUM((IFNULL(required_mask,0) & {bit}) != 0)",
+                 f"SUM((IFNULL(detected_mask,0) & {bit}) != 0)",
+                 f"SUM((IFNULL(required_mask,0) & IFNULL(detected_mask,0) & {bit}) != 0)"]
+    con.execute(f"""
+        INSERT INTO compliance_daily(day, uid, n, req, pasa, {', '.join(ROLLUP_ITEM_COLS)})
+        SELECT substr(ts,1,10), IFNULL(uid,''), COUNT(*), SUM(IFNULL(required_mask,0) != 0), SUM(pasa),
+               {', '.join(sums)}
+        FROM records WHERE {' AND '.join(where)} GROUP BY 1, 2""", params)
+
+def _m008_compliance_daily(con):
+    # rollup día x uid con contadores por ítem: n fichadas, req con algún EPP
+    # requerido, pasa; por ítem: requerido / detectado / requerido y detectado
+    item_cols = ",\n        ".join(f"{c} INTEGER NOT NULL DEFAULT 0" for c in ROLLUP_ITEM_COLS)
+    con.execute(f"""CREATE TABLE IF NOT EXISTS compliance_daily(
+        day TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0,
+        req INTEGER NOT NULL DEFAULT 0,
+        pasa INTEGER NOT NULL DEFAULT 0,
+        {item_cols},
+        PRIMARY KEY(day, uid)
+    ) WITHOUT ROWID""")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_compliance_daily_uid_day ON compliance_daily(uid, day)")
+    rebuild_compliance_rollup(con)
+
+def _m009_employees_version(con):
+    # versión del padrón: cada alta/cambio toma MAX(version)+1 (ver bump en save_employee)
+    if "version" not in _columns(con, "employees"):
+        con.execute("ALTER TABLE employees ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        con.execute("UPDATE employees SET version = rowid")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_employees_version ON employees(version)")
+
+def _m010_hc_accounts(con):
+    # credenciales HC Gateway por empleado (password cifrada, ver SecretBox) y
+    # sueño por cuenta: sleep_sessions / sleep_days pasan a tener uid
+    # ('' = la cuenta global de HC_USER/HC_PASS, la única que existía antes)
+    con.execute("""CREATE TABLE IF NOT EXISTS hc_accounts(
+        uid TEXT PRIMARY KEY,
+        hc_user TEXT NOT NULL,
+        hc_pass_enc TEXT NOT NULL,
+        updated_at TEXT
+    )""")
+    if "uid" not in _columns(con, "sleep_sessions"):
+        con.execute("""CREATE TABLE sleep_sessions_new(
+            uid TEXT NOT NULL DEFAULT '',
+            id TEXT NOT NULL,
+            start TEXT NOT NULL,
+            end TEXT NOT NULL,
+            data_json TEXT,
+            fetched_at TEXT,
+            PRIMARY KEY(uid, id)
         )""")
-        con.execute("""CREATE TABLE IF NOT EXISTS records(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT,
-            uid TEXT,
-            nombre_tag TEXT,
-            epp_tag_json TEXT,
-            api_result_json TEXT,
-            image_file TEXT
+        con.execute("""INSERT INTO sleep_sessions_new(uid,id,start,end,data_json,fetched_at)
+                       SELECT '',id,start,end,data_json,fetched_at FROM sleep_sessions""")
+        con.execute("DROP TABLE sleep_sessions")
+        con.execute("ALTER TABLE sleep_sessions_new RENAME TO sleep_sessions")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sleep_sessions_uid_start ON sleep_sessions(uid, start)")
+    if "uid" not in _columns(con, "sleep_days"):
+        con.execute("""CREATE TABLE sleep_days_new(
+            uid TEXT NOT NULL DEFAULT '',
+            day TEXT NOT NULL,
+            total_min INTEGER NOT NULL DEFAULT 0,
+            per_stage_json TEXT,
+            updated_at TEXT,
+            PRIMARY KEY(uid, day)
         )""")
-        # migración blanda
-        try:
-            con.execute("ALTER TABLE employees ADD COLUMN force_rewrite INTEGER DEFAULT 0")
-        except Exception:
-            pass
+        con.execute("""INSERT INTO sleep_days_new(uid,day,total_min,per_stage_json,updated_at)
+                       SELECT '',day,total_min,per_stage_json,updated_at FROM sleep_days""")
+        con.execute("DROP TABLE sleep_days")
+        con.execute("ALTER TABLE sleep_days_new RENAME TO sleep_days")
+
+def _m011_employees_search(con):
+    # con uid TEXT PRIMARY KEY el rowid de employees es implícito y VACUUM lo
+    # puede renumerar, desincronizando un FTS external-content: se rearma la
+    # tabla con id INTEGER PRIMARY KEY (alias estable del rowid) y el FTS lo usa
+    indexes = [r[0] for r in con.execute(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='employees' AND sql IS NOT NULL")]
+    con.execute("""CREATE TABLE employees_new(
+        id INTEGER PRIMARY KEY,
+        uid TEXT UNIQUE,
+        nombre TEXT,
+        casco INTEGER DEFAULT 0,
+        lentes INTEGER DEFAULT 0,
+        guantes INTEGER DEFAULT 0,
+        epp_completo INTEGER DEFAULT 0,
+        bloqueado INTEGER DEFAULT 0,
+        force_rewrite INTEGER DEFAULT 0,
+        updated_at TEXT,
+        version INTEGER NOT NULL DEFAULT 0
+    )""")
+    cols = "uid,nombre,casco,lentes,guantes,epp_completo,bloqueado,force_rewrite,updated_at,version"
+    con.execute(f"INSERT INTO employees_new(id,{cols}) SELECT rowid,{cols} FROM employees ORDER BY rowid")
+    con.execute("DROP TABLE employees")
+    con.execute("ALTER TABLE employees_new RENAME TO employees")
+    for sql in indexes:
+        con.execute(sql)
+    # padrón paginado por (updated_at, uid) con NULLs al final; parciales para
+    # los filtros poco frecuentes; FTS5 sobre uid/nombre si el SQLite la trae
+    con.execute("CREATE INDEX IF NOT EXISTS idx_employees_upd_uid ON employees(IFNULL(updated_at,''), uid)")
+    con.execute("""CREATE INDEX IF NOT EXISTS idx_employees_rewrite ON employees(IFNULL(updated_at,''), uid)
+                   WHERE force_rewrite != 0""")
+    con.execute("""CREATE INDEX IF NOT EXISTS idx_employees_blocked ON employees(IFNULL(updated_at,''), uid)
+                   WHERE bloqueado != 0""")
+    con.execute("DROP INDEX IF EXISTS idx_employees_updated_at")   # reemplazado por idx_employees_upd_uid
+    _employees_fts(con, "id")
+
+def _employees_fts(con, key):
+    # FTS5 external-content sobre employees.<key>; sin FTS5 la búsqueda cae a LIKE
+    try:
+        con.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS employees_fts USING fts5(
+            uid, nombre, content='employees', content_rowid='{key}',
+            tokenize="unicode61 remove_diacritics 2", prefix='2 3')""")
+    except sqlite3.OperationalError:
+        return
+    con.execute(f"""CREATE TRIGGER IF NOT EXISTS employees_fts_ai AFTER INSERT ON employees BEGIN
+                      INSERT INTO employees_fts(rowid, uid, nombre) VALUES (new.{key}, new.uid, new.nombre);
+                    END""")
+    con.execute(f"""CREATE TRIGGER IF NOT EXISTS employees_fts_ad AFTER DELETE ON employees BEGIN
+                      INSERT INTO employees_fts(employees_fts, rowid, uid, nombre)
+                      VALUES ('delete', old.{key}, old.uid, old.nombre);
+                    END""")
+    con.execute(f"""CREATE TRIGGER IF NOT EXISTS employees_fts_au AFTER UPDATE OF uid, nombre ON employees BEGIN
+                      INSERT INTO employees_fts(employees_fts, rowid, uid, nombre)
+                      VALUES ('delete', old.{key}, old.uid, old.nombre);
+                      INSERT INTO employees_fts(rowid, uid, nombre) VALUES (new.{key}, new.uid, new.nombre);
+                    END""")
+    con.execute("INSERT INTO employees_fts(employees_fts) VALUES ('rebuild')")
+
+MIGRATIONS = [
+    (1, _m001_base),
+    (2, _m002_force_rewrite),
+    (3, _m003_indexes),
+    (4, _m004_sleep_store),
+    (5, _m005_records_compliance),
+    (6, _m006_records_uid_pasa),
+    (7, _m007_images),
+    (8, _m008_compliance_daily),
+    (9, _m009_employees_version),
+    (10, _m010_hc_accounts),
+    (11, _m011_employees_search),
+]
+
+def migrate():
+    con = _connect()
+    con.isolation_level = None   # transacciones explícitas
+    try:
+        for version, fn in MIGRATIONS:
+            con.execute("BEGIN IMMEDIATE")   # serializa workers que arrancan juntos
+            try:
+                if con.execute("PRAGMA user_version").fetchone()[0] < version:
+                    fn(con)
+                    con.execute(f"PRAGMA user_version={version}")
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+    finally:
+        con.close()
 
-init_db()
+def init_db():
+    migrate()
 
 # ===== UI base =====
 TPL_BASE = """
@@ -79,10 +444,11 @@ small.mono{font-family:ui-monospace, SFMono-Regular, Menlo, Consolas, monospace;
   <nav>
     <a href="{{url_for('dashboard')}}">Dashboard</a>
     <a href="{{url_for('employees')}}">Empleados</a>
+    <a href="{{url_for('analytics')}}">Analítica</a>
   </nav>
 </header>
 {% with messages = get_flashed_messages(with_categories=true) %}
-  {% if messages %}<div class="card">{% for cat,msg in messages %}<div class="{{cat}}">{{msg}}</div>{% endfor %}</div>{% endif %}
+  {% if messages %}<div class="card">{% for cat,msg in messages %}{% if msg is not string %}{% set cat, msg = msg %}{% endif %}<div class="{{cat}}">{{msg}}</div>{% endfor %}</div>{% endif %}
 {% endwith %}
 {{ body|safe }}
 </body></html>
@@ -142,8 +508,95 @@ def epp_detected_from_api_result(api_result_json, min_conf=HUB_MIN_CONF):
 def epp_list_to_str(epp_list):
     return ", ".join(epp_list) if epp_list else "-"
 
+def epp_to_mask(epp_list):
+    m = 0
+    for x in epp_list or []:
+        m |= EPP_BITS.get("lentes" if x == "gafas" else x, 0)
+    return m
+
+def epp_from_mask(mask):
+    return [k for k, bit in EPP_BITS.items() if (mask or 0) & bit]
+
+# valores de result.photo_quality: el enum de report_epp en backend/app.py
+PHOTO_QUALITIES = ["ok", "too_far", "occluded", "low_light", "blurry"]
+
+def photo_quality_from_api_result(api_result_json):
+    try:
+        data = json.loads(api_result_json) if api_result_json else {}
+        q = (data.get("result") or {}).get("photo_quality")
+        return q if isinstance(q, str) else None
+    except Exception:
+        return None
+
+def analysis_ok_from_api_result(api_result_json):
+    """True si el backend llegó a analizar la foto (ok + result)."""
+    try:
+        data = json.loads(api_result_json) if api_result_json else {}
+        return bool(data.get("ok")) and isinstance(data.get("result"), dict)
+    except Exception:
+        return False
+
+def retake_from_api_result(api_result_json):
+    """True si el pre-chequeo del backend pidió repetir la foto."""
+    try:
+        data = json.loads(api_result_json) if api_result_json else {}
+        return bool(data.get("retake"))
+    except Exception:
+        return False
+
+def compute_compliance(e_row, api_result_json, min_conf=HUB_MIN_CONF):
+    """Requerido (según el empleado), detectado (según la API), si pasa y la
+    calidad de foto; se calcula una vez al ingresar y se guarda en records.
+    Si el análisis falló (backend caído, error) pasa queda None: la fichada
+    se guarda pero no cuenta como incumplimiento."""
+    required = epp_required_from_employee_row(e_row)
+    detected = epp_detected_from_api_result(api_result_json, min_conf)
+    pasa = set(required).issubset(set(detected)) if required else False
+    return {
+        "required_mask": epp_to_mask(required),
+        "detected_mask": epp_to_mask(detected),
+        "pasa": (1 if pasa else 0) if analysis_ok_from_api_result(api_result_json) else None,
+        "photo_quality": photo_quality_from_api_result(api_result_json),
+    }
+
+def rollup_add(con, ts, uid, comp):
+    """Suma una fichada a compliance_daily (misma transacción que el INSERT).
+    Las que no tienen análisis (pasa None) no entran, igual que en el rebuild."""
+    if comp["pasa"] is None:
+        return
+    req, det = comp["required_mask"] or 0, comp["detected_mask"] or 0
+    vals = [1, int(req != 0), comp["pasa"] or 0]
+    for bit in EPP_BITS.values():
+        vals += [int(bool(req & bit)), int(bool(det & bit)), int(bool(req & det & bit))]
+    cols = ["n", "req", "pasa"] + ROLLUP_ITEM_COLS
+    con.execute(f"""INSERT INTO compliance_daily(day, uid, {', '.join(cols)})
+                    VALUES(?, ?, {', '.join('?' * len(cols))})
+                    ON CONFLICT(day, uid) DO UPDATE SET {', '.join(f'{c}={c}+excluded.{c}' for c in cols)}""",
+                [(ts or "")[:10], uid or ""] + vals)
+
+def backfill_compliance_batch(con, last_id=0, batch=1000, recompute_all=False):
+    """Calcula required_mask/detected_mask/pasa/photo_quality de hasta 'batch'
+    fichadas con id > last_id (solo las que no lo tienen, salvo recompute_all).
+    Devuelve (filas, último id procesado)."""
+    where = "" if recompute_all else "r.pasa IS NULL AND"
+    rows = con.execute(f"""
+        SELECT r.id, r.api_result_json, e.casco, e.lentes, e.guantes
+        FROM records r LEFT JOIN employees e ON e.uid = r.uid
+        WHERE {where} r.id > ? ORDER BY r.id LIMIT ?""", (last_id, batch)).fetchall()
+    if not rows:
+        return 0, last_id
+    con.executemany(
+        "UPDATE records SET required_mask=?, detected_mask=?, pasa=?, photo_quality=? WHERE id=?",
+        [(c["required_mask"], c["detected_mask"], c["pasa"], c["photo_quality"], r["id"])
+         for r in rows for c in [compute_compliance(r, r["api_result_json"])]])
+    return len(rows), rows[-1]["id"]
+
+init_db()   # después de los helpers EPP: la migración 5 completa el cumplimiento
+
 # ===== Integración Sueño (HC Gateway) =====
+import random
 import requests
+import requests.adapters
 from datetime import datetime as _dt
 from datetime import timezone as _timezone
 from datetime import timedelta as _td
@@ -158,9 +611,13 @@ except Exception:
 HC_BASE = os.getenv("HC_BASE", "https://api.hcgateway.shuchir.dev")
 HC_USER = os.getenv("HC_USER")
 HC_PASS = os.getenv("HC_PASS")
-
-_hc_token = None
-_hc_expiry = None
+HC_CONNECT_TIMEOUT_S = float(os.getenv("HC_CONNECT_TIMEOUT_S", "5"))
+HC_READ_TIMEOUT_S    = float(os.getenv("HC_READ_TIMEOUT_S", "30"))
+HC_RETRIES           = int(os.getenv("HC_RETRIES", "2"))        # reintentos ante red/5xx
+HC_DEADLINE_S        = float(os.getenv("HC_DEADLINE_S", "60"))  # presupuesto total por llamada
+HC_POOL_SIZE         = int(os.getenv("HC_POOL_SIZE", "10"))
+HC_UID               = os.getenv("HC_UID", "")   # empleado dueño de la cuenta HC_USER ('' = ninguno)
+HC_SYNC_WORKERS      = int(os.getenv("HC_SYNC_WORKERS", "8"))  # cuentas sincronizadas en paralelo
 
 def _mins_to_hm(m):
     try:
@@ -231,57 +688,416 @@ def _parse_iso_aware_utc(iso_s: str):
     return dt
 
 
-def _hc_login():
-    global _hc_token, _hc_expiry
-    if not HC_USER or not HC_PASS:
-        raise RuntimeError("Faltan HC_USER / HC_PASS en el entorno")
-    url = f"{HC_BASE}/api/v2/login"
-    try:
-        r = requests.post(url, json={"username": HC_USER, "password": HC_PASS}, timeout=20)
-        r.raise_for_status()
-        data = r.json()
-    except Exception as ex:
-        raise RuntimeError(f"Fallo login HC: {ex}")
-
-    _hc_token = data.get("token")
-    expiry_str = data.get("expiry")
-    _hc_expiry = _parse_iso_aware_utc(expiry_str) if expiry_str else None
-
-    if not _hc_token:
-        raise RuntimeError("Login OK pero no vino 'token'")
-
-def _hc_get_token():
-    global _hc_token, _hc_expiry
-    if _hc_token and _hc_expiry:
-        now_utc = _dt.now(_timezone.utc)
-        # _hc_expiry ya es aware UTC, pero por las dudas:
-        exp_utc = _hc_expiry.astimezone(_timezone.utc) if _hc_expiry.tzinfo else _hc_expiry.replace(tzinfo=_timezone.utc)
-        if now_utc + _td(seconds=60) < exp_utc:
-            return _hc_token
-    _hc_login()
-    return _hc_token
-
+def hc_session(pool_size=HC_POOL_SIZE):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class HCClient:
+    """Cliente de HC Gateway: un requests.Session con pool de conexiones
+    (keep-alive), token renovado bajo lock (un solo login aunque lleguen
+    muchos requests juntos) y reintento por 401/403 en un solo lugar."""
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, base, user, password, session=None, pool_size=HC_POOL_SIZE):
+        self.base = base.rstrip("/")
+        self.user = user
+        self.password = password
+        self.session = session or hc_session(pool_size)
+        self._lock = threading.Lock()
+        self._token = None
+        self._expiry = None
+        self.logins = 0
+
+    def _token_fresh(self):
+        if not (self._token and self._expiry):
+            return False
+        return _dt.now(_timezone.utc) + _td(seconds=60) < self._expiry
+
+    def _login(self):
+        if not self.user or not self.password:
+            raise RuntimeError("Faltan HC_USER / HC_PASS en el entorno")
+        try:
+            r = self.session.post(f"{self.base}/api/v2/login",
+                                  json={"username": self.user, "password": self.password},
+                                  timeout=(HC_CONNECT_TIMEOUT_S, 20))
+            r.raise_for_status()
+            data = r.json()
+        except Exception as ex:
+            raise RuntimeError(f"Fallo login HC: {ex}")
+        token = data.get("token")
+        if not token:
+            raise RuntimeError("Login OK pero no vino 'token'")
+        expiry_str = data.get("expiry")
+        self._expiry = _parse_iso_aware_utc(expiry_str) if expiry_str else None
+        self._token = token
+        self.logins += 1
+
+    def token(self, rejected=None):
+        """Token vigente. 'rejected' es un token que el server acaba de rechazar:
+        si otro hilo ya lo reemplazó, no volvemos a loguear."""
+        tok = self._token
+        if tok and tok != rejected and self._token_fresh():
+            return tok
+        with self._lock:
+            if self._token and self._token != rejected and self._token_fresh():
+                return self._token
+            self._login()
+            return self._token
+
+    def post(self, path, payload, timeout=None):
+        """POST autenticado con timeouts por llamada, reintentos con backoff
+        ante errores de red/5xx (acotados por HC_DEADLINE_S) y re-login por 401/403."""
+        timeout = timeout or (HC_CONNECT_TIMEOUT_S, HC_READ_TIMEOUT_S)
+        deadline = time.monotonic() + HC_DEADLINE_S
+        url = f"{self.base}{path}"
+        attempt, relogged = 0, False
+        while True:
+            tok = self.token()
+            try:
+                r = self.session.post(url, json=payload, timeout=timeout,
+                                      headers={"Authorization": f"Bearer {tok}"})
+            except (requests.ConnectionError, requests.Timeout):
+                r = None
+                if attempt >= HC_RETRIES:
+                    raise
+            if r is not None and r.status_code in (401, 403) and not relogged:
+                relogged = True
+                self.token(rejected=tok)
+                continue
+            if r is not None and (r.status_code not in self.RETRY_STATUS or attempt >= HC_RETRIES):
+                r.raise_for_status()
+                return r.json()
+            backoff = random.uniform(0, min(4.0, 0.5 * (2 ** attempt)))
+            if time.monotonic() + backoff >= deadline:
+                if r is not None:
+                    r.raise_for_status()
+                raise RuntimeError("HC Gateway: sin presupuesto de tiempo para reintentar")
+            attempt += 1
+            time.sleep(backoff)
+
+    def fetch_sleep_sessions(self, q):
+        return self.post("/api/v2/fetch/sleepSession", {"queries": q})
+
+# todas las cuentas comparten el pool de conexiones; cada HCClient tiene su token
+_hc_session = hc_session(max(HC_POOL_SIZE, HC_SYNC_WORKERS))
+hc = HCClient(HC_BASE, HC_USER, HC_PASS, session=_hc_session)
+
+# ===== Cuentas HC por empleado (credenciales cifradas) =====
+# La password se guarda con Fernet (paquete cryptography, opcional: sin él no
+# se pueden cargar cuentas). La clave sale de HUB_SECRET_KEY o, si no está,
+# de data/hub_secret.key, que se genera la primera vez con permisos 0600.
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
+SECRET_KEY_FILE = Path(os.getenv("HUB_SECRET_KEY_FILE", DATA_DIR / "hub_secret.key"))
+
+class SecretBox:
+    def __init__(self, key_file=SECRET_KEY_FILE):
+        self.key_file = Path(key_file)
+        self._fernet = None
+        self._lock = threading.Lock()
+
+    def _load_key(self):
+        key = os.getenv("HUB_SECRET_KEY")
+        if key:
+            return key.encode()
+        try:
+            fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return self.key_file.read_bytes().strip()
+        key = Fernet.generate_key()
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(key)
+        return key
+
+    def _f(self):
+        if Fernet is None:
+            raise RuntimeError("Falta el paquete 'cryptography' para guardar credenciales HC")
+        if self._fernet is None:
+            with self._lock:
+                if self._fernet is None:
+                    self._fernet = Fernet(self._load_key())
+        return self._fernet
+
+    def encrypt(self, text):
+        return self._f().encrypt(text.encode()).decode()
+
+    def decrypt(self, token):
+        return self._f().decrypt(token.encode()).decode()
+
+secret_box = SecretBox()
+
+class HCAccounts:
+    """uid -> HCClient, uno por cuenta (token y re-login independientes).
+    La cuenta global HC_USER/HC_PASS, si está, se sincroniza como HC_UID."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}   # uid -> (updated_at, HCClient)
+
+    def clients(self, uids=None):
+        """{uid: HCClient | Exception}; la excepción (p.ej. clave que no descifra)
+        queda aislada en esa cuenta."""
+        with db() as con:
+            rows = con.execute("SELECT uid, hc_user, hc_pass_enc, updated_at FROM hc_accounts").fetchall()
+        out = {}
+        if HC_USER and HC_PASS:
+            out[HC_UID] = hc
+        with self._lock:
+            for r in rows:
+                cached = self._clients.get(r["uid"])
+                if cached and cached[0] == r["updated_at"]:
+                    out[r["uid"]] = cached[1]
+                    continue
+                try:
+                    client = HCClient(HC_BASE, r["hc_user"], secret_box.decrypt(r["hc_pass_enc"]), session=_hc_session)
+                except Exception as ex:
+                    out[r["uid"]] = ex
+                    continue
+                self._clients[r["uid"]] = (r["updated_at"], client)
+                out[r["uid"]] = client
+        if uids is not None:
+            out = {u: c for u, c in out.items() if u in uids}
+        return out
+
+    def user_for(self, uid):
+        with db() as con:
+            r = con.execute("SELECT hc_user FROM hc_accounts WHERE uid=?", (uid,)).fetchone()
+        return r["hc_user"] if r else None
+
+    def save(self, uid, user, password=None):
+        """password=None conserva la guardada."""
+        now = _dt.now(_timezone.utc).isoformat(timespec="microseconds")
+        with db() as con:
+            if password is None:
+                cur = con.execute("UPDATE hc_accounts SET hc_user=?, updated_at=? WHERE uid=?", (user, now, uid))
+                if not cur.rowcount:
+                    raise ValueError("Falta la contraseña")
+                return
+            con.execute("""INSERT INTO hc_accounts(uid,hc_user,hc_pass_enc,updated_at) VALUES(?,?,?,?)
+                           ON CONFLICT(uid) DO UPDATE SET hc_user=excluded.hc_user,
+                             hc_pass_enc=excluded.hc_pass_enc, updated_at=excluded.updated_at""",
+                        (uid, user, secret_box.encrypt(password), now))
+
+    def delete(self, uid):
+        with db() as con:
+            con.execute("DELETE FROM hc_accounts WHERE uid=?", (uid,))
+            con.execute("DELETE FROM sleep_sessions WHERE uid=?", (uid,))
+            con.execute("DELETE FROM sleep_days WHERE uid=?", (uid,))
+            con.execute("DELETE FROM sync_state WHERE key IN (?,?,?)",
+                        tuple(_acct_key(k, uid) for k in ("sleep_watermark", "sleep_last_sync", "sleep_last_error")))
+        with self._lock:
+            self._clients.pop(uid, None)
+
+hc_accounts = HCAccounts()
 
 SLEEP_STAGE_MAP = {0: "siesta/otro", 1: "despierto", 4: "ligero", 5: "profundo", 6: "REM"}
 
-def _dur_minutes(start_iso, end_iso):
-    try:
-        a = _dt.fromisoformat(start_iso.replace("Z","+00:00"))  # aware UTC
-        b = _dt.fromisoformat(end_iso.replace("Z","+00:00"))    # aware UTC
-        return int(max(0, (b - a).total_seconds() // 60))
-    except Exception:
-        return 0
-
-def _summarize_session(sess):
-    start = sess.get("start"); end = sess.get("end")
-    total = _dur_minutes(start, end)
-    per = {}
-    for st in (sess.get("data") or {}).get("stages", []):
-        s = st.get("stage")
-        mins = _dur_minutes(st.get("startTime"), st.get("endTime"))
-        name = SLEEP_STAGE_MAP.get(s, f"etapa_{s}")
-        per[name] = per.get(name, 0) + mins
-    return {"start": start, "end": end, "total_min": total, "per_stage": per}
+# ===== Agregación de sueño vectorizada (NumPy, opcional) =====
+# Misma semántica que _accumulate_stage_minutes_per_day pero sobre arrays; es
+# lo que corre _rebuild_sleep_days en cada sincronización. Los timestamps se
+# parsean en bloque a datetime64[us], se pasan a hora de pared local con el
+# offset exacto de tz en cada instante (transiciones de DST buscadas al
+# segundo), se recortan a la ventana, se parten en las medianoches locales y
+# se suman minutos por (día, etapa). Igual que el código original, la
+# aritmética es en hora de pared (Python resta y compara datetimes con el
+# mismo tzinfo sin mirar el offset) y cada tramo se trunca a minutos por
+# separado. Sin numpy se usa la función original.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_US_PER_MIN = 60_000_000
+_US_PER_DAY = 86_400_000_000
+_EPOCH_UTC = _dt(1970, 1, 1, tzinfo=_timezone.utc)
+
+def _to_us(dt):
+    """datetime aware → µs desde epoch (UTC); naive → µs de pared."""
+    if dt.tzinfo is not None:
+        return (dt - _EPOCH_UTC) // _td(microseconds=1)
+    return (dt - _dt(1970, 1, 1)) // _td(microseconds=1)
+
+def _parse_canonical_us(a):
+    """'YYYY-MM-DDTHH:MM:SSZ' (lo que manda HC Gateway) → (µs UTC, ok), leyendo
+    los dígitos directo de la matriz de code points; fechas inválidas → ok=False."""
+    n = a.shape[0]
+    width = a.dtype.itemsize // 4
+    ok = np.zeros(n, dtype=bool)
+    if width < 20:
+        return np.zeros(n, dtype=np.int64), ok
+    cp = a.view(np.uint32).reshape(n, width)
+    ok = ((cp[:, 4] == 45) & (cp[:, 7] == 45) & (cp[:, 10] == 84) & (cp[:, 13] == 58)
+          & (cp[:, 16] == 58) & (cp[:, 19] == 90))
+    if width > 20:
+        ok &= cp[:, 20] == 0
+    dig = cp[:, :19].astype(np.int32) - 48
+    ok &= ((dig[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] >= 0)
+           & (dig[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] <= 9)).all(axis=1)
+    y = dig[:, 0] * 1000 + dig[:, 1] * 100 + dig[:, 2] * 10 + dig[:, 3]
+    mo = dig[:, 5] * 10 + dig[:, 6]
+    d = dig[:, 8] * 10 + dig[:, 9]
+    h = dig[:, 11] * 10 + dig[:, 12]
+    mi = dig[:, 14] * 10 + dig[:, 15]
+    sec = dig[:, 17] * 10 + dig[:, 18]
+    leap = (y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0))
+    dim = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(mo, 0, 12)] + (leap & (mo == 2))
+    ok &= (y >= 1) & (mo >= 1) & (mo <= 12) & (d >= 1) & (d <= dim) & (h < 24) & (mi < 60) & (sec < 60)
+    # días desde epoch (algoritmo days_from_civil)
+    yy = y - (mo <= 2)
+    era = yy // 400
+    yoe = yy - era * 400
+    doy = (153 * (mo + np.where(mo > 2, -3, 9)) + 2) // 5 + d - 1
+    days = (era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468).astype(np.int64)
+    us = ((days * 24 + h) * 60 + mi) * 60 + sec
+    return np.where(ok, us * 1_000_000, 0), ok
+
+def _parse_utc_us(strs):
+    """ISO-8601 → (µs UTC int64, tipo int8: 0 inválido, 1 con zona, 2 sin zona).
+    El formato canónico y los 'Z'/'+00:00' con fracción van vectorizados; el
+    resto uno por uno como antes (sin zona = hora local del sistema)."""
+    n = len(strs)
+    out = np.zeros(n, dtype=np.int64)
+    kind = np.zeros(n, dtype=np.int8)
+    if not n:
+        return out, kind
+    a = np.asarray(strs, dtype=str)
+    out, ok = _parse_canonical_us(a)
+    kind[ok] = 1
+    rest = np.flatnonzero(~ok)
+    if rest.size:
+        r = a[rest]
+        z = np.char.endswith(r, "Z")
+        p = np.char.endswith(r, "+00:00") & ~z
+        for mask, suffix in ((z, "Z"), (p, "+00:00")):
+            idx = rest[mask]
+            if not idx.size:
+                continue
+            try:
+                out[idx] = np.char.replace(a[idx], suffix, "").astype("datetime64[us]").astype(np.int64)
+                kind[idx] = 1
+            except ValueError:
+                pass   # alguno raro: caen al camino lento
+    for i in np.flatnonzero(kind == 0):
+        try:
+            dt = _dt.fromisoformat(str(a[i]).replace("Z", "+00:00"))
+        except Exception:
+            continue
+        out[i] = _to_us(dt.astimezone(_timezone.utc))
+        kind[i] = 1 if dt.tzinfo is not None else 2
+    return out, kind
+
+def _utc_offset_us(tz, t_us):
+    dt = _EPOCH_UTC + _td(microseconds=int(t_us))
+    return dt.astimezone(tz).utcoffset() // _td(microseconds=1)
+
+def _utc_offsets_us(utc_us, tz):
+    """Offset de tz (µs) en cada instante. Muestrea un punto por día y, donde
+    cambia, busca la transición exacta por bisección al segundo."""
+    if not utc_us.size:
+        return np.zeros(0, dtype=np.int64)
+    lo = int(utc_us.min()) // _US_PER_DAY * _US_PER_DAY
+    hi = int(utc_us.max()) // _US_PER_DAY * _US_PER_DAY + _US_PER_DAY
+    bounds, values = [], [_utc_offset_us(tz, lo)]
+    prev_t, prev_off = lo, values[0]
+    for t in range(lo + _US_PER_DAY, hi + 1, _US_PER_DAY):
+        off = _utc_offset_us(tz, t)
+        if off != prev_off:
+            a, b = prev_t // 1_000_000, t // 1_000_000   # segundos: off(a)=prev_off, off(b)=off
+            while b - a > 1:
+                m = (a + b) // 2
+                if _utc_offset_us(tz, m * 1_000_000) == prev_off:
+                    a = m
+                else:
+                    b = m
+            bounds.append(b * 1_000_000)
+            values.append(off)
+        prev_t, prev_off = t, off
+    if not bounds:
+        return np.full(utc_us.shape, values[0], dtype=np.int64)
+    idx = np.searchsorted(np.asarray(bounds, dtype=np.int64), utc_us, side="right")
+    return np.asarray(values, dtype=np.int64)[idx]
+
+def _stage_codes(stages):
+    """Etiqueta de cada etapa → (códigos int, lista de etiquetas)."""
+    labels, code_of, code_of_stage = [], {}, {}
+    for stg in dict.fromkeys(stages):
+        label = SLEEP_STAGE_MAP.get(stg, f"etapa_{stg}")
+        if label not in code_of:
+            code_of[label] = len(labels)
+            labels.append(label)
+        code_of_stage[stg] = code_of[label]
+    return np.fromiter(map(code_of_stage.__getitem__, stages), dtype=np.int64, count=len(stages)), labels
+
+def accumulate_stages_per_day(by_day, stages, tz, win_start_local, win_end_local):
+    """Como llamar _accumulate_stage_minutes_per_day por cada (start_iso,
+    end_iso, stage) de 'stages', en bloque. Acumula sobre by_day y lo devuelve."""
+    stages = [(s, e, stg) for s, e, stg in stages if s and e and stg is not None]
+    if np is None:
+        for s, e, stg in stages:
+            _accumulate_stage_minutes_per_day(by_day, s, e, stg, tz, win_start_local, win_end_local)
+        return by_day
+    if not stages:
+        return by_day
+    s_utc, s_kind = _parse_utc_us([x[0] for x in stages])
+    e_utc, e_kind = _parse_utc_us([x[1] for x in stages])
+    codes, labels = _stage_codes([x[2] for x in stages])
+    keep = (s_kind > 0) & (e_kind > 0) & (e_utc > s_utc)
+    # fuera de la ventana (±1 día, más que cualquier offset) no aporta nada; se
+    # descarta antes de buscar offsets, que recorren el rango día por día
+    lo_utc = _to_us(win_start_local.astimezone(_timezone.utc)) - _US_PER_DAY
+    hi_utc = _to_us(win_end_local.astimezone(_timezone.utc)) + _US_PER_DAY
+    keep &= (e_utc > lo_utc) & (s_utc < hi_utc)
+    s_utc, e_utc, codes = s_utc[keep], e_utc[keep], codes[keep]
+    s_utc = np.maximum(s_utc, lo_utc)
+    e_utc = np.minimum(e_utc, hi_utc)
+
+    # hora de pared local; la ventana también (mismo tzinfo → comparación de pared)
+    both = np.concatenate([s_utc, e_utc])
+    wall = both + _utc_offsets_us(both, tz)
+    s_w, e_w = wall[:s_utc.size], wall[s_utc.size:]
+    ws = _to_us(win_start_local.astimezone(tz).replace(tzinfo=None))
+    we = _to_us(win_end_local.astimezone(tz).replace(tzinfo=None))
+    s_w = np.maximum(s_w, ws)
+    e_w = np.minimum(e_w, we)
+    keep = e_w > s_w
+    s_w, e_w, codes = s_w[keep], e_w[keep], codes[keep]
+    if not s_w.size:
+        return by_day
+
+    # un tramo por cada día local que toca el intervalo
+    d0 = s_w // _US_PER_DAY
+    d1 = (e_w - 1) // _US_PER_DAY
+    nseg = d1 - d0 + 1
+    rep = np.repeat(np.arange(s_w.size), nseg)
+    first = np.repeat(np.cumsum(nseg) - nseg, nseg)
+    day = d0[rep] + (np.arange(rep.size) - first)
+    seg_s = np.maximum(s_w[rep], day * _US_PER_DAY)
+    seg_e = np.minimum(e_w[rep], (day + 1) * _US_PER_DAY)
+    mins = (seg_e - seg_s) // _US_PER_MIN
+    pos = mins > 0
+    day, code, mins = day[pos], codes[rep][pos], mins[pos]
+    if not day.size:
+        return by_day
+
+    # group-by (día, etapa) respetando el orden de primera aparición
+    key = day * len(labels) + code
+    uniq, first_idx, inv = np.unique(key, return_index=True, return_inverse=True)
+    sums = np.bincount(inv.ravel(), weights=mins, minlength=uniq.size).astype(np.int64)
+    day_keys = np.datetime_as_string((uniq // len(labels)).astype("datetime64[D]"))
+    for k in np.argsort(first_idx, kind="stable"):
+        d = by_day.setdefault(str(day_keys[k]), {"total_min": 0, "per_stage": {}})
+        m = int(sums[k])
+        label = labels[int(uniq[k] % len(labels))]
+        d["total_min"] += m
+        d["per_stage"][label] = d["per_stage"].get(label, 0) + m
+    return by_day
 
 def _fmt_local(iso_str, fmt="%Y-%m-%d %H:%M"):
     if not iso_str: return "-"
@@ -302,96 +1118,240 @@ def _local_midnight_range(days=7, include_today=False):
     start_local = (end_local - _td(days=days-1)).replace(hour=0, minute=0, second=0, microsecond=0)
     return start_local, end_local, BA_TZ
 
-def fetch_sleep_last_days(days=7, include_today=False):
-    """Dict por fecha local 'YYYY-MM-DD' -> {'total_min': X, 'per_stage': {...}}."""
-    start_local, end_local, tz = _local_midnight_range(days, include_today=include_today)
+# ===== Sueño local (sleep_days) + sincronización incremental =====
+# Las páginas leen solo de SQLite. Un hilo de fondo trae de HC Gateway, para
+# cada cuenta, las sesiones con inicio >= (watermark - solapamiento), las
+# guarda en sleep_sessions y re-agrega únicamente los días locales que tocan.
+# Las cuentas se sincronizan en paralelo (HC_SYNC_WORKERS); si una falla, su
+# error queda en sync_state y las demás siguen.
+HC_SYNC_INTERVAL_S   = float(os.getenv("HC_SYNC_INTERVAL_S", "300"))   # 0 = sin hilo de fondo
+HC_SYNC_BACKFILL_DAYS = int(os.getenv("HC_SYNC_BACKFILL_DAYS", "30"))
+HC_SYNC_OVERLAP_H    = float(os.getenv("HC_SYNC_OVERLAP_H", "36"))      # sesiones que llegan tarde
+HC_SYNC_LEASE_S      = float(os.getenv("HC_SYNC_LEASE_S", "300"))
+
+_UTC_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+def _state_get(con, key):
+    row = con.execute("SELECT value FROM sync_state WHERE key=?", (key,)).fetchone()
+    return row["value"] if row else None
+
+def _state_set(con, key, value):
+    con.execute("INSERT INTO sync_state(key,value) VALUES(?,?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+
+def _acct_key(name, uid):
+    """Clave de sync_state por cuenta ('' conserva las claves de la cuenta global)."""
+    return f"{name}:{uid}" if uid else name
+
+def _take_sync_lease():
+    """Entre varios workers, solo uno sincroniza a la vez (lease en sync_state).
+    Devuelve el valor guardado (vencimiento + pid), que identifica al dueño, o None."""
+    now = time.time()
+    lease = f"{now + HC_SYNC_LEASE_S:.6f} {os.getpid()}"
+    with db() as con:
+        cur = con.execute("""INSERT INTO sync_state(key,value) VALUES('sleep_lease', ?)
+                             ON CONFLICT(key) DO UPDATE SET value=excluded.value
+                             WHERE CAST(sync_state.value AS REAL) < ?""",
+                          (lease, now))
+        return lease if cur.rowcount > 0 else None
+
+def _release_sync_lease(lease):
+    """Libera el lease solo si sigue siendo nuestro: si venció y lo tomó otro
+    worker, no se lo pisamos."""
+    with db() as con:
+        con.execute("UPDATE sync_state SET value='0' WHERE key='sleep_lease' AND value=?", (lease,))
+
+def _local_days_between(start_local, end_local):
+    out = []
+    cur = start_local.replace(hour=0, minute=0, second=0, microsecond=0)
+    while cur < end_local:
+        out.append(cur.strftime("%Y-%m-%d"))
+        cur = (cur + _td(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return out
 
-    def to_utc(dt_local): return dt_local.astimezone(_timezone.utc)
-    q = {
-        "start": {"$gte": to_utc(start_local).strftime("%Y-%m-%dT%H:%M:%SZ")},
-        "end":   {"$lte": to_utc(end_local).strftime("%Y-%m-%dT%H:%M:%SZ")}
-    }
+def _rebuild_sleep_days(con, uid, day_keys):
+    """Re-agrega sleep_days de una cuenta para las fechas dadas desde sleep_sessions."""
+    if not day_keys:
+        return
+    win_start = _dt.strptime(min(day_keys), "%Y-%m-%d").replace(tzinfo=BA_TZ)
+    win_end = (_dt.strptime(max(day_keys), "%Y-%m-%d") + _td(days=1)).replace(tzinfo=BA_TZ)
+    rows = con.execute("SELECT data_json FROM sleep_sessions WHERE uid = ? AND start < ? AND end > ?",
+                       (uid, win_end.astimezone(_timezone.utc).strftime(_UTC_FMT),
+                        win_start.astimezone(_timezone.utc).strftime(_UTC_FMT))).fetchall()
+    by_day = accumulate_stages_per_day(
+        {}, ((st.get("startTime"), st.get("endTime"), st.get("stage"))
+             for r in rows for st in json.loads(r["data_json"] or "[]")),
+        BA_TZ, win_start, win_end)
+    now = _dt.now(_timezone.utc).strftime(_UTC_FMT)
+    for k in day_keys:
+        agg = by_day.get(k, {"total_min": 0, "per_stage": {}})
+        con.execute("""INSERT INTO sleep_days(uid,day,total_min,per_stage_json,updated_at) VALUES(?,?,?,?,?)
+                       ON CONFLICT(uid,day) DO UPDATE SET total_min=excluded.total_min,
+                         per_stage_json=excluded.per_stage_json, updated_at=excluded.updated_at""",
+                    (uid, k, agg["total_min"], json.dumps(agg["per_stage"], ensure_ascii=False), now))
+
+def _sync_account(uid, client, full=False):
+    """Sincroniza una cuenta. Devuelve cuántas sesiones procesó."""
+    now_utc = _dt.now(_timezone.utc)
+    with db() as con:
+        wm = None if full else _state_get(con, _acct_key("sleep_watermark", uid))
+    wm_dt = _parse_iso_aware_utc(wm) if wm else None
+    since = (wm_dt - _td(hours=HC_SYNC_OVERLAP_H)) if wm_dt else now_utc - _td(days=HC_SYNC_BACKFILL_DAYS)
+    data = client.fetch_sleep_sessions({"start": {"$gte": since.strftime(_UTC_FMT)}})
 
-    tok = _hc_get_token()
-    url = f"{HC_BASE}/api/v2/fetch/sleepSession"
-    headers = {"Authorization": f"Bearer {tok}", "Content-Type": "application/json"}
-    r = requests.post(url, headers=headers, json={"queries": q}, timeout=30)
-    if r.status_code in (401, 403):
-        _hc_login()
-        headers["Authorization"] = f"Bearer {_hc_token}"
-        r = requests.post(url, headers=headers, json={"queries": q}, timeout=30)
-    r.raise_for_status()
-    data = r.json()
-
-    by_day = {}
-    # Partimos CADA ETAPA por días y acumulamos
-    for sess in data:
-        stages = ((sess.get("data") or {}).get("stages") or [])
-        for st in stages:
-            s = st.get("startTime"); e = st.get("endTime"); stage = st.get("stage")
-            if not (s and e) or stage is None:
+    affected = set()
+    max_start = wm_dt
+    with db() as con:
+        for sess in data:
+            s_utc = _parse_iso_aware_utc(sess.get("start") or "")
+            e_utc = _parse_iso_aware_utc(sess.get("end") or "")
+            if not s_utc or not e_utc:
                 continue
-            _accumulate_stage_minutes_per_day(by_day, s, e, stage, tz, start_local, end_local)
+            sid = str(sess.get("_id") or sess.get("id") or s_utc.strftime(_UTC_FMT))
+            stages = (sess.get("data") or {}).get("stages") or []
+            con.execute("""INSERT INTO sleep_sessions(uid,id,start,end,data_json,fetched_at) VALUES(?,?,?,?,?,?)
+                           ON CONFLICT(uid,id) DO UPDATE SET start=excluded.start, end=excluded.end,
+                             data_json=excluded.data_json, fetched_at=excluded.fetched_at""",
+                        (uid, sid, s_utc.strftime(_UTC_FMT), e_utc.strftime(_UTC_FMT),
+                         json.dumps(stages, ensure_ascii=False), now_utc.strftime(_UTC_FMT)))
+            affected.update(_local_days_between(s_utc.astimezone(BA_TZ), e_utc.astimezone(BA_TZ)))
+            if max_start is None or s_utc > max_start:
+                max_start = s_utc
+        _rebuild_sleep_days(con, uid, sorted(affected))
+        if max_start:
+            _state_set(con, _acct_key("sleep_watermark", uid), max_start.strftime(_UTC_FMT))
+        _state_set(con, _acct_key("sleep_last_sync", uid), now_utc.strftime(_UTC_FMT))
+        _state_set(con, _acct_key("sleep_last_error", uid), "")
+    return len(data)
+
+def _sync_account_isolated(uid, client, full):
+    try:
+        if isinstance(client, Exception):
+            raise client
+        return _sync_account(uid, client, full)
+    except Exception as ex:
+        count_error(f"hc_sync_{type(ex).__name__}")
+        with db() as con:
+            _state_set(con, _acct_key("sleep_last_error", uid),
+                       f"{_dt.now(_timezone.utc).strftime(_UTC_FMT)} {type(ex).__name__}: {ex}")
+        return None
+
+def sync_sleep(full=False, uids=None):
+    """Trae sesiones nuevas de HC para todas las cuentas (o las de 'uids') y
+    actualiza sleep_days. Devuelve {uid: sesiones procesadas, o None si esa
+    cuenta falló}; None si otro worker ya estaba sincronizando."""
+    lease = _take_sync_lease()
+    if lease is None:
+        return None
+    try:
+        clients = hc_accounts.clients(uids)
+        results = {}
+        if clients:
+            workers = max(1, min(HC_SYNC_WORKERS, len(clients)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hc-sync") as ex:
+                futs = {uid: ex.submit(_sync_account_isolated, uid, c, full) for uid, c in clients.items()}
+                results = {uid: f.result() for uid, f in futs.items()}
+        if uids is None:
+            failed = sum(1 for n in results.values() if n is None)
+            with db() as con:
+                _state_set(con, "sleep_last_sync", _dt.now(_timezone.utc).strftime(_UTC_FMT))
+                _state_set(con, "sleep_last_error", f"{failed} de {len(results)} cuentas con error" if failed else "")
+        return results
+    finally:
+        _release_sync_lease(lease)
+
+def sleep_sync_status(uid=None):
+    """Estado de la última pasada (uid=None) o de una cuenta."""
+    with db() as con:
+        if uid is None:
+            return {"last_sync": _state_get(con, "sleep_last_sync"),
+                    "last_error": _state_get(con, "sleep_last_error") or None}
+        return {"last_sync": _state_get(con, _acct_key("sleep_last_sync", uid)),
+                "last_error": _state_get(con, _acct_key("sleep_last_error", uid)) or None}
+
+def sleep_for_dates_local(date_keys, uid=""):
+    """Agregados de sueño de una cuenta para las fechas locales dadas (0 si no hay datos)."""
+    out = {k: {"total_min": 0, "per_stage": {}} for k in date_keys}
+    if not out:
+        return out
+    keys = list(out)
+    with db() as con:
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            for r in con.execute(f"SELECT day,total_min,per_stage_json FROM sleep_days "
+                                 f"WHERE uid = ? AND day IN ({','.join('?'*len(chunk))})", [uid] + chunk):
+                out[r["day"]] = {"total_min": r["total_min"], "per_stage": json.loads(r["per_stage_json"] or "{}")}
+    return out
 
-    # Completar días sin datos dentro de la ventana
+def sleep_for_pairs_local(pairs):
+    """{(uid, día): {'total_min', 'per_stage'}} solo para los pares que tienen datos."""
     out = {}
-    cur = start_local
-    while cur <= end_local:
-        k = cur.strftime("%Y-%m-%d")
-        out[k] = by_day.get(k, {"total_min": 0, "per_stage": {}})
-        cur += _td(days=1)
+    if not pairs:
+        return out
+    uids = sorted({u for u, _d in pairs})
+    days = [d for _u, d in pairs]
+    with db() as con:
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i+500]
+            for r in con.execute(f"""SELECT uid,day,total_min,per_stage_json FROM sleep_days
+                                     WHERE uid IN ({','.join('?'*len(chunk))}) AND day BETWEEN ? AND ?""",
+                                 chunk + [min(days), max(days)]):
+                if (r["uid"], r["day"]) in pairs:
+                    out[(r["uid"], r["day"])] = {"total_min": r["total_min"],
+                                                 "per_stage": json.loads(r["per_stage_json"] or "{}")}
+    return out
 
-    # Orden descendente (más reciente → más lejano)
+def sleep_last_days_local(days=7, include_today=False, uid=""):
+    """Últimos 'days' días locales de sleep_days de una cuenta (orden descendente)."""
+    start_local, end_local, _tz = _local_midnight_range(days, include_today=include_today)
+    out = sleep_for_dates_local(_local_days_between(start_local, end_local), uid=uid)
     return dict(sorted(out.items(), key=lambda kv: kv[0], reverse=True))
 
-
-def fetch_sleep_for_dates(date_keys):
-    """Obtiene agregados de sueño solo para las fechas locales dadas (YYYY-MM-DD)."""
-    if not date_keys:
-        return {}
-    # Rango mínimo que cubre las fechas pedidas (aware BA)
-    min_k = min(date_keys)
-    max_k = max(date_keys)
-
-    start_local = _dt.strptime(min_k + " 00:00:00", "%Y-%m-%d %H:%M:%S").replace(tzinfo=BA_TZ)
-    end_local   = _dt.strptime(max_k + " 23:59:59", "%Y-%m-%d %H:%M:%S").replace(tzinfo=BA_TZ)
-
-    def to_utc(dt_local): return dt_local.astimezone(_timezone.utc)
-    q = {
-        "start": {"$gte": to_utc(start_local).strftime("%Y-%m-%dT%H:%M:%SZ")},
-        "end":   {"$lte": to_utc(end_local).strftime("%Y-%m-%dT%H:%M:%SZ")}
-    }
-
-    tok = _hc_get_token()
-    url = f"{HC_BASE}/api/v2/fetch/sleepSession"
-    headers = {"Authorization": f"Bearer {tok}", "Content-Type": "application/json"}
-    r = requests.post(url, headers=headers, json={"queries": q}, timeout=30)
-    if r.status_code in (401,403):
-        _hc_login()
-        headers["Authorization"] = f"Bearer {_hc_token}"
-        r = requests.post(url, headers=headers, json={"queries": q}, timeout=30)
-    r.raise_for_status()
-    data = r.json()
-
-    # agrego por día local BA
-    by_day = {}
-    for sess in data:
-        sm = _summarize_session(sess)
+def _sleep_sync_loop():
+    while True:
         try:
-            st = _dt.fromisoformat(sm["start"].replace("Z","+00:00")).astimezone(BA_TZ)
-            dkey = st.strftime("%Y-%m-%d")
+            sync_sleep()
         except Exception:
-            continue
-        day = by_day.setdefault(dkey, {"total_min": 0, "per_stage": {}})
-        day["total_min"] += sm["total_min"]
-        for k, v in sm["per_stage"].items():
-            day["per_stage"][k] = day["per_stage"].get(k, 0) + v
-
-    # solo las fechas pedidas; si falta alguna, total 0
-    out = {}
-    for k in date_keys:
-        out[k] = by_day.get(k, {"total_min": 0, "per_stage": {}})
-    return out
+            pass   # cada cuenta deja su error en sync_state
+        time.sleep(HC_SYNC_INTERVAL_S)
+
+def start_sleep_syncer():
+    """Hilo de sincronización; lo arranca el servidor (__main__ o el post_worker_init
+    de gunicorn.conf.py), no el import: los comandos de mantenimiento y los
+    scripts que importan pc_hub no sincronizan."""
+    if HC_SYNC_INTERVAL_S > 0:
+        threading.Thread(target=_sleep_sync_loop, name="hc-sleep-sync", daemon=True).start()
+
+def _sync_badge(uid=None):
+    st = sleep_sync_status(uid)
+    last = _fmt_local(st["last_sync"]) if st["last_sync"] else "nunca"
+    err = f" <span class='err'>({escape(st['last_error'])})</span>" if st["last_error"] else ""
+    hidden = f"<input type='hidden' name='uid' value='{escape(uid)}'/>" if uid is not None else ""
+    return (f"<form action='{url_for('sleep_resync')}' method='post' style='margin:0'>{hidden}"
+            f"<small class='mono'>Sueño sincronizado: {last}</small>{err} "
+            f"<button type='submit'>Resincronizar</button></form>")
+
+@app.post("/sueno/sync")
+def sleep_resync():
+    full = bool(request.form.get("full"))
+    uid = request.form.get("uid")
+    try:
+        res = sync_sleep(full=full, uids=None if uid is None else {uid})
+        if res is None:
+            flash(("err", "Ya hay una sincronización en curso"))
+        elif not res:
+            flash(("err", "No hay cuentas de HC Gateway configuradas"))
+        else:
+            failed = [u for u, n in res.items() if n is None]
+            sessions = sum(n for n in res.values() if n)
+            msg = f"Sueño sincronizado ({len(res) - len(failed)} cuentas, {sessions} sesiones)"
+            if failed:
+                flash(("err", f"{msg}; fallaron {len(failed)}: {', '.join(u or '(global)' for u in failed[:10])}"))
+            else:
+                flash(("ok", msg))
+    except Exception as ex:
+        flash(("err", f"No se pudo sincronizar: {ex}"))
+    return redirect(request.referrer or url_for("dashboard"))
 
 def _local_day_from_ts(ts_str):
     """Devuelve YYYY-MM-DD (BA) a partir de ts 'YYYY-MM-DD HH:MM:SS'."""
@@ -402,23 +1362,442 @@ def _local_day_from_ts(ts_str):
     except Exception:
         return ts_str.split(" ",1)[0] if ts_str else ""
 
-# ===== Dashboard =====
-@app.get("/")
-def dashboard():
+# ===== Consulta de fichadas (keyset) =====
+# Paginación por cursor sobre id (id < cursor ORDER BY id DESC): cuesta lo
+# mismo en la página 1 que en la 10.000. El rango de fechas se traduce a un
+# rango de ids con idx_records_ts para buscar por la PK; como ts crece con id
+# solo aproximadamente (la cola de ingreso y /tap insertan con algo de atraso),
+# ese rango se ensancha RECORDS_TS_SLACK_S y el filtro exacto es sobre r.ts.
+RECORDS_PAGE_DEFAULT = 50
+RECORDS_PAGE_MAX = 500
+RECORDS_TS_SLACK_S = int(os.getenv("HUB_RECORDS_TS_SLACK_S", "7200"))
+
+class RecordFilters:
+    def __init__(self, args):
+        self.uid = (args.get("uid") or "").strip()
+        self.date_from = (args.get("from") or "").strip()
+        self.date_to = (args.get("to") or "").strip()
+        p = (args.get("pasa") or "").strip()
+        self.pasa = int(p) if p in ("0", "1") else None
+        try:
+            self.cursor = int(args.get("cursor") or 0) or None
+        except ValueError:
+            self.cursor = None
+        try:
+            self.limit = int(args.get("limit") or RECORDS_PAGE_DEFAULT)
+        except ValueError:
+            self.limit = RECORDS_PAGE_DEFAULT
+        self.limit = max(1, min(self.limit, RECORDS_PAGE_MAX))
+        for d in (self.date_from, self.date_to):
+            if d:
+                _dt.strptime(d, "%Y-%m-%d")   # ValueError si viene mal
+
+    def query_args(self, **override):
+        a = {"uid": self.uid, "from": self.date_from, "to": self.date_to,
+             "pasa": "" if self.pasa is None else str(self.pasa), "limit": self.limit}
+        a.update(override)
+        return {k: v for k, v in a.items() if v not in ("", None)}
+
+def _ts_bounds_for_dates(date_from, date_to):
+    """[desde, hasta) como ts 'YYYY-MM-DD HH:MM:SS'; None donde no hay límite."""
+    lo = date_from + " 00:00:00" if date_from else None
+    hi = (_dt.strptime(date_to, "%Y-%m-%d") + _td(days=1)).strftime("%Y-%m-%d 00:00:00") if date_to else None
+    return lo, hi
+
+def _id_bounds_for_dates(con, date_from, date_to):
+    """Rango de ids (pista para la PK) que cubre las fichadas de las fechas,
+    con RECORDS_TS_SLACK_S de margen para las que se insertaron tarde."""
+    ts_lo, ts_hi = _ts_bounds_for_dates(date_from, date_to)
+    slack = _td(seconds=RECORDS_TS_SLACK_S)
+    fmt = "%Y-%m-%d %H:%M:%S"
+    lo = hi = None
+    if ts_lo:
+        r = con.execute("SELECT id FROM records WHERE ts >= ? ORDER BY ts LIMIT 1",
+                        ((_dt.strptime(ts_lo, fmt) - slack).strftime(fmt),)).fetchone()
+        lo = r["id"] if r else float("inf")
+    if ts_hi:
+        r = con.execute("SELECT id FROM records WHERE ts < ? ORDER BY ts DESC LIMIT 1",
+                        ((_dt.strptime(ts_hi, fmt) + slack).strftime(fmt),)).fetchone()
+        hi = r["id"] if r else -1
+    return lo, hi
+
+def _records_where(con, f):
+    """Cláusula WHERE (texto, params) para los filtros; None si el rango de fechas está vacío."""
+    lo, hi = _id_bounds_for_dates(con, f.date_from, f.date_to)
+    if lo == float("inf") or hi == -1:
+        return None
+    where, params = [], []
+    if f.uid:
+        where.append("r.uid = ?"); params.append(f.uid)
+    if f.pasa is not None:
+        where.append("r.pasa = ?"); params.append(f.pasa)
+    ts_lo, ts_hi = _ts_bounds_for_dates(f.date_from, f.date_to)
+    if ts_lo:
+        where.append("r.ts >= ?"); params.append(ts_lo)
+    if ts_hi:
+        where.append("r.ts < ?"); params.append(ts_hi)
+    if lo is not None:
+        where.append("r.id >= ?"); params.append(lo)
+    uppers = [x for x in (None if hi is None else hi + 1, f.cursor) if x is not None]
+    if uppers:
+        where.append("r.id < ?"); params.append(min(uppers))
+    return ("WHERE " + " AND ".join(where)) if where else "", params
+
+def query_records(f):
+    """Devuelve (items, next_cursor) según los filtros."""
     with db() as con:
-        rows = con.execute("SELECT * FROM records ORDER BY id DESC LIMIT 50").fetchall()
+        w = _records_where(con, f)
+        if w is None:
+            return [], None
+        where, params = w
+        sql = f"""
+            SELECT r.id, r.ts, r.uid, r.nombre_tag, r.image_file,
+                   r.required_mask, r.detected_mask, r.pasa, r.photo_quality,
+                   CASE WHEN r.pasa IS NULL THEN r.api_result_json END AS api_result_json,
+                   e.nombre, e.casco, e.lentes, e.guantes
+            FROM records r LEFT JOIN employees e ON e.uid = r.uid
+            {where}
+            ORDER BY r.id DESC LIMIT ?"""
+        rows = con.execute(sql, params + [f.limit + 1]).fetchall()
+
+    items = []
+    for r in rows[:f.limit]:
+        comp = r if r["pasa"] is not None else compute_compliance(r, r["api_result_json"])  # sin análisis (o sin backfill)
+        items.append({
+            "id": r["id"],
+            "ts": r["ts"],
+            "day": _local_day_from_ts(r["ts"] or ""),
+            "uid": r["uid"] or "",
+            "nombre": r["nombre"] or (r["nombre_tag"] or ""),
+            "image_file": r["image_file"],
+            "required": epp_from_mask(comp["required_mask"]),
+            "detected": epp_from_mask(comp["detected_mask"]),
+            "pasa": None if comp["pasa"] is None else bool(comp["pasa"]),
+            "photo_quality": comp["photo_quality"] if r["pasa"] is not None else photo_quality_from_api_result(r["api_result_json"]),
+        })
+    next_cursor = items[-1]["id"] if len(rows) > f.limit else None
+    return items, next_cursor
+
+@app.get("/api/records")
+def api_records():
+    """?uid=&from=YYYY-MM-DD&to=YYYY-MM-DD&pasa=0|1&limit=&cursor=<id>"""
+    try:
+        f = RecordFilters(request.args)
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad date (YYYY-MM-DD)"}), 400
+    with stage("db_query"):
+        items, next_cursor = query_records(f)
+    return jsonify({"ok": True, "items": items, "next_cursor": next_cursor})
+
+# ===== Exportación (streaming) =====
+# Genera NDJSON o CSV leyendo SQLite por tramos: memoria constante y primeros
+# bytes inmediatos aunque se pida un año entero.
+EXPORT_FETCH = 500
+EXPORT_COLUMNS = ["id", "ts", "day", "uid", "nombre", "nombre_tag", "required", "detected", "pasa",
+                  "photo_quality", "image_file", "emp_casco", "emp_lentes", "emp_guantes",
+                  "emp_epp_completo", "emp_bloqueado"]
+EXPORT_SLEEP_COLUMNS = ["sleep_total_min", "sleep_per_stage"]
+
+def _export_rows(f, with_sleep):
+    # por tramos de EXPORT_FETCH filas (keyset sobre r.id), cada uno con su
+    # conexión del pool: un cliente lento no retiene una conexión ni una
+    # transacción de lectura que frene los checkpoints del WAL
     with db() as con:
-        emps = {e["uid"]: e for e in con.execute("SELECT * FROM employees").fetchall()}
-
-    # --- Precalcular sueño por día para las fechas de las fichadas ---
-    days_needed = set()
+        w = _records_where(con, f)
+        if w is None:
+            return
+        last_id = con.execute("SELECT MAX(id) FROM records").fetchone()[0]
+    if last_id is None:
+        return
+    where, params = w
+    where = (where + " AND" if where else "WHERE") + " r.id > ? AND r.id <= ?"
+    sleep_cols = ", s.total_min AS sleep_total_min, s.per_stage_json AS sleep_per_stage" if with_sleep else ""
+    sleep_join = "LEFT JOIN sleep_days s ON s.uid = r.uid AND s.day = substr(r.ts, 1, 10)" if with_sleep else ""
+    sql = f"""
+        SELECT r.id, r.ts, r.uid, r.nombre_tag, r.image_file,
+               r.required_mask, r.detected_mask, r.pasa, r.photo_quality,
+               CASE WHEN r.pasa IS NULL THEN r.api_result_json END AS api_result_json,
+               e.nombre, e.casco, e.lentes, e.guantes, e.epp_completo, e.bloqueado
+               {sleep_cols}
+        FROM records r LEFT JOIN employees e ON e.uid = r.uid
+        {sleep_join}
+        {where}
+        ORDER BY r.id LIMIT ?"""
+    after = 0
+    while True:
+        with db() as con:
+            rows = con.execute(sql, params + [after, last_id, EXPORT_FETCH]).fetchall()
+        if not rows:
+            return
+        after = rows[-1]["id"]
+        for r in rows:
+            comp = r if r["pasa"] is not None else compute_compliance(r, r["api_result_json"])
+            out = {
+                "id": r["id"], "ts": r["ts"], "day": _local_day_from_ts(r["ts"] or ""),
+                "uid": r["uid"] or "", "nombre": r["nombre"] or "", "nombre_tag": r["nombre_tag"] or "",
+                "required": epp_from_mask(comp["required_mask"]),
+                "detected": epp_from_mask(comp["detected_mask"]),
+                "pasa": None if comp["pasa"] is None else bool(comp["pasa"]),
+                "photo_quality": comp["photo_quality"],
+                "image_file": r["image_file"],
+                "emp_casco": r["casco"], "emp_lentes": r["lentes"], "emp_guantes": r["guantes"],
+                "emp_epp_completo": r["epp_completo"], "emp_bloqueado": r["bloqueado"],
+            }
+            if with_sleep:
+                out["sleep_total_min"] = r["sleep_total_min"]
+                out["sleep_per_stage"] = json.loads(r["sleep_per_stage"]) if r["sleep_per_stage"] else None
+            yield out
+
+def _ndjson_stream(rows):
+    buf = []
+    for r in rows:
+        buf.append(json.dumps(r, ensure_ascii=False))
+        if len(buf) >= EXPORT_FETCH:
+            yield "\n".join(buf) + "\n"
+            buf = []
+    if buf:
+        yield "\n".join(buf) + "\n"
+
+def _csv_cell(v):
+    if isinstance(v, list):
+        return ", ".join(v)
+    if isinstance(v, dict):
+        return json.dumps(v, ensure_ascii=False)
+    return "" if v is None else v
+
+def _csv_stream(rows, columns):
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(columns)
+    yield out.getvalue()   # la cabecera sale antes de la primera consulta
+    out.seek(0); out.truncate()
+    n = 0
     for r in rows:
-        if r["ts"]:
-            days_needed.add(_local_day_from_ts(r["ts"]))
-    sleep_by_day = fetch_sleep_for_dates(days_needed) if days_needed else {}
+        w.writerow([_csv_cell(r[c]) for c in columns])
+        n += 1
+        if n >= EXPORT_FETCH:
+            yield out.getvalue()
+            out.seek(0); out.truncate()
+            n = 0
+    yield out.getvalue()
+
+@app.get("/export/records")
+def export_records():
+    """?format=ndjson|csv&uid=&from=YYYY-MM-DD&to=YYYY-MM-DD&pasa=0|1&sleep=1"""
+    try:
+        f = RecordFilters(request.args)
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad date (YYYY-MM-DD)"}), 400
+    f.cursor = None
+    fmt = (request.args.get("format") or "ndjson").lower()
+    with_sleep = request.args.get("sleep") in ("1", "true", "yes")
+    rows = _export_rows(f, with_sleep)
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    if fmt == "csv":
+        columns = EXPORT_COLUMNS + (EXPORT_SLEEP_COLUMNS if with_sleep else [])
+        body, mimetype, ext = _csv_stream(rows, columns), "text/csv", "csv"
+    elif fmt == "ndjson":
+        body, mimetype, ext = _ndjson_stream(rows), "application/x-ndjson", "ndjson"
+    else:
+        return jsonify({"ok": False, "error": "format must be ndjson or csv"}), 400
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=fichadas_{stamp}.{ext}",
+        "X-Accel-Buffering": "no",
+        "Cache-Control": "no-store",
+    })
+
+# ===== Analítica de cumplimiento =====
+# Todo sale de compliance_daily (una fila por día x uid con contadores por
+# ítem): un año con cientos de empleados son decenas de miles de filas, no
+# millones de fichadas.
+SLEEP_BUCKETS = [(0, 360, "< 6 h"), (360, 420, "6–7 h"), (420, 480, "7–8 h"), (480, None, "≥ 8 h")]
+
+def _rate(ok, req):
+    return round(ok / req, 4) if req else None
+
+def _pearson(xs, ys):
+    n = len(xs)
+    if n < 3:
+        return None
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    syy = sum((y - my) ** 2 for y in ys)
+    if not sxx or not syy:
+        return None
+    return round(sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / (sxx * syy) ** 0.5, 4)
+
+def compliance_analytics(date_from=None, date_to=None, uid=None):
+    where, params = [], []
+    if date_from:
+        where.append("c.day >= ?"); params.append(date_from)
+    if date_to:
+        where.append("c.day <= ?"); params.append(date_to)
+    if uid:
+        where.append("c.uid = ?"); params.append(uid)
+    w = ("WHERE " + " AND ".join(where)) if where else ""
+    cols = ["n", "req", "pasa"] + ROLLUP_ITEM_COLS
+    sums = ", ".join(f"SUM(c.{c}) AS {c}" for c in cols)
+    with db() as con:
+        per_emp = [dict(r) for r in con.execute(f"""
+            SELECT c.uid, e.nombre, {sums}
+            FROM compliance_daily c LEFT JOIN employees e ON e.uid = c.uid
+            {w} GROUP BY c.uid""", params)]
+        per_day = [{"day": r["day"], "fichadas": r["n"], "con_requeridos": r["req"], "pasa": r["pasa"],
+                    "rate": _rate(r["pasa"], r["req"]),
+                    "sleep_avg_min": None if r["sleep_avg"] is None else round(r["sleep_avg"])}
+                   for r in con.execute(f"""
+                       SELECT c.day, SUM(c.n) n, SUM(c.req) req, SUM(c.pasa) pasa, AVG(s.total_min) sleep_avg
+                       FROM compliance_daily c
+                       LEFT JOIN sleep_days s ON s.uid = c.uid AND s.day = c.day AND s.total_min > 0
+                       {w} GROUP BY c.day ORDER BY c.day""", params)]
+        # empleado-días con sueño registrado: base de la correlación
+        with_sleep = con.execute(f"""
+            SELECT c.req, c.pasa, s.total_min
+            FROM compliance_daily c JOIN sleep_days s ON s.uid = c.uid AND s.day = c.day
+            {w} {'AND' if w else 'WHERE'} c.req > 0 AND s.total_min > 0""", params).fetchall()
+
+    tot = {c: sum(e[c] for e in per_emp) for c in cols}
+    items = {item: {"req": tot[f"{item}_req"], "det": tot[f"{item}_det"], "ok": tot[f"{item}_ok"],
+                    "rate": _rate(tot[f"{item}_ok"], tot[f"{item}_req"]),
+                    "detection_rate": _rate(tot[f"{item}_det"], tot["n"])}
+             for item in EPP_BITS}
+    employees = [{"uid": e["uid"], "nombre": e["nombre"] or "", "fichadas": e["n"], "con_requeridos": e["req"],
+                  "pasa": e["pasa"], "rate": _rate(e["pasa"], e["req"]),
+                  "items": {item: {"req": e[f"{item}_req"], "ok": e[f"{item}_ok"],
+                                   "rate": _rate(e[f"{item}_ok"], e[f"{item}_req"])}
+                            for item in EPP_BITS if e[f"{item}_req"]}}
+                 for e in per_emp]
+    employees.sort(key=lambda d: (d["rate"] is None, d["rate"] or 0))
+    buckets = []
+    for lo, hi, label in SLEEP_BUCKETS:
+        ds = [d for d in with_sleep if d["total_min"] >= lo and (hi is None or d["total_min"] < hi)]
+        req = sum(d["req"] for d in ds)
+        ok = sum(d["pasa"] for d in ds)
+        buckets.append({"label": label, "employee_days": len(ds), "con_requeridos": req, "pasa": ok,
+                        "rate": _rate(ok, req)})
+    return {
+        "filters": {"from": date_from, "to": date_to, "uid": uid},
+        "totals": {"fichadas": tot["n"], "con_requeridos": tot["req"], "pasa": tot["pasa"],
+                   "rate": _rate(tot["pasa"], tot["req"])},
+        "items": items,
+        "employees": employees,
+        "days": per_day,
+        "sleep": {"employee_days": len(with_sleep),
+                  "pearson_r": _pearson([d["total_min"] for d in with_sleep], [d["pasa"] / d["req"] for d in with_sleep]),
+                  "buckets": buckets},
+    }
 
-    body = """
-    <div class="card"><h3>Últimas fichadas</h3>
+def _analytics_args():
+    a = {k: (request.args.get(k) or "").strip() or None for k in ("from", "to", "uid")}
+    for k in ("from", "to"):
+        if a[k]:
+            _dt.strptime(a[k], "%Y-%m-%d")   # ValueError si viene mal
+    return a
+
+@app.get("/api/analytics")
+def api_analytics():
+    """?from=YYYY-MM-DD&to=YYYY-MM-DD&uid="""
+    try:
+        a = _analytics_args()
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad date (YYYY-MM-DD)"}), 400
+    with stage("analytics"):
+        data = compliance_analytics(a["from"], a["to"], a["uid"])
+    return jsonify({"ok": True, **data})
+
+def _pct(rate):
+    return "-" if rate is None else f"{rate * 100:.1f}%"
+
+@app.get("/analytics")
+def analytics():
+    try:
+        a = _analytics_args()
+    except ValueError:
+        flash(("err", "Fecha inválida (usar YYYY-MM-DD)"))
+        a = {"from": None, "to": None, "uid": None}
+    with stage("analytics"):
+        data = compliance_analytics(a["from"], a["to"], a["uid"])
+    t, sl = data["totals"], data["sleep"]
+    parts = ["""
+    <div class="card">
+    <form method="get" action="%s" class="row" style="align-items:flex-end">
+      <div class="col"><label>UID</label><input type="text" name="uid" value="%s"/></div>
+      <div><label>Desde</label><br><input type="date" name="from" value="%s"/></div>
+      <div><label>Hasta</label><br><input type="date" name="to" value="%s"/></div>
+      <div><button type="submit">Filtrar</button></div>
+    </form>
+    <div class="kv" style="margin-top:12px"><span>Fichadas: %d</span><span>Con EPP requerido: %d</span>
+      <span>Pasan: %d</span><span>Cumplimiento: %s</span></div>
+    </div>
+    """ % (url_for("analytics"), escape(a["uid"] or ""), a["from"] or "", a["to"] or "",
+           t["fichadas"], t["con_requeridos"], t["pasa"], _pct(t["rate"]))]
+
+    parts.append("<div class='card'><h3>Por ítem</h3><table><tr><th>Ítem</th><th>Requerido</th>"
+                 "<th>Cumple</th><th>Cumplimiento</th><th>Detectado (sobre todas)</th></tr>")
+    for k, it in data["items"].items():
+        parts.append(f"<tr><td>{k}</td><td>{it['req']}</td><td>{it['ok']}</td>"
+                     f"<td>{_pct(it['rate'])}</td><td>{_pct(it['detection_rate'])}</td></tr>")
+    parts.append("</table></div>")
+
+    r = sl["pearson_r"]
+    parts.append(f"<div class='card'><h3>Sueño vs cumplimiento</h3>"
+                 f"<p>Empleado-días con sueño registrado: {sl['employee_days']} · correlación (r de Pearson, "
+                 f"minutos de sueño vs cumplimiento del día): {'-' if r is None else r}</p>"
+                 "<table><tr><th>Sueño</th><th>Empleado-días</th><th>Con EPP requerido</th><th>Pasan</th><th>Cumplimiento</th></tr>")
+    for b in sl["buckets"]:
+        parts.append(f"<tr><td>{b['label']}</td><td>{b['employee_days']}</td><td>{b['con_requeridos']}</td>"
+                     f"<td>{b['pasa']}</td><td>{_pct(b['rate'])}</td></tr>")
+    parts.append("</table></div>")
+
+    parts.append("<div class='card'><h3>Por empleado</h3><table><tr><th>UID</th><th>Nombre</th><th>Fichadas</th>"
+                 "<th>Cumplimiento</th><th>casco</th><th>lentes</th><th>guantes</th></tr>")
+    for e in data["employees"]:
+        its = e["items"]
+        cells = "".join(f"<td>{_pct(its[k]['rate']) if k in its else '-'}</td>" for k in ("casco", "lentes", "guantes"))
+        parts.append(f"<tr><td><a href=\"{url_for('analytics', uid=e['uid'], **{k: v for k, v in a.items() if v and k != 'uid'})}\">"
+                     f"{escape(e['uid'])}</a></td><td>{escape(e['nombre'])}</td><td>{e['fichadas']}</td>"
+                     f"<td>{_pct(e['rate'])}</td>{cells}</tr>")
+    if not data["employees"]:
+        parts.append("<tr><td colspan='7'>Sin datos para estos filtros.</td></tr>")
+    parts.append("</table></div>")
+
+    parts.append("<div class='card'><h3>Por día</h3><table><tr><th>Día</th><th>Fichadas</th><th>Pasan</th>"
+                 "<th>Cumplimiento</th><th>Sueño (promedio)</th></tr>")
+    for d in reversed(data["days"]):
+        parts.append(f"<tr><td>{d['day']}</td><td>{d['fichadas']}</td><td>{d['pasa']}</td>"
+                     f"<td>{_pct(d['rate'])}</td><td>{_mins_to_hm(d['sleep_avg_min']) if d['sleep_avg_min'] else '-'}</td></tr>")
+    parts.append("</table></div>")
+    with stage("render"):
+        return render("".join(parts), title="Hub Fichador – Analítica")
+
+# ===== Dashboard =====
+@app.get("/")
+def dashboard():
+    try:
+        f = RecordFilters(request.args)
+    except ValueError:
+        flash(("err", "Fecha inválida (usar YYYY-MM-DD)"))
+        return redirect(url_for("dashboard"))
+    with stage("db_query"):
+        items, next_cursor = query_records(f)
+
+    # --- Sueño de cada empleado en el día de su fichada ---
+    pairs = {(it["uid"], it["day"]) for it in items if it["day"]}
+    with stage("sleep_read"):
+        sleep_by = sleep_for_pairs_local(pairs)
+
+    sel = lambda v: "selected" if f.pasa == v else ""
+    parts = ["""
+    <div class="card"><div class="row"><div class="col"><h3>Últimas fichadas</h3></div><div>%s</div></div>
+    <form method="get" action="%s" class="row" style="align-items:flex-end;margin-bottom:12px">
+      <div class="col"><label>UID</label><input type="text" name="uid" value="%s"/></div>
+      <div><label>Desde</label><br><input type="date" name="from" value="%s"/></div>
+      <div><label>Hasta</label><br><input type="date" name="to" value="%s"/></div>
+      <div><label>¿Pasa?</label><br><select name="pasa">
+        <option value="">Todas</option><option value="1" %s>Sí</option><option value="0" %s>No</option>
+      </select></div>
+      <div><button type="submit">Filtrar</button></div>
+    </form>
     <table>
       <tr>
         <th>Fecha/Hora</th>
@@ -431,64 +1810,405 @@ def dashboard():
         <th>Sueño del día</th>
         <th>¿Pasa?</th>
       </tr>
-    """
-    for r in rows:
-        uid = r["uid"] or ""
-        e = emps.get(uid)
-        nombre = (e["nombre"] if e else "") or (r["nombre_tag"] or "")
-        required = epp_required_from_employee_row(e)
-        detected = epp_detected_from_api_result(r["api_result_json"], HUB_MIN_CONF)
-        def norm(xs): return sorted(set("lentes" if x == "gafas" else x for x in xs))
-        pasa = set(norm(required)).issubset(set(norm(detected))) if required else False
-        img = f'<img class="thumb" src="{url_for("image", name=r["image_file"])}"/>' if r["image_file"] else ""
-        dkey = _local_day_from_ts(r["ts"] or "")
-        sleep_total_min = (sleep_by_day.get(dkey, {}) or {}).get("total_min", 0)
-        sleep_total_hm = _mins_to_hm(sleep_total_min)
-        body += f"""
+    """ % (_sync_badge(), url_for("dashboard"), escape(f.uid), f.date_from, f.date_to, sel(1), sel(0))]
+    for it in items:
+        uid = it["uid"]
+        img = (f'<a href="{url_for("image", name=it["image_file"])}"><img class="thumb" loading="lazy" '
+               f'src="{url_for("thumb", name=it["image_file"])}"/></a>') if it["image_file"] else ""
+        dkey = it["day"]
+        sleep = sleep_by.get((uid, dkey))
+        sleep_total_hm = _mins_to_hm(sleep["total_min"]) if sleep else "-"
+        parts.append(f"""
         <tr>
-          <td>{r['ts']}</td>
+          <td>{it['ts']}</td>
           <td>{dkey}</td>
           <td>{img}</td>
-          <td><a href="{url_for('edit_employee', uid=uid)}">{uid}</a></td>
-          <td>{nombre}</td>
-          <td>{epp_list_to_str(required)}</td>
-          <td>{epp_list_to_str(detected)}</td>
+          <td><a href="{url_for('edit_employee', uid=uid)}">{escape(uid)}</a></td>
+          <td>{escape(it['nombre'])}</td>
+          <td>{epp_list_to_str(it['required'])}</td>
+          <td>{epp_list_to_str(it['detected'])}</td>
           <td>{sleep_total_hm}</td>
-          <td>{'✔️' if pasa else '❌'}</td>
+          <td>{'—' if it['pasa'] is None else '✔️' if it['pasa'] else '❌'}</td>
         </tr>
-        """
-    body += "</table></div>"
-    return render(body, title="Hub Fichador – Dashboard")
-
-@app.get("/images/<name>")
+        """)
+    if not items:
+        parts.append("<tr><td colspan='9'>Sin fichadas para estos filtros.</td></tr>")
+    parts.append("</table>")
+    nav = []
+    if f.cursor:
+        nav.append(f"<a href='{url_for('dashboard', **f.query_args())}'>« Más recientes</a>")
+    if next_cursor:
+        nav.append(f"<a href='{url_for('dashboard', **f.query_args(cursor=next_cursor))}'>Página siguiente »</a>")
+    exp = f.query_args(limit=None)
+    nav.append(f"<span>Exportar: <a href='{url_for('export_records', format='csv', sleep=1, **exp)}'>CSV</a> · "
+               f"<a href='{url_for('export_records', format='ndjson', sleep=1, **exp)}'>NDJSON</a></span>")
+    parts.append(f"<p style='display:flex;gap:16px'>{' '.join(nav)}</p>")
+    parts.append("</div>")
+    body = "".join(parts)
+    with stage("render"):
+        return render(body, title="Hub Fichador – Dashboard")
+
+# ===== Almacén de imágenes (direccionado por contenido) =====
+# Cada foto se guarda como IMG_DIR/ab/cd/<sha256>.jpg: el nombre es el hash,
+# así dos toques en el mismo segundo no se pisan y un reintento de la misma
+# foto no ocupa lugar dos veces. La escritura es atómica (tmp + fsync +
+# rename) y la tabla images lleva la cuenta de referencias desde records.
+# Las fotos viejas (nombre plano YYYYmmdd_HHMMSS_uid.jpg) se siguen sirviendo.
+IMAGE_RETENTION_DAYS = int(os.getenv("HUB_IMAGE_RETENTION_DAYS", "0"))   # 0 = conservar siempre
+IMAGE_FSYNC = os.getenv("HUB_IMAGE_FSYNC", "1") == "1"
+_TMP_DIR = IMG_DIR / "tmp"
+
+class ImageStore:
+    def __init__(self, root, fsync=IMAGE_FSYNC):
+        self.root = Path(root)
+        self.fsync = fsync
+
+    @staticmethod
+    def relpath(sha, ext=".jpg"):
+        return f"{sha[:2]}/{sha[2:4]}/{sha}{ext}"
+
+    def put(self, stream):
+        """Copia 'stream' al almacén. Devuelve (relpath, sha256, tamaño, es_nueva)."""
+        _TMP_DIR.mkdir(parents=True, exist_ok=True)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=_TMP_DIR, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: stream.read(64 * 1024), b""):
+                    h.update(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+                out.flush()
+                if self.fsync:
+                    os.fsync(out.fileno())
+            sha = h.hexdigest()
+            rel = self.relpath(sha)
+            dst = self.root / rel
+            if dst.exists():
+                os.unlink(tmp)
+                return rel, sha, size, False
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, dst)
+            if self.fsync:
+                _fsync_dir(dst.parent)
+            return rel, sha, size, True
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def delete(self, rel):
+        for p in (self.root / rel, THUMB_DIR / thumb_name(rel)):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+image_store = ImageStore(IMG_DIR)
+
+def image_ref(con, rel, sha, size):
+    con.execute("""INSERT INTO images(path,sha256,size,refcount,created_at) VALUES(?,?,?,1,?)
+                   ON CONFLICT(path) DO UPDATE SET refcount=refcount+1""",
+                (rel, sha, size, datetime.datetime.now().isoformat(timespec="seconds")))
+
+def image_unref(con, rel):
+    """Resta una referencia; devuelve True si el archivo quedó sin uso."""
+    row = con.execute("SELECT refcount FROM images WHERE path=?", (rel,)).fetchone()
+    if row is None:   # foto vieja sin registrar: se libera si ningún otro record la usa
+        return con.execute("SELECT 1 FROM records WHERE image_file=? LIMIT 1", (rel,)).fetchone() is None
+    if row["refcount"] <= 1:
+        con.execute("DELETE FROM images WHERE path=?", (rel,))
+        return True
+    con.execute("UPDATE images SET refcount=refcount-1 WHERE path=?", (rel,))
+    return False
+
+# ===== Imágenes y miniaturas =====
+# Las fotos no cambian una vez guardadas: se sirven con Cache-Control
+# immutable + ETag (send_file responde 304 a If-None-Match/If-Modified-Since).
+# Pillow es opcional: sin él /thumbs sirve el original.
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:
+    PILImage = None
+
+THUMB_HEIGHT  = int(os.getenv("HUB_THUMB_HEIGHT", "128"))    # 2x los 64px del dashboard
+THUMB_FORMAT  = os.getenv("HUB_THUMB_FORMAT", "webp").lower()  # webp | jpeg
+THUMB_QUALITY = int(os.getenv("HUB_THUMB_QUALITY", "70"))
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+def thumb_name(image_file):
+    """Ruta relativa (mismo subdirectorio que el original) de la miniatura."""
+    return Path(image_file).with_suffix(".webp" if THUMB_FORMAT == "webp" else ".jpg").as_posix()
+
+def make_thumbnail(image_file):
+    """Genera (si falta) la miniatura de IMG_DIR/image_file. Devuelve su ruta relativa o None."""
+    if PILImage is None:
+        return None
+    src = IMG_DIR / image_file
+    dst = THUMB_DIR / thumb_name(image_file)
+    if dst.exists():
+        return thumb_name(image_file)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    with PILImage.open(src) as im:
+        im.draft("RGB", (THUMB_HEIGHT * 4, THUMB_HEIGHT))   # decodificación reducida para JPEG
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        im.thumbnail((THUMB_HEIGHT * 4, THUMB_HEIGHT))
+        # temporal único: dos ingresos de la misma foto (o un /thumbs que falla
+        # mientras tanto) no se pisan; el último os.replace gana
+        fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix=dst.name + ".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                if THUMB_FORMAT == "webp":
+                    im.save(out, format="WEBP", quality=THUMB_QUALITY, method=4)
+                else:
+                    im.save(out, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+    return thumb_name(image_file)
+
+def _immutable(resp):
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMAGE_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+@app.get("/images/<path:name>")
 def image(name):
-    return send_from_directory(IMG_DIR, name)
+    return _immutable(send_from_directory(IMG_DIR, name, max_age=IMAGE_MAX_AGE, conditional=True, etag=True))
+
+@app.get("/thumbs/<path:name>")
+def thumb(name):
+    """Miniatura de la imagen original 'name'; si falta se genera en el momento."""
+    try:
+        src = safe_join(str(IMG_DIR), name)
+        tname = make_thumbnail(name) if src and os.path.isfile(src) else None
+    except Exception as ex:
+        count_error(f"thumb_{type(ex).__name__}")
+        tname = None
+    if not tname:
+        # el original sirve de respaldo pero no se fija: backfill-thumbs puede repararlo
+        resp = send_from_directory(IMG_DIR, name, conditional=True, etag=True)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+    return _immutable(send_from_directory(THUMB_DIR, tname, max_age=IMAGE_MAX_AGE, conditional=True, etag=True))
+
+# ===== Cache del padrón =====
+# Los kioscos consultan el padrón en cada apoyo: se sirve desde memoria. Cada
+# cambio a employees sube employees.version (MAX+1 dentro del mismo UPDATE, así
+# que es monótona aunque haya varios procesos); el cache trae sólo las filas
+# con version mayor a la que ya tiene. Los cambios hechos en este proceso se
+# ven al instante (invalidate); los de otro proceso, a lo sumo en TTL segundos.
+EMP_CACHE_TTL_S = float(os.getenv("HUB_EMP_CACHE_TTL_S", "2"))
+ROSTER_NEXT_VERSION = "(SELECT IFNULL(MAX(version), 0) + 1 FROM employees)"
+
+class EmployeeCache:
+    def __init__(self, ttl_s=EMP_CACHE_TTL_S):
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._snap = (0, {})   # (versión, uid -> fila); se reemplaza entero
+        self._checked_at = 0.0
+        self._dirty = True
+
+    @property
+    def version(self):
+        return self._snap[0]
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _fresh(self):
+        return not self._dirty and time.monotonic() - self._checked_at < self.ttl_s
+
+    def _refresh(self):
+        if self._fresh():
+            return
+        with self._lock:
+            if self._fresh():
+                return
+            self._dirty = False
+            version, by_uid = self._snap
+            with db() as con:
+                rows = con.execute("SELECT * FROM employees WHERE version > ? ORDER BY version",
+                                   (version,)).fetchall()
+                if not rows and version and not con.execute(
+                        "SELECT 1 FROM employees WHERE version = ?", (version,)).fetchone():
+                    # la base retrocedió (restore): recargar todo
+                    version, by_uid = 0, {}
+                    rows = con.execute("SELECT * FROM employees ORDER BY version").fetchall()
+            if rows:
+                by_uid = dict(by_uid)
+                for r in rows:
+                    by_uid[r["uid"]] = dict(r)
+                self._snap = (rows[-1]["version"], by_uid)
+            self._checked_at = time.monotonic()
+
+    def get(self, uid):
+        self._refresh()
+        return self._snap[1].get(uid)
+
+    def delta(self, since):
+        """(versión, completo, filas con version > since)."""
+        self._refresh()
+        version, by_uid = self._snap
+        full = not since or since > version
+        rows = sorted((e for e in by_uid.values() if full or e["version"] > since), key=lambda e: e["version"])
+        return version, full, rows
+
+employee_cache = EmployeeCache()
 
 # ===== Empleados =====
+# Búsqueda por FTS5 (prefijo de uid o de cualquier palabra del nombre) y
+# paginación por cursor sobre (updated_at, uid), así el costo de una página
+# no depende del tamaño del padrón.
+EMP_PAGE_DEFAULT = 50
+EMP_PAGE_MAX = 500
+EMP_EPP_ITEMS = ("casco", "lentes", "guantes")
+EMP_TRISTATE = {"completo": "epp_completo", "bloqueado": "bloqueado", "rewrite": "force_rewrite"}
+
+with db() as _con:
+    EMP_FTS = _con.execute("SELECT 1 FROM sqlite_master WHERE name='employees_fts'").fetchone() is not None
+
+class EmployeeFilters:
+    def __init__(self, args):
+        self.q = (args.get("q") or "").strip()
+        self.epp = [x for x in EMP_EPP_ITEMS if x in args.getlist("epp")]
+        self.flags = {}
+        for name in EMP_TRISTATE:
+            v = (args.get(name) or "").strip()
+            if v in ("0", "1"):
+                self.flags[name] = int(v)
+        upd, sep, uid = (args.get("cursor") or "").partition("|")
+        self.cursor = (upd, uid) if sep else None
+        try:
+            self.limit = int(args.get("limit") or EMP_PAGE_DEFAULT)
+        except ValueError:
+            self.limit = EMP_PAGE_DEFAULT
+        self.limit = max(1, min(self.limit, EMP_PAGE_MAX))
+
+    def query_args(self, **override):
+        a = {"q": self.q, "epp": self.epp or None, "limit": self.limit,
+             **{k: str(v) for k, v in self.flags.items()}}
+        a.update(override)
+        return {k: v for k, v in a.items() if v not in ("", None)}
+
+def _fts_query(q):
+    """'ana góm' → '"ana"* AND "góm"*': cada término como prefijo."""
+    terms = [t.replace('"', '""') for t in q.split() if any(ch.isalnum() for ch in t)]
+    return " AND ".join(f'"{t}"*' for t in terms)
+
+def _employees_where(f):
+    """(join, where, params) para los filtros, sin el cursor."""
+    join, where, params = "", [], []
+    if f.q:
+        if EMP_FTS:
+            match = _fts_query(f.q)
+            if match:   # sólo signos de puntuación: no hay nada que buscar
+                join = "JOIN employees_fts ON employees_fts.rowid = e.id"
+                where.append("employees_fts MATCH ?"); params.append(match)
+        else:
+            like = "%" + f.q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where.append("(e.uid LIKE ? ESCAPE '\\' OR e.nombre LIKE ? ESCAPE '\\')"); params += [like, like]
+    for item in f.epp:
+        where.append(f"e.{item} != 0")
+    for name, on in f.flags.items():
+        # "!= 0" tal cual: así SQLite usa los índices parciales de bloqueado/force_rewrite
+        where.append(f"e.{EMP_TRISTATE[name]} {'!=' if on else '='} 0")
+    return join, where, params
+
+def query_employees(f):
+    """Devuelve (filas, total, next_cursor)."""
+    join, where, params = _employees_where(f)
+    cond = ("WHERE " + " AND ".join(where)) if where else ""
+    # el "<=" sobre la primera columna es lo que le permite a SQLite buscar por rango en el índice
+    page_where = where + (["IFNULL(e.updated_at,'') <= ? AND (IFNULL(e.updated_at,''), e.uid) < (?, ?)"]
+                          if f.cursor else [])
+    page_cond = ("WHERE " + " AND ".join(page_where)) if page_where else ""
+    with db() as con:
+        total = con.execute(f"SELECT COUNT(*) FROM employees e {join} {cond}", params).fetchone()[0]
+        rows = con.execute(f"""SELECT e.* FROM employees e {join} {page_cond}
+                               ORDER BY IFNULL(e.updated_at,'') DESC, e.uid DESC LIMIT ?""",
+                           params + ([f.cursor[0], *f.cursor] if f.cursor else []) + [f.limit + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > f.limit:
+        last = rows[f.limit - 1]
+        next_cursor = f"{last['updated_at'] or ''}|{last['uid']}"
+    return rows[:f.limit], total, next_cursor
+
+@app.get("/api/employees")
+def api_employees():
+    """?q=&epp=casco&epp=lentes&completo=0|1&bloqueado=0|1&rewrite=0|1&limit=&cursor="""
+    f = EmployeeFilters(request.args)
+    with stage("db_query"):
+        rows, total, next_cursor = query_employees(f)
+    items = [{k: e[k] for k in ("uid", "nombre", "casco", "lentes", "guantes", "epp_completo",
+                                "bloqueado", "force_rewrite", "updated_at")} for e in rows]
+    return jsonify({"ok": True, "items": items, "total": total, "next_cursor": next_cursor})
+
 @app.get("/empleados")
 def employees():
-    with db() as con:
-        rows = con.execute("SELECT * FROM employees ORDER BY updated_at DESC NULLS LAST").fetchall()
-    body = """
+    f = EmployeeFilters(request.args)
+    with stage("db_query"):
+        rows, total, next_cursor = query_employees(f)
+    chk = lambda x: "checked" if x in f.epp else ""
+    def tri(name, label, yes="Sí", no="No"):
+        v = f.flags.get(name)
+        return (f"<div><label>{label}</label><br><select name='{name}'><option value=''>Todos</option>"
+                f"<option value='1' {'selected' if v == 1 else ''}>{yes}</option>"
+                f"<option value='0' {'selected' if v == 0 else ''}>{no}</option></select></div>")
+    parts = ["""
     <div class="card"><div class="row">
-      <div class="col"><h3>Empleados</h3></div>
+      <div class="col"><h3>Empleados <small class="mono">%d</small></h3></div>
       <div><form action="%s" method="get">
         <input type="text" name="uid" placeholder="UID nuevo/editar"/><button type="submit">Abrir</button>
       </form></div></div>
+    <form method="get" action="%s" class="row" style="align-items:flex-end;margin-bottom:12px">
+      <div class="col"><label>Buscar (nombre o UID)</label><input type="text" name="q" value="%s"/></div>
+      <div><label>Requiere</label><br>%s</div>
+      %s%s%s
+      <div><button type="submit">Filtrar</button></div>
+    </form>
       <table><tr><th>UID</th><th>Nombre</th><th>EPP</th><th>Flags</th><th>Rewrite</th><th>Actualizado</th></tr>
-    """ % (url_for("edit_employee"))
+    """ % (total, url_for("edit_employee"), url_for("employees"), escape(f.q),
+           "".join(f"<label class='chk'><input type='checkbox' name='epp' value='{x}' {chk(x)}/> {x}</label>"
+                   for x in EMP_EPP_ITEMS),
+           tri("completo", "EPP completo"), tri("bloqueado", "Bloqueado"),
+           tri("rewrite", "Rewrite", yes="Pendiente", no="-"))]
     for e in rows:
-        epps = []
-        if e["casco"]: epps.append("casco")
-        if e["lentes"]: epps.append("lentes")
-        if e["guantes"]: epps.append("guantes")
+        epps = [x for x in EMP_EPP_ITEMS if e[x]]
         flags = []
         if e["epp_completo"]: flags.append("EPP completo")
         if e["bloqueado"]: flags.append("Bloqueado")
         rw = "pendiente" if e["force_rewrite"] else "-"
-        body += f"<tr><td><a href='{url_for('edit_employee', uid=e['uid'])}'>{e['uid']}</a></td><td>{e['nombre'] or ''}</td><td>{', '.join(epps) if epps else '-'}</td><td>{', '.join(flags) if flags else '-'}</td><td>{rw}</td><td>{e['updated_at'] or ''}</td></tr>"
-    body += "</table></div>"
-    return render(body, title="Hub Fichador – Empleados")
+        parts.append(f"<tr><td><a href='{url_for('edit_employee', uid=e['uid'])}'>{escape(e['uid'])}</a></td>"
+                     f"<td>{escape(e['nombre'] or '')}</td><td>{', '.join(epps) if epps else '-'}</td>"
+                     f"<td>{', '.join(flags) if flags else '-'}</td><td>{rw}</td><td>{e['updated_at'] or ''}</td></tr>")
+    if not rows:
+        parts.append("<tr><td colspan='6'>Sin empleados para estos filtros.</td></tr>")
+    parts.append("</table>")
+    nav = []
+    if f.cursor:
+        nav.append(f"<a href='{url_for('employees', **f.query_args())}'>« Primera página</a>")
+    if next_cursor:
+        nav.append(f"<a href='{url_for('employees', **f.query_args(cursor=next_cursor))}'>Página siguiente »</a>")
+    parts.append(f"<p style='display:flex;gap:16px'>{' '.join(nav)}</p></div>")
+    with stage("render"):
+        return render("".join(parts), title="Hub Fichador – Empleados")
 
 @app.get("/empleados/editar")
 def edit_employee():
@@ -508,9 +2228,29 @@ def edit_employee():
         "force": bool(e["force_rewrite"]) if e else False
     }
 
+    # ---- Cuenta HC Gateway del empleado ----
+    hc_user = hc_accounts.user_for(uid)
+    has_sleep = hc_user is not None or (uid == HC_UID and HC_USER and HC_PASS)
+    hc_html = """
+    <div class="card"><h3>Cuenta HC Gateway</h3>
+    <form action="%s" method="post">
+      <input type="hidden" name="uid" value="%s"/>
+      <div class="row">
+        <div class="col"><label>Usuario</label><input type="text" name="hc_user" value="%s"/></div>
+        <div class="col"><label>Contraseña</label><input type="password" name="hc_pass" placeholder="%s" autocomplete="new-password"/></div>
+      </div>
+      <label class="chk"><input type="checkbox" name="delete"> Quitar cuenta (borra su sueño guardado)</label>
+      <div style="margin-top:12px"><button type="submit">Guardar cuenta</button></div>
+    </form></div>
+    """ % (url_for("save_hc_account"), escape(uid), escape(hc_user or ""),
+           "sin cambios" if hc_user else "")
+
     # ---- Sueño: últimos 7 días (INCLUYENDO HOY), orden descendente ----
     try:
-        series = fetch_sleep_last_days(days=7, include_today=True)
+        if not has_sleep:
+            raise LookupError("el empleado no tiene cuenta de HC Gateway")
+        with stage("sleep_read"):
+            series = sleep_last_days_local(days=7, include_today=True, uid=uid)
         rows = ""
         order = ["REM", "profundo", "ligero", "despierto", "siesta/otro"]
         for day, agg in series.items():  # ya viene ordenado desc
@@ -527,14 +2267,17 @@ def edit_employee():
             rows = "<tr><td colspan='3'>Sin datos en el período.</td></tr>"
         sleep_html = f"""
         <div class="card">
-          <h3>Sueño – Últimos 7 días (incluye hoy)</h3>
+          <div class="row"><div class="col"><h3>Sueño – Últimos 7 días (incluye hoy)</h3></div><div>{_sync_badge(uid)}</div></div>
           <table>
             <tr><th>Fecha</th><th>Total</th><th>Etapas</th></tr>
             {rows}
           </table>
         </div>
         """
+    except LookupError as ex:
+        sleep_html = f"<div class='card'><h3>Sueño – Últimos 7 días</h3><p>Sin datos: {ex}.</p></div>"
     except Exception as ex:
+        count_error(f"hc_{type(ex).__name__}")
         sleep_html = f"<div class='card'><h3>Sueño – Últimos 7 días</h3><p class='err'>No se pudo obtener: {ex}</p></div>"
 
     # ---- Form empleado ----
@@ -568,8 +2311,9 @@ def edit_employee():
         url_for("employees")
     )
 
-    body += sleep_html
-    return render(body, title=f"Empleado {uid}")
+    body += sleep_html + hc_html
+    with stage("render"):
+        return render(body, title=f"Empleado {uid}")
 
 @app.post("/empleados/guardar")
 def save_employee():
@@ -586,25 +2330,48 @@ def save_employee():
         return redirect(url_for("employees"))
     now = datetime.datetime.now().isoformat(timespec="seconds")
     with db() as con:
-        con.execute("""INSERT INTO employees(uid,nombre,casco,lentes,guantes,epp_completo,bloqueado,force_rewrite,updated_at)
-                       VALUES(?,?,?,?,?,?,?,?,?)
+        con.execute(f"""INSERT INTO employees(uid,nombre,casco,lentes,guantes,epp_completo,bloqueado,force_rewrite,updated_at,version)
+                       VALUES(?,?,?,?,?,?,?,?,?,{ROSTER_NEXT_VERSION})
                        ON CONFLICT(uid) DO UPDATE SET
                          nombre=excluded.nombre, casco=excluded.casco, lentes=excluded.lentes,
                          guantes=excluded.guantes, epp_completo=excluded.epp_completo,
                          bloqueado=excluded.bloqueado, force_rewrite=excluded.force_rewrite,
-                         updated_at=excluded.updated_at
+                         updated_at=excluded.updated_at, version=excluded.version
                     """, (uid,nombre,casco,lentes,guantes,eppc,bloq,force,now))
+    employee_cache.invalidate()
     flash(("ok","Empleado guardado"))
     return redirect(url_for("edit_employee", uid=uid))
 
+@app.post("/empleados/hc")
+def save_hc_account():
+    uid = (request.form.get("uid") or "").strip()
+    hc_user = (request.form.get("hc_user") or "").strip()
+    hc_pass = request.form.get("hc_pass") or None
+    if not uid:
+        flash(("err","UID requerido"))
+        return redirect(url_for("employees"))
+    try:
+        if request.form.get("delete"):
+            hc_accounts.delete(uid)
+            flash(("ok","Cuenta HC quitada"))
+        elif not hc_user:
+            flash(("err","Falta el usuario de HC Gateway"))
+        else:
+            hc_accounts.save(uid, hc_user, hc_pass)
+            # primera sincronización de esta cuenta en segundo plano
+            threading.Thread(target=sync_sleep, kwargs={"uids": {uid}}, daemon=True).start()
+            flash(("ok","Cuenta HC guardada; sincronizando sueño"))
+    except (ValueError, RuntimeError) as ex:
+        flash(("err", str(ex)))
+    return redirect(url_for("edit_employee", uid=uid))
+
 # ===== APIs para Raspberry =====
 @app.post("/should_rewrite")
 def should_rewrite():
     uid = (request.form.get("uid") or (request.json.get("uid") if request.is_json else "") or "").strip()
     if not uid:
         return jsonify({"ok": False, "error": "uid missing"}), 400
-    with db() as con:
-        e = con.execute("SELECT * FROM employees WHERE uid=?", (uid,)).fetchone()
+    e = employee_cache.get(uid)
     if not e:
         return jsonify({"ok": True, "rewrite": False})
     if e["force_rewrite"]:
@@ -618,9 +2385,200 @@ def rewrite_done():
         return jsonify({"ok": False, "error": "uid missing"}), 400
     now = datetime.datetime.now().isoformat(timespec="seconds")
     with db() as con:
-        con.execute("UPDATE employees SET force_rewrite=0, updated_at=? WHERE uid=?", (now, uid))
+        con.execute(f"""UPDATE employees SET force_rewrite=0, updated_at=?,
+                          version=CASE WHEN force_rewrite != 0 THEN {ROSTER_NEXT_VERSION} ELSE version END
+                        WHERE uid=?""", (now, uid))
+    employee_cache.invalidate()
     return jsonify({"ok": True})
 
+@app.get("/api/employees/delta")
+def employees_delta():
+    """?since=<versión>: empleados cambiados desde esa versión del padrón.
+    since=0 (o una versión que el hub no conoce) devuelve el padrón completo."""
+    try:
+        since = max(0, int(request.args.get("since") or 0))
+    except ValueError:
+        return jsonify({"ok": False, "error": "since must be an integer"}), 400
+    version, full, rows = employee_cache.delta(since)
+    resp = jsonify({
+        "ok": True, "version": version, "full": full,
+        "employees": {e["uid"]: {**desired_payload_from_employee(e), "rw": bool(e["force_rewrite"]), "v": e["version"]}
+                      for e in rows},
+    })
+    resp.set_etag(f"roster-{since}-{version}")
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+# ===== Ingreso: escritura directa o cola con group commit =====
+# HUB_INGEST_MODE=queue: el request termina cuando la foto está en disco y la
+# fila entra a una cola en memoria; un hilo la inserta junto con otras en una
+# sola transacción (cada N filas o cada T ms). HUB_INGEST_DURABLE=1 hace que
+# el request espere el COMMIT de su lote (igual se agrupan las escrituras);
+# con 0 responde apenas encola y una caída puede perder filas aún no escritas.
+INGEST_MODE       = os.getenv("HUB_INGEST_MODE", "sync")   # sync | queue
+INGEST_DURABLE    = os.getenv("HUB_INGEST_DURABLE", "1") == "1"
+INGEST_BATCH_ROWS = int(os.getenv("HUB_INGEST_BATCH_ROWS", "100"))
+INGEST_BATCH_MS   = float(os.getenv("HUB_INGEST_BATCH_MS", "50"))
+INGEST_QUEUE_MAX  = int(os.getenv("HUB_INGEST_QUEUE_MAX", "10000"))
+INGEST_WAIT_S     = float(os.getenv("HUB_INGEST_WAIT_S", "10"))
+
+def insert_record(con, row):
+    """INSERT de una fichada (con cumplimiento calculado) + referencia a su imagen."""
+    e = con.execute("SELECT casco,lentes,guantes FROM employees WHERE uid=?", (row["uid"],)).fetchone()
+    comp = compute_compliance(e, row["api_result"])
+    cur = con.execute("""INSERT INTO records(ts,uid,nombre_tag,epp_tag_json,api_result_json,image_file,
+                                             required_mask,detected_mask,pasa,photo_quality)
+                         VALUES(?,?,?,?,?,?,?,?,?,?)""",
+                      (row["ts"], row["uid"], row["nombre_tag"], json.dumps(row["epp_tag"], ensure_ascii=False),
+                       row["api_result"], row["image_file"],
+                       comp["required_mask"], comp["detected_mask"], comp["pasa"], comp["photo_quality"]))
+    image_ref(con, row["image_file"], row["sha"], row["size"])
+    rollup_add(con, row["ts"], row["uid"], comp)
+    return cur.lastrowid
+
+class _Pending:
+    __slots__ = ("row", "done", "record_id", "error")
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.record_id = None
+        self.error = None
+
+class IngestQueue:
+    _STOP = object()
+
+    def __init__(self, batch_rows=INGEST_BATCH_ROWS, batch_ms=INGEST_BATCH_MS, maxsize=INGEST_QUEUE_MAX):
+        self.batch_rows = batch_rows
+        self.batch_s = batch_ms / 1000.0
+        self._q = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="ingest-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, row):
+        """Encola la fila; lanza queue.Full si la cola está llena."""
+        self.start()
+        p = _Pending(row)
+        self._q.put_nowait(p)
+        return p
+
+    def _loop(self):
+        while True:
+            first = self._q.get()
+            if first is self._STOP:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.batch_s
+            stop = False
+            while len(batch) < self.batch_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stop:
+                self._drain()
+                return
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                batch.append(item)
+        for i in range(0, len(batch), self.batch_rows):
+            self._commit(batch[i:i + self.batch_rows])
+
+    def _commit(self, batch):
+        try:
+            with db() as con:
+                for p in batch:
+                    p.record_id = insert_record(con, p.row)
+        except Exception:
+            # una fila mala no tira el lote: se reintentan de a una
+            count_error("ingest_batch_failed")
+            for p in batch:
+                try:
+                    with db() as con:
+                        p.record_id = insert_record(con, p.row)
+                except Exception as ex:
+                    count_error(f"ingest_{type(ex).__name__}")
+                    p.record_id, p.error = None, ex
+        self.batches += 1
+        self.rows += len(batch)
+        for p in batch:
+            p.done.set()
+
+    def shutdown(self, timeout=30):
+        """Deja de aceptar y escribe todo lo pendiente."""
+        with self._lock:
+            t = self._thread
+        if t is None or not t.is_alive():
+            return
+        self._q.put(self._STOP)
+        t.join(timeout)
+
+ingest_queue = IngestQueue()
+if INGEST_MODE == "queue":
+    atexit.register(ingest_queue.shutdown)
+
+def save_ingest_image(stream):
+    """Guarda la foto (por contenido) y su miniatura → (fname, sha, size)."""
+    with stage("image_save"):
+        fname, sha, size, _new = image_store.put(stream)
+    with stage("thumbnail"):
+        try:
+            make_thumbnail(fname)
+        except Exception as ex:   # /thumbs la regenera si hace falta
+            count_error(f"thumb_{type(ex).__name__}")
+    return fname, sha, size
+
+def persist_record(row):
+    """Escribe la fichada según HUB_INGEST_MODE → (campos para la respuesta, status)."""
+    if retake_from_api_result(row["api_result"]):
+        # foto a repetir: no es una fichada (ni rollup ni referencia a la foto);
+        # el archivo queda huérfano y lo limpia images-retention
+        return {"saved": False}, 200
+    if INGEST_MODE == "queue":
+        try:
+            pending = ingest_queue.submit(row)
+        except queue.Full:
+            count_error("ingest_queue_full")
+            pending = None   # cola llena: escribimos directo (backpressure)
+        if pending is not None:
+            if not INGEST_DURABLE:
+                return {"queued": True}, 200
+            with stage("group_commit_wait"):
+                committed = pending.done.wait(INGEST_WAIT_S)
+            if not committed:
+                return {"queued": True}, 200
+            if pending.error is not None:
+                return {"error": f"db: {pending.error}"}, 500
+            return {"id": pending.record_id}, 200
+
+    with stage("db_insert"):
+        with db() as con:
+            rid = insert_record(con, row)
+    return {"id": rid}, 200
+
 @app.post("/ingreso")
 def ingreso():
     f = request.files.get("image")
@@ -635,15 +2593,221 @@ def ingreso():
         epp_tag = []
     api_result = request.form.get("api_result") or ""
     ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    safe_uid = uid or "nouid"
-    fname = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{safe_uid}.jpg"
-    f.save(IMG_DIR / fname)
+    fname, sha, size = save_ingest_image(f.stream)
+    row = {"ts": ts, "uid": uid, "nombre_tag": nombre_tag, "epp_tag": epp_tag,
+           "api_result": api_result, "image_file": fname, "sha": sha, "size": size}
+    extra, status = persist_record(row)
+    if extra.get("saved") is False:
+        fname = None
+    return jsonify({"ok": status == 200, "saved_image": fname, **extra}), status
+
+# ===== Tap: rewrite + análisis + ingreso en un solo request =====
+# El kiosco manda uid + foto una vez; el hub llama a /analyze del backend por
+# una conexión keep-alive (requests.Session con pool) mientras guarda la foto,
+# persiste la fichada y contesta veredicto + payload de reescritura juntos.
+ANALYZE_URL               = os.getenv("HUB_ANALYZE_URL", "http://127.0.0.1:5000/analyze")
+ANALYZE_CONNECT_TIMEOUT_S = float(os.getenv("HUB_ANALYZE_CONNECT_TIMEOUT_S", "3"))
+ANALYZE_READ_TIMEOUT_S    = float(os.getenv("HUB_ANALYZE_READ_TIMEOUT_S", "60"))
+ANALYZE_POOL_SIZE         = int(os.getenv("HUB_ANALYZE_POOL_SIZE", "16"))
+
+# nombres del backend para cada EPP del padrón
+EPP_TO_BACKEND = {"lentes": "gafas"}
+
+class AnalyzeClient:
+    """Cliente del backend de análisis: un Session con pool (sin handshake por tap)."""
+
+    def __init__(self, url, pool_size=ANALYZE_POOL_SIZE):
+        self.url = url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def analyze(self, image_bytes, required, min_conf=HUB_MIN_CONF, precheck=True, uid=None):
+        """→ (payload, status). Errores de red/backend vuelven como payload ok=False.
+        uid acota el caché del backend a fotos de la misma persona."""
+        try:
+            r = self.session.post(
+                self.url,
+                files={"image": ("tap.jpg", image_bytes, "image/jpeg")},
+                data={"required": json.dumps([EPP_TO_BACKEND.get(x, x) for x in required]),
+                      "min_conf": str(min_conf), "precheck": "1" if precheck else "0", "uid": uid or ""},
+                timeout=(ANALYZE_CONNECT_TIMEOUT_S, ANALYZE_READ_TIMEOUT_S))
+        except requests.RequestException as ex:
+            count_error(f"analyze_{type(ex).__name__}")
+            return {"ok": False, "error": f"backend: {type(ex).__name__}"}, 502
+        try:
+            payload = r.json()
+        except ValueError:
+            payload = {"ok": False, "error": f"backend: HTTP {r.status_code}"}
+        if r.status_code != 200:
+            count_error(f"analyze_http_{r.status_code}")
+        return payload, r.status_code
+
+analyzer = AnalyzeClient(ANALYZE_URL)
+_tap_io = ThreadPoolExecutor(max_workers=int(os.getenv("HUB_TAP_IO_WORKERS", "4")), thread_name_prefix="tap-io")
+
+@app.post("/tap")
+def tap():
+    """uid + image → veredicto, fichada guardada y payload de reescritura."""
+    f = request.files.get("image")
+    uid = (request.form.get("uid") or "").strip()
+    if not f:
+        return jsonify({"ok": False, "error": "image missing"}), 400
+    if not uid:
+        return jsonify({"ok": False, "error": "uid missing"}), 400
+    raw = f.read()
+    e = employee_cache.get(uid)
+    required = epp_required_from_employee_row(e)
+
+    # la foto se escribe a disco mientras el backend analiza
+    saving = _tap_io.submit(save_ingest_image, io.BytesIO(raw))
+    precheck = request.form.get("precheck", "1") != "0"   # el kiosco manda 0 tras varios retakes
+    with stage("analyze"):
+        payload, an_status = analyzer.analyze(raw, required, precheck=precheck, uid=uid)
+    fname, sha, size = saving.result()
+
+    api_result = json.dumps(payload, ensure_ascii=False)
+    comp = compute_compliance(e, api_result)
+    # ts al persistir, no al recibir: el análisis puede tardar y los ids deben crecer con ts
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    row = {"ts": ts, "uid": uid, "nombre_tag": (request.form.get("nombre_tag") or "").strip(),
+           "epp_tag": [], "api_result": api_result, "image_file": fname, "sha": sha, "size": size}
+    extra, status = persist_record(row)
+    if status != 200:
+        return jsonify({"ok": False, "saved_image": fname, **extra}), status
+    if extra.get("saved") is False:
+        fname = None
+
+    detected = epp_from_mask(comp["detected_mask"])
+    out = {
+        "ok": True, **extra, "saved_image": fname, "ts": ts,
+        "uid": uid, "known": e is not None, "nombre": (e or {}).get("nombre") or "",
+        "bloqueado": bool((e or {}).get("bloqueado")),
+        "analysis_ok": an_status == 200 and bool(payload.get("ok")),
+        "pasa": None if comp["pasa"] is None else bool(comp["pasa"]),
+        "required": required, "detected": detected,
+        "missing": [x for x in required if x not in detected],
+        "photo_quality": comp["photo_quality"],
+        "retake": bool(payload.get("retake")),
+        "result": payload.get("result"),
+        "rewrite": bool(e and e["force_rewrite"]),
+    }
+    if not out["analysis_ok"]:
+        out["analysis_error"] = payload.get("error") or f"HTTP {an_status}"
+    if out["rewrite"]:
+        out["desired_payload"] = desired_payload_from_employee(e)
+    return jsonify(out)
+
+# ===== Comandos de mantenimiento (flask --app pc_hub <comando>) =====
+import click
+
+@app.cli.command("backfill-compliance")
+@click.option("--all", "recompute_all", is_flag=True, help="Recalcular también las filas que ya tienen valores.")
+@click.option("--batch", default=1000, show_default=True)
+def backfill_compliance(recompute_all, batch):
+    """Completa required_mask/detected_mask/pasa/photo_quality en records viejos
+    (la migración ya lo hace al crear las columnas; --all recalcula todo)."""
+    last_id, done = 0, 0
+    while True:
+        with db() as con:
+            n, last_id = backfill_compliance_batch(con, last_id, batch, recompute_all)
+        if not n:
+            break
+        done += n
+    if done:
+        with db() as con:
+            rebuild_compliance_rollup(con)
+    click.echo(f"{done} filas actualizadas")
+
+@app.cli.command("rebuild-rollups")
+@click.option("--from", "day_from", default=None, help="YYYY-MM-DD (default: desde el principio)")
+@click.option("--to", "day_to", default=None, help="YYYY-MM-DD (default: hasta hoy)")
+def rebuild_rollups(day_from, day_to):
+    """Recalcula compliance_daily desde records."""
+    t0 = time.perf_counter()
     with db() as con:
-        con.execute("""INSERT INTO records(ts,uid,nombre_tag,epp_tag_json,api_result_json,image_file)
-                       VALUES(?,?,?,?,?,?)""",
-                    (ts, uid, nombre_tag, json.dumps(epp_tag,ensure_ascii=False), api_result, fname))
-    return jsonify({"ok": True, "saved_image": fname})
+        rebuild_compliance_rollup(con, day_from, day_to)
+        n = con.execute("SELECT COUNT(*) FROM compliance_daily").fetchone()[0]
+    click.echo(f"compliance_daily: {n} filas ({time.perf_counter() - t0:.2f}s)")
+
+@app.cli.command("backfill-thumbs")
+def backfill_thumbs():
+    """Genera las miniaturas que falten para las imágenes ya guardadas."""
+    if PILImage is None:
+        raise click.ClickException("Pillow no está instalado")
+    made = failed = 0
+    for p in IMG_DIR.rglob("*"):
+        rel = p.relative_to(IMG_DIR).as_posix()
+        if not p.is_file() or rel.startswith("tmp/") or (THUMB_DIR / thumb_name(rel)).exists():
+            continue
+        try:
+            make_thumbnail(rel)
+            made += 1
+        except Exception as ex:
+            failed += 1
+            click.echo(f"{rel}: {ex}", err=True)
+    click.echo(f"{made} miniaturas generadas, {failed} con error")
+
+@app.cli.command("images-retention")
+@click.option("--days", default=IMAGE_RETENTION_DAYS, show_default=True,
+              help="Borrar fotos de fichadas más viejas que N días (0 = no borrar).")
+@click.option("--orphans-grace-h", default=24, show_default=True,
+              help="Borrar archivos sin ninguna referencia con más de N horas.")
+@click.option("--dry-run", is_flag=True)
+@click.option("--batch", default=500, show_default=True)
+def images_retention(days, orphans_grace_h, dry_run, batch):
+    """Saca la foto de records viejos (image_file=NULL), borra los archivos que
+    quedan sin referencias y compacta huérfanos (p.ej. cortes entre escritura e INSERT)."""
+    freed = detached = 0
+    if days > 0:
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        last_id = 0
+        while True:
+            with db() as con:
+                rows = con.execute("""SELECT id, image_file FROM records
+                                      WHERE ts < ? AND image_file IS NOT NULL AND id > ? ORDER BY id LIMIT ?""",
+                                   (cutoff, last_id, batch)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                if dry_run:   # solo cuenta: sigue con el lote siguiente sin tocar nada
+                    detached += len(rows)
+                    continue
+                to_delete = []
+                for r in rows:
+                    con.execute("UPDATE records SET image_file=NULL WHERE id=?", (r["id"],))
+                    if image_unref(con, r["image_file"]):
+                        to_delete.append(r["image_file"])
+                detached += len(rows)
+            # el archivo se borra después del COMMIT: si algo falla antes, queda como huérfano
+            for rel in to_delete:
+                image_store.delete(rel)
+                freed += 1
+
+    # Huérfanos: archivos que no están en images ni en records
+    orphans = 0
+    limit = time.time() - orphans_grace_h * 3600
+    with db() as con:
+        for p in IMG_DIR.rglob("*"):
+            if not p.is_file() or p.stat().st_mtime > limit:
+                continue
+            rel = p.relative_to(IMG_DIR).as_posix()
+            if rel.startswith("tmp/"):
+                orphan = True   # escritura interrumpida
+            else:
+                orphan = (con.execute("SELECT 1 FROM images WHERE path=?", (rel,)).fetchone() is None and
+                          con.execute("SELECT 1 FROM records WHERE image_file=? LIMIT 1", (rel,)).fetchone() is None)
+            if orphan:
+                orphans += 1
+                if not dry_run:
+                    image_store.delete(rel)
+    if dry_run:
+        click.echo(f"(dry-run) {detached} fichadas afectadas, {orphans} huérfanos")
+    else:
+        click.echo(f"{detached} fichadas sin foto, {freed} fotos liberadas, {orphans} huérfanos")
 
 # ===== Main =====
 if __name__ == "__main__":
+    start_sleep_syncer()
     app.run(host="0.0.0.0", port=8090, debug=False)